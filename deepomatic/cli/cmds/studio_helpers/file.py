@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 import os
-import json
 import uuid
 import logging
+from ... import serializer
 from ...thread_base import Greenlet
 from ...common import SUPPORTED_IMAGE_INPUT_FORMAT
 from ...json_schema import JSONSchemaType, validate_json
@@ -39,16 +39,16 @@ class UploadImageGreenlet(Greenlet):
                 file_meta = file.get('meta', {})
                 file_metadata = file_meta.get('metadata', '{}')
                 if type(file_metadata) is str:
-                    file_metadata = json.loads(file_metadata)
+                    file_metadata = serializer.loads(file_metadata)
                 if self._set_metadata_path:
                     file_metadata.update({'image_path': file['path']})
-                file_meta['metadata'] = json.dumps(file_metadata)
+                file_meta['metadata'] = serializer.dumps(file_metadata)
                 meta[file['key']] = file_meta
             except RuntimeError as e:
                 self.current_messages.report_error()
                 LOGGER.error('Something when wrong with {}: {}. Skipping it.'.format(file['path'], e))
         try:
-            rq = self._helper.post(url, data={"objects": json.dumps(meta)}, content_type='multipart/mixed', files=files)
+            rq = self._helper.post(url, data={"objects": serializer.dumps(meta)}, content_type='multipart/mixed', files=files)
             self._task.retrieve(rq['task_id'])
         except RuntimeError as e:
             self.current_messages.report_errors(len(meta))
@@ -105,7 +105,7 @@ class DatasetFiles(object):
                     line_number = 0
                     for line in fd:
                         line_number += 1
-                        line = json.loads(line)
+                        line = serializer.loads(line)
                         is_valid_json, error, schema_type = validate_json(line)
                         if schema_type == JSONSchemaType.STUDIO_HEADER:
                             self.post_header(org_slug, project_name, line)
@@ -9,6 +9,15 @@ from deepomatic.cli.common import (SUPPORTED_IMAGE_INPUT_FORMAT, SUPPORTED_IMAGE
                                    SUPPORTED_PROTOCOLS_INPUT, SUPPORTED_VIDEO_INPUT_FORMAT,
                                    SUPPORTED_VIDEO_OUTPUT_FORMAT, SUPPORTED_FOURCC,
                                    SUPPORTED_VIDEO_OUTPUT_COLOR_SPACE)
+from deepomatic.cli.concurrency import DEFAULT_MIN_CONCURRENCY, DEFAULT_MAX_CONCURRENCY
+from deepomatic.cli.metrics import DEFAULT_STATS_INTERVAL
+from deepomatic.cli.output_data import (REORDER_POLICIES, DEFAULT_REORDER_POLICY, DEFAULT_REORDER_WINDOW_MEMORY,
+                                        JSONL_FSYNC_POLICIES, DEFAULT_JSONL_FSYNC, DEFAULT_JSONL_FLUSH_INTERVAL,
+                                        DEFAULT_JSONL_FLUSH_BYTES, DEFAULT_OUTPUT_QUEUE_SIZE)
+from deepomatic.cli.lib.inference import (DEFAULT_ENCODING_WORKERS, DEFAULT_JPEG_QUALITY,
+                                          DEFAULT_BATCH_SIZE, DEFAULT_BATCH_MAX_WAIT, DEFAULT_RESULT_WORKERS,
+                                          DEFAULT_POSTPROCESSING_WORKERS)
+from deepomatic.cli.workflow.cached_workflow import DEFAULT_PREDICTION_CACHE_SIZE
 
 
 logger = logging.getLogger(__name__)
@@ -123,6 +132,18 @@ def valid_json(data):
         raise argparse.ArgumentTypeError("'{}' is not a valid JSON".format(data))
 
 
+def valid_label_thresholds(file_path):
+    try:
+        with open(file_path) as f:
+            label_thresholds = json.load(f)
+    except Exception:
+        raise argparse.ArgumentTypeError("'{}' is not a valid JSON file".format(file_path))
+    if not isinstance(label_thresholds, dict) or \
+            not all(isinstance(threshold, (int, float)) for threshold in label_thresholds.values()):
+        raise argparse.ArgumentTypeError("'{}' must be a JSON map of label names to thresholds".format(file_path))
+    return label_thresholds
+
+
 class BuildDict(argparse.Action):
     """
     This class is used in argparse. It will transform a chain of name:values into a dict.
@@ -182,12 +203,101 @@ def setup_model_cmd_line_parser(mode, cmd, inference_parsers):
         group.add_argument('--output_color_space', type=str,
                            help="Mainly useful for option `-o stdout`. Convert the outputed frame into the specified color space.",
                            choices=SUPPORTED_VIDEO_OUTPUT_COLOR_SPACE, default='BGR')
+        group.add_argument('--resume', action='store_true',
+                           help="Resume an interrupted job: the frames already output are skipped. The frames output"
+                           " are written to a journal next to the first output, which must all be .jsonl files,"
+                           " .json files with a %%s wildcard or directories.")
+        group.add_argument('--output_queue_size', type=int, default=DEFAULT_OUTPUT_QUEUE_SIZE,
+                           help="Each output writes the frames in its own thread, this is the number of frames waiting"
+                           " to be written by an output. 0 writes them in the output thread."
+                           " Defaults to {}.".format(DEFAULT_OUTPUT_QUEUE_SIZE))
+        group.add_argument('--jsonl_flush_interval', type=float, default=DEFAULT_JSONL_FLUSH_INTERVAL,
+                           help="The lines of a .jsonl output are buffered, and written at most this number of seconds"
+                           " after the previous write. Defaults to {}s.".format(DEFAULT_JSONL_FLUSH_INTERVAL))
+        group.add_argument('--jsonl_flush_bytes', type=int, default=DEFAULT_JSONL_FLUSH_BYTES,
+                           help="The lines of a .jsonl output are written once this number of bytes is buffered."
+                           " Defaults to {}.".format(DEFAULT_JSONL_FLUSH_BYTES))
+        group.add_argument('--jsonl_fsync', choices=JSONL_FSYNC_POLICIES, default=DEFAULT_JSONL_FSYNC,
+                           help="When a .jsonl output is synced to disk: never, after each write (flush) or at the end"
+                           " (close). Defaults to '{}'.".format(DEFAULT_JSONL_FSYNC))
 
     # Define output group for draw blur noop
     if cmd in ['draw', 'blur', 'noop']:
         group = output_groups[cmd]
         group.add_argument('-F', '--fullscreen', help="Fullscreen if window output.", action="store_true")
 
+    # Define monitoring group for infer draw blur noop
+    if cmd in ['infer', 'draw', 'blur', 'noop']:
+        group = inference_parsers.add_argument_group('monitoring arguments')
+        group.add_argument('--metrics_port', type=int, default=None,
+                           help="If set, serves the pipeline metrics on this port: Prometheus format on /metrics"
+                           " and json on /metrics.json.")
+        group.add_argument('--metrics_host', type=str, default='localhost',
+                           help="Address the metrics endpoint listens on, defaults to localhost.")
+        group.add_argument('--stats_file', type=str, default=None,
+                           help="If set, appends a json line with the pipeline metrics to this file every stats_interval seconds.")
+        group.add_argument('--stats_interval', type=float, default=DEFAULT_STATS_INTERVAL,
+                           help="Interval in seconds between two lines of the stats file, defaults to {}.".format(DEFAULT_STATS_INTERVAL))
+
+    # Define performance group for infer draw blur noop
+    if cmd in ['infer', 'draw', 'blur', 'noop']:
+        group = inference_parsers.add_argument_group('performance arguments')
+        group.add_argument('--reorder_window_frames', type=int, default=None,
+                           help="Maximum number of frames kept to output them in order, unlimited by default.")
+        group.add_argument('--reorder_window_memory', type=float, default=DEFAULT_REORDER_WINDOW_MEMORY,
+                           help="Maximum memory in MB used by the frames kept to output them in order,"
+                           " defaults to {}.".format(DEFAULT_REORDER_WINDOW_MEMORY))
+        group.add_argument('--reorder_policy', type=str, choices=REORDER_POLICIES, default=DEFAULT_REORDER_POLICY,
+                           help="What to do when the reorder window is full: 'block' limits the number of frames in"
+                           " the pipeline, 'unordered' outputs the frames out of order and 'drop' skips the frames that"
+                           " are late, which is useful for live streams. Defaults to '{}'.".format(DEFAULT_REORDER_POLICY))
+        group.add_argument('--decode_prefetch', type=int, default=0,
+                           help="Number of video frames decoded ahead by a dedicated thread, so that decoding overlaps"
+                           " with the rest of the pipeline. Disabled by default.")
+        group.add_argument('--no_frame_count', dest='count_frames', action='store_false',
+                           help="By default all the videos of an input directory are opened before starting, to count"
+                           " their frames for the progress bar. This option skips this count.")
+        group.add_argument('--input_cache', default=None,
+                           help="Path of a file caching the fps and the frame count of the videos of an input"
+                           " directory, so that they are not opened again to count their frames on the next runs.")
+        group.add_argument('--decode_workers', type=int, default=0,
+                           help="Number of worker processes decoding the files of an input directory concurrently."
+                           " The frames are still read in the order of the files. Disabled by default.")
+        group.add_argument('--encoding_workers', type=int, default=DEFAULT_ENCODING_WORKERS,
+                           help="Number of threads encoding the frames in jpeg before sending them,"
+                           " defaults to {} on this machine.".format(DEFAULT_ENCODING_WORKERS))
+        group.add_argument('--max_inference_size', type=int, default=None,
+                           help="If set, frames whose largest side is bigger than this size in pixels are downscaled"
+                           " before being sent for inference. The outputs still use the original frames.")
+        group.add_argument('--no_jpeg_passthrough', dest='jpeg_passthrough', action='store_false',
+                           help="By default jpeg image inputs are sent as is for inference and only decoded if an output"
+                           " needs the image. This option forces them to be decoded and encoded again.")
+        group.add_argument('--jpeg_quality', type=int, choices=range(1, 101), default=DEFAULT_JPEG_QUALITY, metavar='[1-100]',
+                           help="Quality of the jpeg sent for inference, defaults to {}.".format(DEFAULT_JPEG_QUALITY))
+        group.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE,
+                           help="Maximum number of frames sent together for inference, defaults to {}."
+                           " Cloud requests of a batch are sent concurrently.".format(DEFAULT_BATCH_SIZE))
+        group.add_argument('--batch_max_wait', type=float, default=DEFAULT_BATCH_MAX_WAIT,
+                           help="Maximum time in seconds to wait for frames to fill a batch,"
+                           " defaults to {}.".format(DEFAULT_BATCH_MAX_WAIT))
+        group.add_argument('--min_concurrency', type=int, default=DEFAULT_MIN_CONCURRENCY,
+                           help="Minimum number of inference requests in flight, defaults to {}."
+                           " The number of requests in flight adapts to the latency and the errors of the"
+                           " inference backend.".format(DEFAULT_MIN_CONCURRENCY))
+        group.add_argument('--max_concurrency', type=int, default=DEFAULT_MAX_CONCURRENCY,
+                           help="Maximum number of inference requests in flight,"
+                           " defaults to {}.".format(DEFAULT_MAX_CONCURRENCY))
+        group.add_argument('--target_latency', type=float, default=None,
+                           help="If set, the number of inference requests in flight is decreased when getting a result"
+                           " takes longer than this time in seconds. By default, it is only decreased on errors.")
+        group.add_argument('--result_workers', type=int, default=DEFAULT_RESULT_WORKERS,
+                           help="Number of greenlets waiting for the inference results and converting them,"
+                           " defaults to {}.".format(DEFAULT_RESULT_WORKERS))
+        group.add_argument('--postprocessing_workers', type=int, default=DEFAULT_POSTPROCESSING_WORKERS,
+                           help="Number of threads drawing or blurring the frames before they are reordered, defaults"
+                           " to {} on this machine. With 0, the frames are drawn or blurred by the output"
+                           " thread.".format(DEFAULT_POSTPROCESSING_WORKERS))
+
     # Define option group for draw blur
     if cmd in ['draw', 'blur']:
         subparser = inference_parsers
@@ -203,6 +313,15 @@ def setup_model_cmd_line_parser(mode, cmd, inference_parsers):
         group.add_argument('-t', '--threshold', type=float,
                            help="Threshold above which a prediction is considered valid.",
                            default=None)
+        group.add_argument('--label_thresholds', type=valid_label_thresholds, default=None,
+                           help="JSON file mapping label names to the threshold above which their predictions are"
+                           " considered valid. Labels missing from the file use --threshold.")
+        group.add_argument('--prediction_cache', default=None,
+                           help="Path of a local cache of the predictions, keyed by the content of the images sent and"
+                           " the recognition. The images already in the cache are not sent again.")
+        group.add_argument('--prediction_cache_size', type=float, default=DEFAULT_PREDICTION_CACHE_SIZE,
+                           help="Size in MB of the predictions kept in the cache, the least recently used ones are"
+                           " evicted beyond. Defaults to {} MB.".format(DEFAULT_PREDICTION_CACHE_SIZE))
 
     # Define onprem group for infer draw blur
     if mode == "site" and cmd in ['infer', 'draw', 'blur']:
@@ -211,6 +330,9 @@ def setup_model_cmd_line_parser(mode, cmd, inference_parsers):
                            help="AMQP url for on-premises deployments.")
         group.add_argument('-k', '--routing_key', required=True,
                            help="Recognition routing key for on-premises deployments.")
+        group.add_argument('--amqp_consumers', type=int, default=1,
+                           help="Number of AMQP connections consuming the inference responses, each one with its own"
+                           " response queue. Defaults to 1.")
 
     if cmd == "draw":
         # Define draw specific options
@@ -1,6 +1,12 @@
 import io
 import os
 import cv2
+import numpy as np
+import time
+import struct
+import collections
+import gevent
+import gevent.event
 import logging
 try:
     import Queue as queue
@@ -10,12 +16,12 @@ except ImportError:
 from deepomatic.cli.version import __title__, __version__
 
 Full = queue.Full
-Queue = queue.Queue
 Empty = queue.Empty
 
 LOGGER = logging.getLogger(__name__)
 SUPPORTED_STUDIO_INPUT_FORMAT = ['.txt']
 SUPPORTED_IMAGE_INPUT_FORMAT = ['.bmp', '.jpeg', '.jpg', '.jpe', '.png', '.tif', '.tiff']
+JPEG_INPUT_FORMAT = ['.jpeg', '.jpg', '.jpe']
 SUPPORTED_VIDEO_INPUT_FORMAT = ['.avi', '.mp4', '.webm', '.mjpg']
 SUPPORTED_FILE_INPUT_FORMAT = SUPPORTED_IMAGE_INPUT_FORMAT + SUPPORTED_VIDEO_INPUT_FORMAT
 SUPPORTED_PROTOCOLS_INPUT = ['rtsp', 'http', 'https']
@@ -39,6 +45,12 @@ SUPPORTED_FOURCC = {
     '.avi': ['XVID', 'MJPG']
 }
 
+# Start Of Frame markers, the other markers of the 0xC0-0xCF range are DHT, JPG and DAC
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+JPEG_SOS_MARKER = 0xDA
+JPEG_APP1_MARKER = 0xE1
+EXIF_ORIENTATION_TAG = 0x0112
+
 
 class TqdmToLogger(io.StringIO):
     """Tqdm output stream to play nice with logger."""
@@ -58,9 +70,215 @@ class TqdmToLogger(io.StringIO):
         self.logger.log(self.level, self.buf)
 
 
+class Waiter(object):
+    """
+    Allow a greenlet to wait for a notification sent from any thread.
+    gevent primitives are bound to the hub of the thread that created them, so the
+    notification goes through an async watcher (safe to trigger from another thread)
+    which sets an event in the hub of the waiting greenlet.
+    """
+    def __init__(self):
+        self._event = gevent.event.Event()
+        self._watcher = gevent.get_hub().loop.async_()
+        self._watcher.start(self._event.set)
+
+    def wait(self, timeout=None):
+        return self._event.wait(timeout)
+
+    def clear(self):
+        self._event.clear()
+
+    def notify(self):
+        self._watcher.send()
+
+    def close(self):
+        self._watcher.close()
+
+
+class Queue(queue.Queue):
+    """
+    A queue.Queue that can be waited on from greenlets and threads without blocking their hub.
+    Consumers are woken up only when an item is put and producers only when an item is taken.
+    Blocked producers are served in arrival order, so that a pool keeps the order of the messages as much as possible.
+    """
+    def __init__(self, maxsize=0):
+        queue.Queue.__init__(self, maxsize)
+        self._getters = []
+        self._putters = []
+        self._put_turns = collections.deque()  # waiters of the blocked put() calls, in arrival order
+
+    @staticmethod
+    def _notify(waiters):
+        # Must be called with the mutex held
+        for waiter in waiters:
+            waiter.notify()
+
+    def _put(self, item):
+        queue.Queue._put(self, item)
+        self._notify(self._getters)
+
+    def _get(self):
+        item = queue.Queue._get(self)
+        self._notify(self._putters)
+        return item
+
+    def _full(self):
+        return 0 < self.maxsize <= self._qsize()
+
+    def _wait(self, can_proceed, waiters, timeout):
+        # Wait until can_proceed() is true, a notification is received or the timeout expires
+        # The check and the waiter registration are done atomically to not miss a notification
+        with self.mutex:
+            if can_proceed():
+                return True
+            waiter = Waiter()
+            waiters.append(waiter)
+        try:
+            waiter.wait(timeout)
+        finally:
+            with self.mutex:
+                waiters.remove(waiter)
+                waiter.close()
+                proceed = can_proceed()
+        return proceed
+
+    def wait_not_empty(self, timeout=None):
+        """Returns True if an item is available, False if the timeout expired or if woken up by wake_up()."""
+        return self._wait(self._qsize, self._getters, timeout)
+
+    def wait_not_full(self, timeout=None):
+        """Returns True if an item can be put, False if the timeout expired or if woken up by wake_up()."""
+        return self._wait(lambda: not self._full(), self._putters, timeout)
+
+    def _blocking(self, action, exception, wait, block, timeout):
+        if not block:
+            return action()
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            try:
+                return action()
+            except exception:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise
+                wait(remaining)
+
+    def get(self, block=True, timeout=None):
+        return self._blocking(lambda: queue.Queue.get(self, False),
+                              Empty, self.wait_not_empty, block, timeout)
+
+    def _put_item(self, item):
+        # Must be called with the mutex held
+        self._put(item)
+        self.unfinished_tasks += 1
+        self.not_empty.notify()
+
+    def put(self, item, block=True, timeout=None):
+        with self.mutex:
+            if not self._put_turns and not self._full():
+                self._put_item(item)
+                return
+            if not block:
+                raise Full
+            waiter = Waiter()
+            self._putters.append(waiter)
+            self._put_turns.append(waiter)
+        deadline = None if timeout is None else time.time() + timeout
+        try:
+            while True:
+                # Clearing before checking makes sure we don't miss a notification
+                waiter.clear()
+                with self.mutex:
+                    if self._put_turns[0] is waiter and not self._full():
+                        self._put_item(item)
+                        return
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Full
+                waiter.wait(remaining)
+        finally:
+            with self.mutex:
+                self._putters.remove(waiter)
+                self._put_turns.remove(waiter)
+                waiter.close()
+                if self._put_turns and not self._full():
+                    # Our turn is over, let the next producer check
+                    self._put_turns[0].notify()
+
+    def clear(self):
+        with self.mutex:
+            self.queue.clear()
+            self._notify(self._putters)
+
+    def wake_up(self):
+        """Wake up all waiting consumers and producers, used to make them check if they should stop."""
+        with self.mutex:
+            self._notify(self._getters)
+            self._notify(self._putters)
+
+
+def read_exif_orientation(tiff):
+    # The EXIF data is a TIFF structure, the orientation is in the first IFD
+    byte_order = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if byte_order is None or len(tiff) < 8:
+        return None
+    ifd_offset = struct.unpack(byte_order + 'I', tiff[4:8])[0]
+    if ifd_offset + 2 > len(tiff):
+        return None
+    nb_entries = struct.unpack(byte_order + 'H', tiff[ifd_offset:ifd_offset + 2])[0]
+    for i in range(nb_entries):
+        entry = ifd_offset + 2 + 12 * i
+        if entry + 12 > len(tiff):
+            break
+        tag, _, _, value = struct.unpack(byte_order + 'HHI4s', tiff[entry:entry + 12])
+        if tag == EXIF_ORIENTATION_TAG:
+            return struct.unpack(byte_order + 'H', value[:2])[0]
+    return None
+
+
+def read_jpeg_header(data):
+    """
+    Reads the size and the EXIF orientation of a jpeg without decoding it.
+    Returns (width, height, orientation) or None if data does not look like a complete jpeg.
+    """
+    if len(data) < 4 or data[:2] != b'\xff\xd8' or data[-2:] != b'\xff\xd9':
+        return None
+    orientation = None
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            # Fill byte
+            offset += 1
+            continue
+        length = struct.unpack('>H', data[offset + 2:offset + 4])[0]
+        segment = data[offset + 4:offset + 2 + length]
+        if marker == JPEG_APP1_MARKER and segment[:6] == b'Exif\x00\x00':
+            orientation = read_exif_orientation(segment[6:])
+        elif marker in JPEG_SOF_MARKERS:
+            if len(segment) < 5:
+                return None
+            height, width = struct.unpack('>HH', segment[1:5])
+            return width, height, orientation
+        elif marker == JPEG_SOS_MARKER:
+            # Image data before any frame header
+            return None
+        offset += 2 + length
+    return None
+
+
+def decode_image(data):
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+
 def clear_queue(queue):
-    with queue.mutex:
-        queue.queue.clear()
+    queue.clear()
 
 
 def write_frame_to_disk(frame, path):
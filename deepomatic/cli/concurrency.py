@@ -0,0 +1,82 @@
+import time
+import logging
+import gevent.event
+
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_MIN_CONCURRENCY = 1
+DEFAULT_MAX_CONCURRENCY = 50
+DECREASE_FACTOR = 0.5
+
+
+class ConcurrencyLimiter(object):
+    """
+    Limit the number of inference requests in flight, the limit is adapted from the results with AIMD:
+    - slow start: until the first congestion, the limit grows by one for each result, so it doubles every round trip
+    - then it grows by one for each limit results, so by one every round trip
+    - a timeout, an error or a latency above target_latency is a congestion, the limit is halved.
+      Only the requests sent after the last decrease can decrease it again, so it is halved at most once per round trip.
+    The limit stays between min_concurrency and max_concurrency.
+    It is used by the send and result greenlets, which run in the same hub.
+    """
+    def __init__(self, min_concurrency=DEFAULT_MIN_CONCURRENCY, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 target_latency=None):
+        self.min_concurrency = max(1, min_concurrency)
+        self.max_concurrency = max(self.min_concurrency, max_concurrency)
+        self.target_latency = target_latency
+        self.limit = float(self.min_concurrency)
+        self.in_flight = 0
+        self.slow_start = True
+        self.nb_decreases = 0
+        self._last_decrease = 0.
+        self._room = gevent.event.Event()
+        self._room.set()
+
+    def _update_room(self):
+        if self.in_flight < int(self.limit):
+            self._room.set()
+        else:
+            self._room.clear()
+
+    def acquire(self, nb_requests=1, timeout=None):
+        """
+        Wait until a request can be sent, then count nb_requests in flight.
+        A batch is sent as soon as one request can be sent, so the limit can be exceeded by the size of a batch.
+        Returns the time at which the requests are sent, to be given to release(), or None after timeout.
+        """
+        if not self._room.wait(timeout):
+            return None
+        self.in_flight += nb_requests
+        self._update_room()
+        return time.time()
+
+    def release(self, sent_at, congestion=False):
+        """Called when the result of a request is received, or when it could not be sent."""
+        self.in_flight -= 1
+        if congestion or (self.target_latency is not None and time.time() - sent_at > self.target_latency):
+            self._decrease(sent_at)
+        else:
+            self._increase()
+        self._update_room()
+
+    def cancel(self, nb_requests=1):
+        """Requests acquired but not sent, they don't tell anything about the load."""
+        self.in_flight -= nb_requests
+        self._update_room()
+
+    def _increase(self):
+        if self.slow_start:
+            self.limit += 1
+        else:
+            self.limit += 1. / self.limit
+        self.limit = min(self.limit, self.max_concurrency)
+
+    def _decrease(self, sent_at):
+        if sent_at < self._last_decrease:
+            # Sent before the last decrease, the congestion has already been taken into account
+            return
+        self.slow_start = False
+        self.limit = max(self.limit * DECREASE_FACTOR, self.min_concurrency)
+        self.nb_decreases += 1
+        self._last_decrease = time.time()
+        LOGGER.debug('Congestion detected, inference concurrency decreased to {}'.format(int(self.limit)))
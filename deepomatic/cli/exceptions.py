@@ -42,6 +42,10 @@ class DeepoInputError(DeepoCLIException):
     pass
 
 
+class DeepoResumeError(DeepoCLIException):
+    pass
+
+
 class DeepoPredictionJsonError(DeepoCLIException):
     pass
 
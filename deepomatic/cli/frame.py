@@ -1,19 +1,50 @@
+import threading
+from .common import decode_image
 from .thread_base import CurrentMessages
 
 
 class Frame(object):
-    def __init__(self, name, filename, image, decoded_video_frame_index=None, absolute_video_frame_index=None):
+    def __init__(self, name, filename, image, decoded_video_frame_index=None, absolute_video_frame_index=None,
+                 image_loader=None):
         # The Frame object is used as a data exchanged in the different queues
         self.name = name  # name of the frame
         self.filename = filename  # the original filename from which the frame was extracted
-        self.image = image  # an opencv loaded image (numpy array)
+        self._image = image  # an opencv loaded image (numpy array)
+        self._image_loader = image_loader  # if set, the image is only loaded when accessed
         self.decoded_video_frame_index = decoded_video_frame_index  # frame index in the input sequence (skipped frames are not included)
         self.absolute_video_frame_index = absolute_video_frame_index  # frame index in the input sequence (skipped frames included)
         self.frame_number = None  # frame_number since deepocli started (set by input_loop)
         self.inference_async_result = None  # an inference request object that will allow us to retrieve the predictions when ready
-        self.predictions = None  # predictions result dict
+        self.inference_sent_at = None  # time at which the inference request was sent
+        self.predictions = None  # predictions result (see predictions.Predictions)
         self.output_image = None  # frame to output (modified version of the image, check infer postprocessings draw/blur)
         self.buf_bytes = None
+        self.jpeg_bytes = None  # original jpeg file content, can be sent as is for inference
+        self.jpeg_size = None  # (width, height) of jpeg_bytes
+
+    @property
+    def image(self):
+        if self._image_loader is not None:
+            self._image = self._image_loader()
+            self._image_loader = None
+        return self._image
+
+    @image.setter
+    def image(self, image):
+        self._image = image
+        self._image_loader = None
+
+    def __getstate__(self):
+        # Frames decoded by the decode workers are pickled, the image loader can't be: it is rebuilt from jpeg_bytes
+        state = self.__dict__.copy()
+        state['_image_loader'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._image is None and self.jpeg_bytes is not None:
+            data = self.jpeg_bytes
+            self._image_loader = lambda: decode_image(data)
 
     def __str__(self):
         return "<Frame {}>".format(' '.join("{}={}".format(key, getattr(self, key)) for key in [
@@ -25,12 +56,70 @@ class Frame(object):
             'inference_async_result']))
 
 
+def frame_size(frame):
+    """Memory used by the frame in bytes, used by the reorder window."""
+    size = 0
+    # Don't load the image to measure it
+    if frame._image is not None:
+        size += frame._image.nbytes
+    if frame.buf_bytes is not None:
+        size += len(frame.buf_bytes)
+    if frame.jpeg_bytes is not None and frame.jpeg_bytes is not frame.buf_bytes:
+        size += len(frame.jpeg_bytes)
+    if frame.output_image is not None and frame.output_image is not frame._image:
+        size += frame.output_image.nbytes
+    return size
+
+
 class CurrentFrames(CurrentMessages):
+    """
+    Frames currently processed in the pipeline.
+    If max_frames or max_bytes is set, wait_for_room() allows to block new frames until there is room for them.
+    """
+    def __init__(self, max_frames=None, max_bytes=None):
+        super(CurrentFrames, self).__init__()
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.nb_bytes = 0
+        self._sizes = {}
+        self._room = threading.Condition(self._lock)
+
+    def _released(self, msg):
+        self.nb_bytes -= self._sizes.pop(msg, 0)
+        self._room.notify_all()
+
+    def _has_room(self, size):
+        if not self._alive:
+            # Always accept a frame when nothing else is processed, even if it is bigger than max_bytes
+            return True
+        if self.max_frames is not None and len(self._alive) >= self.max_frames:
+            return False
+        if self.max_bytes is not None and self.nb_bytes + size > self.max_bytes:
+            return False
+        return True
+
+    def wait_for_room(self, frame, timeout=None):
+        """Returns True when there is room for the frame, False after timeout."""
+        if self.max_frames is None and self.max_bytes is None:
+            return True
+        size = frame_size(frame)
+        with self._room:
+            return self._room.wait_for(lambda: self._has_room(size), timeout)
+
     def forget_frame(self, frame, count_as_error=True):
         self.forget_message(frame.frame_number, count_as_error=count_as_error)
 
     def add_frame(self, frame):
         self.add_message(frame.frame_number)
+        if self.max_bytes is not None:
+            size = frame_size(frame)
+            with self._lock:
+                if frame.frame_number in self._alive:
+                    self._sizes[frame.frame_number] = size
+                    self.nb_bytes += size
+
+    def was_skipped(self, frame):
+        return self.take_skipped(frame.frame_number)
 
     def get_oldest(self):
         return self.get_min()
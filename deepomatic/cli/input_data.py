@@ -1,22 +1,33 @@
 import os
-import json
+import time
+import queue
+import threading
 import urllib.request
 import cv2
 import numpy as np
 import logging
 import errno
+import itertools
+import collections
+import multiprocessing
 from tqdm import tqdm
 
+from . import serializer
 from .common import (SUPPORTED_IMAGE_INPUT_FORMAT, SUPPORTED_PROTOCOLS_INPUT,
-                     SUPPORTED_VIDEO_INPUT_FORMAT, SUPPORTED_STUDIO_INPUT_FORMAT, TqdmToLogger,
-                     clear_queue)
+                     SUPPORTED_VIDEO_INPUT_FORMAT, SUPPORTED_STUDIO_INPUT_FORMAT, JPEG_INPUT_FORMAT, TqdmToLogger,
+                     clear_queue, read_jpeg_header, decode_image)
 from .exceptions import DeepoFPSError, DeepoInputError, DeepoVideoOpenError
 from .frame import Frame
-from .thread_base import Thread
+from .input_manifest import InputManifest
+from .thread_base import Thread, WAIT_TIMEOUT
 from .json_schema import validate_json, JSONSchemaType
 
 
 LOGGER = logging.getLogger(__name__)
+DECODE_WORKER_PREFETCH = 16
+DECODE_WORKER_SOURCES_AHEAD = 2
+# Arguments needed to open the sources in the decode workers, the others may not be picklable
+DECODE_WORKER_ARGS = ('input_fps', 'skip_frame', 'recognition_id', 'jpeg_passthrough')
 
 
 def get_input(descriptor, kwargs):
@@ -62,8 +73,12 @@ class InputThread(Thread):
         self.frame_number = 0  # Used to keep input order, notably for video reconstruction
 
     def process_msg(self, _unused):
+        journal = self.inputs.journal
         try:
             frame = next(self.inputs)
+            # Frames output by the interrupted job are skipped when it is resumed
+            while journal is not None and journal.skip(frame.filename, frame.name):
+                frame = next(self.inputs)
         except StopIteration:
             self.stop()
             return
@@ -80,8 +95,18 @@ class InputThread(Thread):
         super(InputThread, self).put_to_output(msg)
         self.frame_number += 1
 
+    def init(self):
+        # Set by the MainLoop after the inputs were created
+        self.inputs.metrics = self.metrics
+
+    def close(self):
+        self.inputs.close()
+
 
 class InputData(object):
+    metrics = None  # set by the InputThread
+    journal = None  # set when resuming a job, see journal.ResumeJournal
+
     def __init__(self, descriptor, **kwargs):
         self._args = kwargs
         self._descriptor = descriptor
@@ -111,6 +136,9 @@ class InputData(object):
     def is_infinite(self):
         raise NotImplementedError()
 
+    def close(self):
+        pass
+
 
 class ImageInputData(InputData):
     @classmethod
@@ -121,9 +149,27 @@ class ImageInputData(InputData):
     def __init__(self, descriptor, **kwargs):
         super(ImageInputData, self).__init__(descriptor, **kwargs)
         self._name = '%s_%s' % (self._name, self._reco)
+        _, ext = os.path.splitext(descriptor)
+        self._jpeg_passthrough = kwargs.get('jpeg_passthrough', True) and ext.lower() in JPEG_INPUT_FORMAT
+
+    def _load_jpeg(self):
+        # The file content can be sent as is for inference, the image is only decoded if needed
+        with open(self._descriptor, 'rb') as f:
+            data = f.read()
+        header = read_jpeg_header(data)
+        if header is None or header[2] not in (None, 1):
+            # Invalid jpeg, or needing a rotation we let opencv handle
+            return None
+        frame = Frame(self._name, self._filename, None, image_loader=lambda: decode_image(data))
+        frame.jpeg_bytes = data
+        frame.jpeg_size = header[:2]
+        return frame
 
     def __iter__(self):
-        self._iterator = iter([Frame(self._name, self._filename, cv2.imread(self._descriptor, 1))])
+        frame = self._load_jpeg() if self._jpeg_passthrough else None
+        if frame is None:
+            frame = Frame(self._name, self._filename, cv2.imread(self._descriptor, 1))
+        self._iterator = iter([frame])
         return self
 
     def __next__(self):
@@ -163,7 +209,7 @@ class StudioInputData(InputData):
             for line_i, line in tqdm(enumerate(f), total=0, file=tqdmout, desc="Loading the input file..."):
                 line = line.strip()
                 try:
-                    json_data = json.loads(line)
+                    json_data = serializer.loads(line)
                     is_valid, error, schema_type = validate_json(json_data)
                     if schema_type == JSONSchemaType.STUDIO_HEADER:
                         pass
@@ -224,6 +270,69 @@ class StudioInputData(InputData):
         return False
 
 
+def video_frame_count(frame_count, video_fps, extract_fps, skip_frame):
+    """Number of frames read from a video, see VideoInputData.get_fps for the extract fps."""
+    fps_ratio = extract_fps / video_fps
+    skip_ratio = 1. / (1 + skip_frame)
+    return int(frame_count * fps_ratio * skip_ratio)
+
+
+class DecodeRing(object):
+    """
+    Decode frames ahead in a dedicated thread, so that decoding overlaps with the rest of the input stage.
+    At most depth decoded frames wait in the ring, the decoder waits for some room when it is full.
+    """
+    END = object()
+
+    def __init__(self, next_frame, depth, on_decoded=None):
+        self._next_frame = next_frame
+        self._on_decoded = on_decoded
+        self._frames = queue.Queue(maxsize=depth)
+        self._stopped = False
+        self._done = False
+        self._thread = threading.Thread(target=self._run, name='DecodeRing', daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return self._frames.qsize()
+
+    def _run(self):
+        item = None
+        while not self._stopped and item is not self.END and not isinstance(item, Exception):
+            start = time.time()
+            try:
+                item = self._next_frame()
+            except StopIteration:
+                item = self.END
+            except Exception as e:
+                # Raised again by the consumer
+                item = e
+            if self._on_decoded is not None:
+                self._on_decoded(time.time() - start)
+            while not self._stopped:
+                try:
+                    self._frames.put(item, timeout=WAIT_TIMEOUT)
+                    break
+                except queue.Full:
+                    continue
+
+    def get(self):
+        if self._done:
+            raise StopIteration()
+        item = self._frames.get()
+        if item is self.END:
+            self._done = True
+            raise StopIteration()
+        if isinstance(item, Exception):
+            self._done = True
+            raise item
+        return item
+
+    def close(self):
+        self._stopped = True
+        self._thread.join()
+
+
 class VideoInputData(InputData):
     @classmethod
     def is_valid(cls, descriptor):
@@ -239,6 +348,8 @@ class VideoInputData(InputData):
         self._open_video()
         self._kwargs_fps = kwargs['input_fps']
         self._skip_frame = kwargs['skip_frame']
+        self._decode_prefetch = kwargs.get('decode_prefetch') or 0
+        self._ring = None
         self._extract_fps = None
         self._fps = self.get_fps()
 
@@ -255,6 +366,7 @@ class VideoInputData(InputData):
         return True
 
     def __iter__(self):
+        self.close()
         self._open_video()
         self._absolute_video_frame_index = 0
         self._decoded_video_frame_index = 0
@@ -298,6 +410,24 @@ class VideoInputData(InputData):
             self._stop_video()
 
     def __next__(self):
+        if not self._decode_prefetch:
+            return self._next_frame()
+        if self._ring is None:
+            # Started with the first frame, the capture must not be used by other threads once it is decoding
+            self._ring = DecodeRing(self._next_frame, self._decode_prefetch, self._observe_decode)
+        return self._ring.get()
+
+    def _observe_decode(self, duration):
+        if self.metrics is not None:
+            self.metrics.observe_processing('decode', duration)
+            self.metrics.set_gauge('decode_ring_frames', len(self._ring) if self._ring is not None else 0)
+
+    def close(self):
+        if self._ring is not None:
+            self._ring.close()
+            self._ring = None
+
+    def _next_frame(self):
         # make sure we don't enter infinite loop
         assert self._frames_to_skip >= 0
         assert self._extract_fps >= 0
@@ -353,10 +483,9 @@ class VideoInputData(InputData):
     def get_frame_count(self):
         assert self._video_fps > 0
 
-        fps_ratio = self._extract_fps / self._video_fps
-        skip_ratio = 1. / (1 + self._skip_frame)
         try:
-            return int(self._cap.get(cv2.CAP_PROP_FRAME_COUNT) * fps_ratio * skip_ratio)
+            return video_frame_count(self._cap.get(cv2.CAP_PROP_FRAME_COUNT), self._video_fps,
+                                     self._extract_fps, self._skip_frame)
         except Exception:
             LOGGER.warning('Cannot compute the total frame count')
             return 0
@@ -365,7 +494,25 @@ class VideoInputData(InputData):
         return False
 
 
+def decode_worker(tasks, results, kwargs):
+    """Decode the sources received one after the other in a worker process, each of them ends with None."""
+    for input_cls, descriptor in iter(tasks.get, None):
+        try:
+            source = input_cls(descriptor, **kwargs)
+            for frame in source:
+                results.put(frame)
+            source.close()
+        except Exception as e:
+            results.put(DeepoInputError('Could not decode {}: {}'.format(descriptor, e)))
+        results.put(None)
+
+
 class DirectoryInputData(InputData):
+    """
+    The directory is scanned lazily: the sources are created one after the other while the frames are read,
+    and a video is only opened when it is decoded. Only counting the frames for the progress bar opens all the
+    videos, it can be disabled with count_frames=False.
+    """
     @classmethod
     def is_valid(cls, descriptor):
         return (os.path.exists(descriptor) and os.path.isdir(descriptor))
@@ -373,28 +520,102 @@ class DirectoryInputData(InputData):
     def __init__(self, descriptor, **kwargs):
         super(DirectoryInputData, self).__init__(descriptor, **kwargs)
         self._current = None
-        self._files = []
-        self._inputs = []
         self._recursive = self._args['recursive']
-
-        if self.is_valid(descriptor):
-            _paths = [os.path.join(descriptor, name) for name in os.listdir(descriptor)]
-            self._inputs = []
-            for path in sorted(_paths):
-                if ImageInputData.is_valid(path):
-                    LOGGER.debug('Image input data detected for {}'.format(path))
-                    self._inputs.append(ImageInputData(path, **kwargs))
-                elif VideoInputData.is_valid(path):
-                    LOGGER.debug('Video input data detected for {}'.format(path))
-                    self._inputs.append(VideoInputData(path, **kwargs))
-                elif self._recursive and self.is_valid(path):
-                    LOGGER.debug('Directory input data detected for {}'.format(path))
-                    self._inputs.append(DirectoryInputData(path, **kwargs))
+        self._count_frames = kwargs.get('count_frames', True)
+        self._input_cache = kwargs.get('input_cache')
+        self._decode_workers = kwargs.get('decode_workers') or 0
+        self._workers = []
+
+    def _scan(self, directory):
+        """Yields the (input class, path) of the sources of the directory, in the order of their paths."""
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        for entry in entries:
+            _, ext = os.path.splitext(entry.name)
+            ext = ext.lower()
+            if entry.is_dir():
+                if self._recursive:
+                    LOGGER.debug('Directory input data detected for {}'.format(entry.path))
+                    for source in self._scan(entry.path):
+                        yield source
+            elif ext in SUPPORTED_IMAGE_INPUT_FORMAT:
+                LOGGER.debug('Image input data detected for {}'.format(entry.path))
+                yield ImageInputData, entry.path
+            elif ext in SUPPORTED_VIDEO_INPUT_FORMAT:
+                LOGGER.debug('Video input data detected for {}'.format(entry.path))
+                yield VideoInputData, entry.path
+
+    def _sources(self):
+        for input_cls, path in self._scan(self._descriptor):
+            if self.journal is not None and input_cls is ImageInputData:
+                # Don't even read the images already output by the resumed job
+                image = ImageInputData(path, **self._args)
+                if self.journal.skip(image._filename, image._name):
+                    continue
+            yield input_cls, path
 
     def _gen(self):
-        for source in self._inputs:
+        if self._decode_workers:
+            for frame in self._gen_parallel():
+                yield frame
+            return
+        for input_cls, path in self._sources():
+            source = input_cls(path, **self._args)
+            source.metrics = self.metrics
+            self._current = source
             for frame in source:
                 yield frame
+            source.close()
+            self._current = None
+
+    def _start_worker(self, context, tasks, results):
+        worker_args = {key: value for key, value in self._args.items() if key in DECODE_WORKER_ARGS}
+        worker = context.Process(target=decode_worker, args=(tasks, results, worker_args),
+                                 name='DecodeWorker-{}'.format(len(self._workers)), daemon=True)
+        worker.start()
+        self._workers.append(worker)
+
+    def _gen_parallel(self):
+        # Source i is decoded by worker i % decode_workers, and each worker decodes its sources in order into its own
+        # queue: reading the sources in order from the queue of their worker yields the frames in the same order
+        # as the sequential decoding, while the next sources are decoded by the other workers.
+        # The sources are sent to the workers while the directory is scanned, a few sources ahead.
+        context = multiprocessing.get_context('spawn')
+        prefetch = self._args.get('decode_prefetch') or DECODE_WORKER_PREFETCH
+        sources = enumerate(self._sources())
+        tasks, results = [], []
+        pending = collections.deque()
+
+        def dispatch():
+            for i, source in itertools.islice(sources, 1):
+                worker = i % self._decode_workers
+                if worker == len(self._workers):
+                    # The workers are only started when needed, a small directory doesn't need all of them
+                    tasks.append(context.Queue())
+                    results.append(context.Queue(maxsize=prefetch))
+                    self._start_worker(context, tasks[worker], results[worker])
+                tasks[worker].put(source)
+                pending.append(worker)
+
+        for _ in range(DECODE_WORKER_SOURCES_AHEAD * self._decode_workers):
+            dispatch()
+        while pending:
+            worker = pending.popleft()
+            dispatch()
+            for frame in iter(results[worker].get, None):
+                if isinstance(frame, Exception):
+                    raise frame
+                yield frame
+        self.close()
+
+    def close(self):
+        if self._current is not None:
+            self._current.close()
+        for worker in self._workers:
+            # The workers may be waiting for some room in their queue if the decoding is interrupted
+            worker.terminate()
+            worker.join()
+        self._workers = []
 
     def __iter__(self):
         self.gen = self._gen()
@@ -404,7 +625,42 @@ class DirectoryInputData(InputData):
         return next(self.gen)
 
     def get_frame_count(self):
-        return sum([_input.get_frame_count() for _input in self._inputs])
+        if not self._count_frames:
+            return -1
+        if self._input_cache:
+            return self._get_cached_frame_count()
+        count = 0
+        for input_cls, path in self._scan(self._descriptor):
+            if input_cls is VideoInputData:
+                video = VideoInputData(path, **self._args)
+                count += video.get_frame_count()
+                video._stop_video(raise_exc=False)
+            else:
+                count += 1
+        return count
+
+    def _get_cached_frame_count(self):
+        count = 0
+        videos = []
+        with InputManifest(self._input_cache) as manifest:
+            for input_cls, path in self._scan(self._descriptor):
+                if input_cls is not VideoInputData:
+                    count += 1
+                    continue
+                videos.append(path)
+                entry = manifest.get(path)
+                if entry is None:
+                    video = VideoInputData(path, **self._args)
+                    cap = video._cap
+                    entry = (video._video_fps, cap.get(cv2.CAP_PROP_FRAME_COUNT),
+                             cap.get(cv2.CAP_PROP_FRAME_WIDTH), cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+                    video._stop_video(raise_exc=False)
+                    manifest.put(path, *entry)
+                video_fps, frame_count = entry[:2]
+                extract_fps = min(self._args['input_fps'] or video_fps, video_fps)
+                count += video_frame_count(frame_count, video_fps, extract_fps, self._args['skip_frame'])
+            manifest.prune(self._descriptor, videos)
+        return count
 
     def get_fps(self):
         return 1
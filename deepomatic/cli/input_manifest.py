@@ -0,0 +1,65 @@
+import os
+import sqlite3
+import logging
+
+
+LOGGER = logging.getLogger(__name__)
+COMMIT_INTERVAL = 1000  # number of updated entries between two commits
+
+
+class InputManifest(object):
+    """
+    On-disk cache of the properties of the video inputs, so that a directory doesn't need to open all its videos
+    again to count their frames. The entries are keyed by absolute path, and are only valid while the modification
+    time and the size of the file are the same. They are updated one at a time when a file changes.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS videos (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER,'
+                         ' fps REAL, frame_count INTEGER, width INTEGER, height INTEGER)')
+        self._nb_updates = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get(self, path):
+        """Returns (fps, frame_count, width, height) if the entry of the file is still valid, None otherwise."""
+        stat = os.stat(path)
+        row = self._db.execute('SELECT mtime_ns, size, fps, frame_count, width, height FROM videos WHERE path = ?',
+                               (os.path.abspath(path),)).fetchone()
+        if row is None or row[:2] != (stat.st_mtime_ns, stat.st_size):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[2:]
+
+    def put(self, path, fps, frame_count, width, height):
+        stat = os.stat(path)
+        self._db.execute('INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, fps, frame_count, width, height))
+        self._nb_updates += 1
+        if self._nb_updates % COMMIT_INTERVAL == 0:
+            self._db.commit()
+
+    def prune(self, directory, seen):
+        """Remove the entries of the files of the directory that were not seen, because they have been deleted."""
+        prefix = os.path.join(os.path.abspath(directory), '')
+        seen = set(os.path.abspath(path) for path in seen)
+        rows = self._db.execute('SELECT path FROM videos WHERE substr(path, 1, ?) = ?', (len(prefix), prefix))
+        deleted = [(path,) for path, in rows.fetchall() if path not in seen]
+        self._db.executemany('DELETE FROM videos WHERE path = ?', deleted)
+        return len(deleted)
+
+    def close(self):
+        if self._db is None:
+            return
+        self._db.commit()
+        self._db.close()
+        self._db = None
+        LOGGER.debug('Input manifest {}: {} hits, {} misses'.format(self.path, self.hits, self.misses))
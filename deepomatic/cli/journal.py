@@ -0,0 +1,103 @@
+import os
+import logging
+from . import serializer
+from .exceptions import DeepoResumeError
+from .output_data import JsonLinesOutputData, is_resumable
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_journal_path(descriptor):
+    """The journal is written next to the output, or in it for a directory output."""
+    if os.path.isdir(descriptor):
+        return os.path.join(descriptor, '.deepocli.journal')
+    name = os.path.basename(descriptor).replace('%', '')
+    return os.path.join(os.path.dirname(descriptor), '.{}.journal'.format(name))
+
+
+def read_json_lines(path):
+    """Yields the json lines of the file, the last one is ignored if it has been truncated by a crash."""
+    with open(path) as f:
+        for line in f:
+            try:
+                yield serializer.loads(line)
+            except ValueError:
+                LOGGER.debug('Ignoring invalid line in {}: {}'.format(path, line))
+
+
+class ResumeJournal(object):
+    """
+    Journal of the frames output by a job, so that it can be resumed after an interruption: the frames already
+    in the journal are skipped by the inputs. A frame is written to the journal once all the outputs wrote it.
+    Each line is the json list [filename, name] of a frame.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.completed = set()
+        self.nb_skipped = 0
+        self._file = None
+        if os.path.exists(path):
+            for filename, name in read_json_lines(path):
+                self.completed.add((filename, name))
+
+    def __len__(self):
+        return len(self.completed)
+
+    def load_json_lines(self, path):
+        """Add the frames of a json lines output written by a job started before the journal existed."""
+        for predictions in read_json_lines(path):
+            data = predictions.get('data') if isinstance(predictions, dict) else None
+            if isinstance(data, dict) and 'original_filename' in data and 'framename' in data:
+                # Also written to the journal, which is the only one read by the next resumes
+                self.completed.add((data['original_filename'], data['framename']))
+                self._write(data['original_filename'], data['framename'])
+
+    def skip(self, filename, name):
+        """Returns True if the frame has already been output by a previous run."""
+        if (filename, name) in self.completed:
+            self.nb_skipped += 1
+            return True
+        return False
+
+    def add(self, frame):
+        self._write(frame.filename, frame.name)
+
+    def _write(self, filename, name):
+        if self._file is None:
+            truncated = os.path.exists(self.path) and os.path.getsize(self.path) > 0 and not self._ends_with_newline()
+            # Line buffered: the journal is written after each frame
+            self._file = open(self.path, 'a', buffering=1)
+            if truncated:
+                self._file.write('\n')
+        self._file.write(serializer.dumps([filename, name]) + '\n')
+
+    def _ends_with_newline(self):
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.nb_skipped:
+            LOGGER.info('Resumed job: {} frames already output were skipped.'.format(self.nb_skipped))
+
+
+def get_resume_journal(descriptors):
+    """Returns the journal of the job writing to these outputs, they must all be written frame by frame."""
+    descriptors = descriptors or [None]
+    for descriptor in descriptors:
+        if not is_resumable(descriptor):
+            raise DeepoResumeError("Output '{}' can't be resumed, only .jsonl, .json with a %s wildcard and directory"
+                                   " outputs are written frame by frame.".format(descriptor))
+    path = get_journal_path(descriptors[0])
+    journal = ResumeJournal(path)
+    if not os.path.exists(path) and all(JsonLinesOutputData.is_valid(descriptor) for descriptor in descriptors):
+        # The job was started without the journal, the frames output are found in the json lines
+        for descriptor in descriptors:
+            if os.path.exists(descriptor):
+                journal.load_json_lines(descriptor)
+    LOGGER.info('Resuming job from {}: {} frames already output.'.format(path, len(journal)))
+    return journal
@@ -1,21 +1,28 @@
+import os
 import sys
 import cv2
+import time
 import logging
+import itertools
 import numpy as np
 import threading
 from text_unidecode import unidecode
 from tqdm import tqdm
 
-from deepomatic.cli.common import Queue, TqdmToLogger
+from deepomatic.cli.common import Queue, Empty, TqdmToLogger
+from deepomatic.cli.concurrency import ConcurrencyLimiter, DEFAULT_MIN_CONCURRENCY, DEFAULT_MAX_CONCURRENCY
 from deepomatic.cli.exceptions import (DeepoCLICredentialsError,
                                        SendInferenceError,
                                        ResultInferenceError,
                                        ResultInferenceTimeout)
 from deepomatic.cli.frame import CurrentFrames
 from deepomatic.cli.input_data import InputThread, VideoInputData, get_input
-from deepomatic.cli.output_data import OutputThread
-from deepomatic.cli.thread_base import QUEUE_MAX_SIZE, MainLoop, Pool, Thread, Greenlet
+from deepomatic.cli.journal import get_resume_journal
+from deepomatic.cli.metrics import PipelineMetrics, MetricsExporter, DEFAULT_STATS_INTERVAL
+from deepomatic.cli.output_data import OutputThread, DEFAULT_REORDER_POLICY
+from deepomatic.cli.thread_base import QUEUE_MAX_SIZE, WAIT_TIMEOUT, MainLoop, Pool, Thread, Greenlet, Sequencer
 from deepomatic.cli.workflow import get_workflow
+from deepomatic.cli.workflow.cached_workflow import CachedWorkflow, DEFAULT_PREDICTION_CACHE_SIZE
 
 
 LOGGER = logging.getLogger(__name__)
@@ -29,18 +36,28 @@ TEXT_COLOR = (255, 255, 255)            # Text color (BGR)
 TAG_TEXT_CORNER = (10, 10)              # Beginning of text tag column (pixel)
 TAG_TEXT_INTERSPACE = 5                 # Vertical space between tags in tag column (pixel)
 
+# Encoding parameters
+DEFAULT_JPEG_QUALITY = 95               # Same as opencv default
+DEFAULT_ENCODING_WORKERS = min(4, os.cpu_count() or 1)
+
+# Send parameters
+DEFAULT_BATCH_SIZE = 1                  # No batching by default
+DEFAULT_BATCH_MAX_WAIT = 0.05           # Time to wait for a batch to be full (seconds)
+
+# Result parameters
+DEFAULT_RESULT_WORKERS = 1
+
+# Postprocessing parameters
+DEFAULT_POSTPROCESSING_WORKERS = min(4, os.cpu_count() or 1)
+
 
 def substract_tuple(tuple1, tuple2):
     return tuple(x - y for x, y in zip(tuple1, tuple2))
 
 
-def get_coordinates_from_roi(roi, width, height):
-    bbox = roi['bbox']
-    xmin = int(bbox['xmin'] * width)
-    ymin = int(bbox['ymin'] * height)
-    xmax = int(bbox['xmax'] * width)
-    ymax = int(bbox['ymax'] * height)
-    return (xmin, ymin, xmax, ymax)
+def get_coordinates_from_bbox(bbox, width, height):
+    xmin, ymin, xmax, ymax = bbox
+    return (int(xmin * width), int(ymin * height), int(xmax * width), int(ymax * height))
 
 
 class DrawImagePostprocessing(object):
@@ -59,12 +76,12 @@ class DrawImagePostprocessing(object):
         height = output_image.shape[0]
         width = output_image.shape[1]
         tag_drawn = 0  # Used to store the number of tags already drawn
-        for pred in frame.predictions['outputs'][0]['labels']['predicted']:
-            score = pred['score']
+        for pred in frame.predictions.outputs[0].labels.predicted:
+            score = pred.score
             # Build legend
             label = u''
             if self._draw_labels:
-                label = pred['label_name']
+                label = pred.label_name
             if self._draw_labels and self._draw_scores:
                 label += ' '
             if self._draw_scores:
@@ -84,10 +101,9 @@ class DrawImagePostprocessing(object):
                 background_color = cv2.cvtColor(np.uint8([[hsv_color]]), cv2.COLOR_HSV2BGR).flatten()
                 background_color = background_color.astype('float64')
             # If we have a bounding box
-            roi = pred.get('roi')
-            if roi is not None:
+            if pred.bbox is not None:
                 # Retrieve coordinates
-                xmin, ymin, xmax, ymax = get_coordinates_from_roi(roi, width, height)
+                xmin, ymin, xmax, ymax = get_coordinates_from_bbox(pred.bbox, width, height)
 
                 # Draw bounding box
                 cv2.rectangle(output_image, (xmin, ymin), (xmax, ymax), BOX_COLOR, 1)
@@ -140,12 +156,11 @@ class BlurImagePostprocessing(object):
         height = output_image.shape[0]
         width = output_image.shape[1]
         skipped_pred = 0
-        for pred in frame.predictions['outputs'][0]['labels']['predicted']:
+        for pred in frame.predictions.outputs[0].labels.predicted:
             # Check that we have a bounding box
-            roi = pred.get('roi')
-            if roi is not None:
+            if pred.bbox is not None:
                 # Retrieve coordinates
-                xmin, ymin, xmax, ymax = get_coordinates_from_roi(roi, width, height)
+                xmin, ymin, xmax, ymax = get_coordinates_from_bbox(pred.bbox, width, height)
                 if (xmax > xmin) and (ymax > ymin):
                     # Draw
                     if self._method == 'black':
@@ -169,63 +184,182 @@ class BlurImagePostprocessing(object):
 
 
 class PrepareInferenceThread(Thread):
-    def process_msg(self, frame):
+    """
+    Encode frames into jpeg. Several of them can run in parallel as opencv releases the GIL,
+    the sequencer makes sure the frames are added to the current frames and forwarded in order.
+    """
+    def __init__(self, exit_event, input_queue, output_queue, current_messages, sequencer, **kwargs):
+        super(PrepareInferenceThread, self).__init__(exit_event, input_queue, output_queue, current_messages)
+        self.sequencer = sequencer
+        jpeg_quality = kwargs.get('jpeg_quality') or DEFAULT_JPEG_QUALITY
+        self.encode_params = [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality]
+        self.max_inference_size = kwargs.get('max_inference_size')
+        self.ticket = None
+
+    def pop_input(self):
+        frame, self.ticket = self.sequencer.pop(super(PrepareInferenceThread, self).pop_input)
+        return frame
+
+    def resize(self, image):
+        # Networks work on small inputs anyway, downscaling here saves encoding time and bandwidth
+        # The original image is kept for the outputs, predictions coordinates are relative so they are still valid
+        height, width = image.shape[:2]
+        scale = float(self.max_inference_size) / max(height, width)
+        if scale >= 1:
+            return image
+        size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+        return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+    def can_send_jpeg_as_is(self, frame):
+        if frame.jpeg_bytes is None:
+            return False
+        return not self.max_inference_size or max(frame.jpeg_size) <= self.max_inference_size
+
+    def encode(self, frame):
+        if self.can_send_jpeg_as_is(frame):
+            # No need to decode and encode again the original jpeg
+            frame.buf_bytes = frame.jpeg_bytes
+            return frame
         try:
-            _, buf = cv2.imencode('.jpg', frame.image)
+            image = frame.image
+            if self.max_inference_size:
+                image = self.resize(image)
+            _, buf = cv2.imencode('.jpg', image, self.encode_params)
         except Exception as e:
             LOGGER.error('Could not decode image for frame {}: {}'.format(frame, e))
             return None
-        buf_bytes = buf.tobytes()
-        frame.buf_bytes = buf_bytes
-        self.current_messages.add_frame(frame)
+        frame.buf_bytes = buf.tobytes()
         return frame
 
+    def process_msg(self, frame):
+        frame = self.encode(frame)
+
+        while not self.sequencer.wait_turn(self.ticket, timeout=WAIT_TIMEOUT):
+            if self.stop_asked:
+                return None
+        try:
+            if frame is None:
+                return None
+            # Admission control: wait for the frames in the pipeline to be under the reorder window limits
+            while not self.current_messages.wait_for_room(frame, timeout=WAIT_TIMEOUT):
+                if self.stop_asked:
+                    return None
+            self.current_messages.add_frame(frame)
+            # Forwarded during our turn to keep the order
+            super(PrepareInferenceThread, self).put_to_output(frame)
+        finally:
+            self.sequencer.end_turn()
+        return None
+
 
 class SendInferenceGreenlet(Greenlet):
-    def __init__(self, exit_event, input_queue, output_queue, current_messages, workflow):
+    """
+    Send frames for inference. The frames available within batch_max_wait seconds are grouped, up to batch_size,
+    and sent together by the workflow. The frames are then forwarded one by one with their own inference result.
+    The number of requests in flight is bounded by the limiter.
+    """
+    def __init__(self, exit_event, input_queue, output_queue, current_messages, workflow, limiter, **kwargs):
         super(SendInferenceGreenlet, self).__init__(exit_event, input_queue, output_queue, current_messages)
         self.workflow = workflow
+        self.limiter = limiter
         self.push_client = workflow.new_client()
+        self.batch_size = kwargs.get('batch_size') or DEFAULT_BATCH_SIZE
+        self.batch_max_wait = kwargs.get('batch_max_wait')
+        if self.batch_max_wait is None:
+            self.batch_max_wait = DEFAULT_BATCH_MAX_WAIT
 
     def close(self):
         self.workflow.close_client(self.push_client)
 
-    def process_msg(self, frame):
+    def pop_input(self):
+        batch = [super(SendInferenceGreenlet, self).pop_input()]
+        deadline = time.time() + self.batch_max_wait
+        while len(batch) < self.batch_size and not self.stop_asked:
+            try:
+                batch.append(self.input_queue.get(timeout=max(0, deadline - time.time())))
+            except Empty:
+                break
+        return batch
+
+    def process_msg(self, frames):
+        sent_at = None
+        while sent_at is None:
+            sent_at = self.limiter.acquire(len(frames), timeout=WAIT_TIMEOUT)
+            if sent_at is None and self.stop_asked:
+                for frame in frames:
+                    self.current_messages.forget_frame(frame)
+                return None
+
+        if len(frames) == 1:
+            # Most workflows don't implement infer_batch(), no need to go through it
+            results = [self.infer(frames[0])]
+        else:
+            results = self.workflow.infer_batch([frame.buf_bytes for frame in frames],
+                                                self.push_client,
+                                                [frame.name for frame in frames])
+        for frame, result in zip(frames, results):
+            if isinstance(result, SendInferenceError):
+                self.limiter.release(sent_at, congestion=True)
+                self.current_messages.forget_frame(frame)
+                LOGGER.error('Error sending frame {}: {}'.format(frame, result))
+                continue
+            frame.inference_async_result = result
+            frame.inference_sent_at = sent_at
+            self.metrics.inference_sent()
+            self.put_to_output(frame)
+        return None
+
+    def infer(self, frame):
         try:
-            frame.inference_async_result = self.workflow.infer(frame.buf_bytes, self.push_client, frame.name)
-            return frame
+            return self.workflow.infer(frame.buf_bytes, self.push_client, frame.name)
         except SendInferenceError as e:
-            self.current_messages.forget_frame(frame)
-            LOGGER.error('Error sending frame {}: {}'.format(frame, e))
-            return None
+            return e
+
+    def task_done(self, frames, msg_out):
+        # One task per frame of the batch
+        for _ in frames[1:]:
+            self.input_queue.task_done()
+        super(SendInferenceGreenlet, self).task_done(frames, msg_out)
 
 
 class ResultInferenceGreenlet(Greenlet):
-    def __init__(self, exit_event, input_queue, output_queue, current_messages, workflow, **kwargs):
+    def __init__(self, exit_event, input_queue, output_queue, current_messages, workflow, limiter, **kwargs):
         super(ResultInferenceGreenlet, self).__init__(exit_event, input_queue, output_queue, current_messages)
         self.workflow = workflow
+        self.limiter = limiter
         self.threshold = kwargs.get('threshold')
-
-    def fill_predictions(self, predictions, new_predicted, new_discarded):
-        for prediction in predictions:
-            if prediction['score'] >= self.threshold:
-                new_predicted.append(prediction)
-            else:
-                new_discarded.append(prediction)
+        self.label_thresholds = kwargs.get('label_thresholds')
+
+    def split_predictions(self, labels):
+        # Compare all the scores at once, for models that return up to thousands of predictions
+        if not self.label_thresholds:
+            labels.is_predicted = labels.scores >= self.threshold
+            return
+        if self.threshold is not None:
+            thresholds = np.full(len(labels), self.threshold)
+        else:
+            # Without global threshold, predictions of labels without threshold stay where they are
+            thresholds = np.where(labels.is_predicted, -np.inf, np.inf)
+        label_thresholds = np.fromiter(map(self.label_thresholds.get, labels.label_names(), itertools.repeat(np.nan)),
+                                       np.float64, len(labels))
+        thresholds = np.where(np.isnan(label_thresholds), thresholds, label_thresholds)
+        labels.is_predicted = labels.scores >= thresholds
 
     def process_msg(self, frame):
         try:
-            predictions = frame.inference_async_result.get_predictions(timeout=60)
-            if self.threshold is not None:
+            # Timeouts and errors tell the backend is overloaded
+            congestion = True
+            try:
+                predictions = frame.inference_async_result.get_predictions(timeout=60)
+                congestion = False
+            finally:
+                self.metrics.inference_done()
+                self.limiter.release(frame.inference_sent_at, congestion)
+                self.metrics.set_gauge('inference_concurrency_limit', int(self.limiter.limit))
+            if self.threshold is not None or self.label_thresholds:
                 # Keep only predictions higher than threshold
-                for output in predictions['outputs']:
-                    new_predicted = []
-                    new_discarded = []
-                    labels = output['labels']
-                    self.fill_predictions(labels['predicted'], new_predicted, new_discarded)
-                    self.fill_predictions(labels['discarded'], new_predicted, new_discarded)
-                    labels['predicted'] = new_predicted
-                    labels['discarded'] = new_discarded
+                for output in predictions.outputs:
+                    self.split_predictions(output.labels)
 
             frame.predictions = predictions
             return frame
@@ -238,9 +372,28 @@ class ResultInferenceGreenlet(Greenlet):
         return None
 
 
+class PostprocessingThread(Thread):
+    """
+    Draw or blur the predictions on the frames before they are reordered. Several of them can run in parallel
+    as opencv releases the GIL, the output thread is left with writing the frames in order.
+    """
+    def __init__(self, exit_event, input_queue, output_queue, current_messages, postprocessing, **kwargs):
+        super(PostprocessingThread, self).__init__(exit_event, input_queue, output_queue, current_messages)
+        self.postprocessing = postprocessing
+
+    def process_msg(self, frame):
+        if frame.image is None:
+            # The image is decoded lazily, it might be corrupted even if the inference succeeded
+            LOGGER.error('Could not decode image for frame {}'.format(frame))
+            self.current_messages.forget_frame(frame)
+            return None
+        self.postprocessing(frame)
+        return frame
+
+
 class InferManager(object):
 
-    def input_loop(self, kwargs, postprocessing=None):
+    def input_loop(self, kwargs, postprocessing=None, workflow=None):
         # Adds smartness to fps handling
         #   1) If both input_fps and output_fps are set, then use them as is.
         #   2) If only one of the two is used, make both equal
@@ -264,18 +417,32 @@ class InferManager(object):
             LOGGER.info('Input fps of {} automatically detected, but no output fps specified.'
                         ' Using same value for both.'.format(kwargs['input_fps']))
 
+        # The frames output by an interrupted job are skipped
+        journal = None
+        if kwargs.get('resume'):
+            journal = get_resume_journal(kwargs.get('outputs'))
+            inputs.journal = journal
+
         # Initialize progress bar
         frame_count = inputs.get_frame_count()
+        if journal is not None and frame_count >= 0:
+            frame_count = max(frame_count - len(journal), 0)
         max_value = int(frame_count) if frame_count >= 0 else None
         tqdmout = TqdmToLogger(LOGGER, level=LOGGER.getEffectiveLevel())
         pbar = tqdm(total=max_value, file=tqdmout, desc='Input processing', smoothing=0)
 
         # Initialize workflow for mutual use between send inference pool and result inference pool
-        try:
-            workflow = get_workflow(kwargs)
-        except DeepoCLICredentialsError as e:
-            LOGGER.error(str(e))
-            sys.exit(1)
+        # A workflow can be given directly, for instance by the benchmarks
+        if workflow is None:
+            try:
+                workflow = get_workflow(kwargs)
+            except DeepoCLICredentialsError as e:
+                LOGGER.error(str(e))
+                sys.exit(1)
+        if workflow and kwargs.get('prediction_cache'):
+            # The images already sent to this recognition are not sent again
+            workflow = CachedWorkflow(workflow, kwargs['prediction_cache'],
+                                      max_size=kwargs.get('prediction_cache_size') or DEFAULT_PREDICTION_CACHE_SIZE)
 
         # IMPORTANT: maxsize is important, it allows to regulate the pipeline and
         # avoid to pushes too many requests to rabbitmq when we are already waiting for many results
@@ -283,33 +450,84 @@ class InferManager(object):
         nb_queue = 2  # input => prepare inference => output
         if workflow:
             nb_queue += 2  # prepare inference => send inference => result inference
+        postprocessing_workers = kwargs.get('postprocessing_workers')
+        if postprocessing_workers is None:
+            postprocessing_workers = DEFAULT_POSTPROCESSING_WORKERS
+        if postprocessing is not None and postprocessing_workers > 0:
+            nb_queue += 1  # ... => postprocessing => output
 
         queues = [Queue(maxsize=QUEUE_MAX_SIZE) for _ in range(nb_queue)]
 
+        # The number of inference requests in flight adapts to the load of the backend
+        limiter = ConcurrencyLimiter(min_concurrency=kwargs.get('min_concurrency') or DEFAULT_MIN_CONCURRENCY,
+                                     max_concurrency=kwargs.get('max_concurrency') or DEFAULT_MAX_CONCURRENCY,
+                                     target_latency=kwargs.get('target_latency'))
+        if workflow:
+            # The frames in flight wait in the queue between send inference and result inference
+            queues[2] = Queue(maxsize=max(QUEUE_MAX_SIZE, limiter.max_concurrency))
+
         exit_event = threading.Event()
 
-        current_frames = CurrentFrames()
+        # With the block policy, the reorder window is bounded by limiting the number of frames in the pipeline
+        # Otherwise the output thread handles the limits itself
+        if (kwargs.get('reorder_policy') or DEFAULT_REORDER_POLICY) == 'block':
+            window_memory = kwargs.get('reorder_window_memory')
+            current_frames = CurrentFrames(max_frames=kwargs.get('reorder_window_frames'),
+                                           max_bytes=None if window_memory is None else int(window_memory * 1024 * 1024))
+        else:
+            current_frames = CurrentFrames()
 
         pools = [
-            Pool(1, InputThread, thread_args=(exit_event, None, queues[0], inputs)),
+            Pool(1, InputThread, thread_args=(exit_event, None, queues[0], inputs), name='input'),
             # Encode image into jpeg
-            Pool(1, PrepareInferenceThread, thread_args=(exit_event, queues[0], queues[1], current_frames)),
+            Pool(kwargs.get('encoding_workers') or DEFAULT_ENCODING_WORKERS, PrepareInferenceThread,
+                 thread_args=(exit_event, queues[0], queues[1], current_frames, Sequencer()), thread_kwargs=kwargs,
+                 name='encode'),
         ]
 
         if workflow:
             pools.extend([
                 # Send inference
-                Pool(5, SendInferenceGreenlet, thread_args=(exit_event, queues[1], queues[2], current_frames, workflow)),
+                Pool(5, SendInferenceGreenlet,
+                     thread_args=(exit_event, queues[1], queues[2], current_frames, workflow, limiter),
+                     thread_kwargs=kwargs, name='send'),
                 # Gather inference predictions from the worker(s)
-                Pool(1, ResultInferenceGreenlet, thread_args=(exit_event, queues[2], queues[3], current_frames, workflow),
-                     thread_kwargs=kwargs),
+                Pool(kwargs.get('result_workers') or DEFAULT_RESULT_WORKERS, ResultInferenceGreenlet,
+                     thread_args=(exit_event, queues[2], queues[3], current_frames, workflow, limiter),
+                     thread_kwargs=kwargs, name='result'),
             ])
 
-        # Output predictions
-        pools.append(Pool(1, OutputThread, thread_args=(exit_event, queues[-1], None, current_frames, pbar.update, postprocessing),
-                          thread_kwargs=kwargs))
+        if postprocessing is not None and postprocessing_workers > 0:
+            # Draw or blur the frames in parallel, only their writing is kept in order by the output thread
+            pools.append(Pool(postprocessing_workers, PostprocessingThread,
+                              thread_args=(exit_event, queues[-2], queues[-1], current_frames, postprocessing),
+                              thread_kwargs=kwargs, name='postprocess'))
+            postprocessing = None
 
-        loop = MainLoop(pools, queues, pbar, exit_event, current_frames, lambda: workflow.close() if workflow else None)
+        # Output predictions
+        pools.append(Pool(1, OutputThread, thread_args=(exit_event, queues[-1], None, current_frames, pbar.update,
+                                                        postprocessing, journal),
+                          thread_kwargs=kwargs, name='output'))
+
+        # Queue i links pool i to pool i + 1
+        metrics = PipelineMetrics(queues=[('{}->{}'.format(pools[i].name, pools[i + 1].name), queue)
+                                          for i, queue in enumerate(queues)],
+                                  current_messages=current_frames)
+        exporter = MetricsExporter(metrics,
+                                   port=kwargs.get('metrics_port'),
+                                   host=kwargs.get('metrics_host') or 'localhost',
+                                   stats_file=kwargs.get('stats_file'),
+                                   stats_interval=kwargs.get('stats_interval') or DEFAULT_STATS_INTERVAL)
+
+        def cleanup():
+            exporter.stop()
+            if workflow:
+                workflow.close()
+            if journal is not None:
+                journal.close()
+
+        loop = MainLoop(pools, queues, pbar, exit_event, current_frames, cleanup, metrics)
+        exporter.start()
 
         try:
             stop_asked = loop.run_forever()
@@ -0,0 +1,244 @@
+import json
+import time
+import bisect
+import logging
+import traceback
+import collections
+from threading import Lock
+import gevent
+from gevent.pywsgi import WSGIServer
+
+
+LOGGER = logging.getLogger(__name__)
+# Buckets in seconds, from the time to encode a small image to the inference timeout
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DEFAULT_STATS_INTERVAL = 10
+METRICS_PREFIX = 'deepocli'
+
+
+class Histogram(object):
+    """
+    Prometheus like histogram: counts the observations falling in each bucket.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last one for +Inf
+        self.sum = 0.
+        self.count = 0
+        self.lock = Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def cumulative_counts(self):
+        cumulative = []
+        total = 0
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+        return cumulative
+
+    def quantile(self, q):
+        """Estimates the quantile q (between 0 and 1), interpolating linearly inside buckets."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        lower_bound = 0.
+        previous = 0
+        for upper_bound, cumulative in zip(self.buckets, self.cumulative_counts()):
+            if cumulative >= rank:
+                in_bucket = cumulative - previous
+                return lower_bound + (upper_bound - lower_bound) * (rank - previous) / in_bucket
+            lower_bound = upper_bound
+            previous = cumulative
+        # In the +Inf bucket, the best we can say is that it's above the last bucket
+        return self.buckets[-1]
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+        }
+
+
+class PipelineMetrics(object):
+    """
+    Live instrumentation of the pipeline:
+    - depth of each queue
+    - time each message spends being processed in each pool (encode/send/result/output for the inference)
+    - number of inferences sent whose result has not been received yet
+    - number of messages added, in error and successful, taken from the current messages
+    - gauges set by the pools, like the size of the reorder window
+    """
+    def __init__(self, queues=None, current_messages=None):
+        self.queues = collections.OrderedDict(queues or {})
+        self.current_messages = current_messages
+        self.pools = collections.OrderedDict()
+        self.inferences_in_flight = 0
+        self.gauges = collections.OrderedDict()
+        self.lock = Lock()
+        self.start_time = time.time()
+        self._last_snapshot = (self.start_time, 0)
+
+    def pool_histogram(self, pool_name):
+        histogram = self.pools.get(pool_name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.pools.setdefault(pool_name, Histogram())
+        return histogram
+
+    def observe_processing(self, pool_name, duration):
+        self.pool_histogram(pool_name).observe(duration)
+
+    def inference_sent(self):
+        with self.lock:
+            self.inferences_in_flight += 1
+
+    def inference_done(self):
+        with self.lock:
+            self.inferences_in_flight -= 1
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def counters(self):
+        current_messages = self.current_messages
+        if current_messages is None:
+            return {}
+        return {
+            'added': current_messages.nb_added_messages,
+            'error': current_messages.nb_errors,
+            'successful': current_messages.nb_successes,
+        }
+
+    def snapshot(self):
+        """Returns the metrics as a dict, the throughput is computed since the previous snapshot."""
+        now = time.time()
+        counters = self.counters()
+        successes = counters.get('successful', 0)
+        last_time, last_successes = self._last_snapshot
+        self._last_snapshot = (now, successes)
+        return {
+            'timestamp': now,
+            'uptime': now - self.start_time,
+            'throughput': (successes - last_successes) / (now - last_time) if now > last_time else 0.,
+            'messages': counters,
+            'inferences_in_flight': self.inferences_in_flight,
+            'gauges': collections.OrderedDict(self.gauges),
+            'queues': collections.OrderedDict((name, queue.qsize()) for name, queue in self.queues.items()),
+            'pools': collections.OrderedDict((name, histogram.to_dict()) for name, histogram in self.pools.items()),
+        }
+
+    def to_prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        lines = [
+            '# HELP {}_queue_depth Number of messages waiting in the queue.'.format(METRICS_PREFIX),
+            '# TYPE {}_queue_depth gauge'.format(METRICS_PREFIX),
+        ]
+        for name, queue in self.queues.items():
+            lines.append('{}_queue_depth{{queue="{}"}} {}'.format(METRICS_PREFIX, name, queue.qsize()))
+
+        lines.extend([
+            '# HELP {}_inferences_in_flight Number of inferences sent and waiting for their result.'.format(METRICS_PREFIX),
+            '# TYPE {}_inferences_in_flight gauge'.format(METRICS_PREFIX),
+            '{}_inferences_in_flight {}'.format(METRICS_PREFIX, self.inferences_in_flight),
+            '# HELP {}_messages_total Number of messages by status.'.format(METRICS_PREFIX),
+            '# TYPE {}_messages_total counter'.format(METRICS_PREFIX),
+        ])
+        for status, value in self.counters().items():
+            lines.append('{}_messages_total{{status="{}"}} {}'.format(METRICS_PREFIX, status, value))
+
+        for name, value in list(self.gauges.items()):
+            lines.extend([
+                '# TYPE {}_{} gauge'.format(METRICS_PREFIX, name),
+                '{}_{} {}'.format(METRICS_PREFIX, name, value),
+            ])
+
+        lines.extend([
+            '# HELP {}_pool_processing_seconds Time spent processing a message in a pool.'.format(METRICS_PREFIX),
+            '# TYPE {}_pool_processing_seconds histogram'.format(METRICS_PREFIX),
+        ])
+        for name, histogram in self.pools.items():
+            bounds = [str(bound) for bound in histogram.buckets] + ['+Inf']
+            for bound, cumulative in zip(bounds, histogram.cumulative_counts()):
+                lines.append('{}_pool_processing_seconds_bucket{{pool="{}",le="{}"}} {}'.format(
+                    METRICS_PREFIX, name, bound, cumulative))
+            lines.append('{}_pool_processing_seconds_sum{{pool="{}"}} {}'.format(METRICS_PREFIX, name, histogram.sum))
+            lines.append('{}_pool_processing_seconds_count{{pool="{}"}} {}'.format(METRICS_PREFIX, name, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        return ' '.join('{}={:.2f}ms'.format(name, 1000 * histogram.sum / histogram.count)
+                        for name, histogram in self.pools.items() if histogram.count)
+
+
+class MetricsExporter(object):
+    """
+    Exposes the pipeline metrics through a local HTTP endpoint and/or a periodic JSONL stats file:
+    - GET /metrics returns the Prometheus text format
+    - GET /metrics.json returns a json snapshot
+    """
+    def __init__(self, metrics, port=None, host='localhost', stats_file=None, stats_interval=DEFAULT_STATS_INTERVAL):
+        self.metrics = metrics
+        self.port = port
+        self.host = host
+        self.stats_file = stats_file
+        self.stats_interval = stats_interval
+        self.server = None
+        self.stats_greenlet = None
+
+    def is_enabled(self):
+        return self.port is not None or self.stats_file is not None
+
+    def wsgi_app(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path == '/metrics':
+            body, content_type = self.metrics.to_prometheus(), 'text/plain; version=0.0.4'
+        elif path == '/metrics.json':
+            body, content_type = json.dumps(self.metrics.snapshot()), 'application/json'
+        else:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not Found\n']
+        start_response('200 OK', [('Content-Type', content_type)])
+        return [body.encode('utf-8')]
+
+    def write_stats(self):
+        with open(self.stats_file, 'a') as f:
+            f.write(json.dumps(self.metrics.snapshot()) + '\n')
+
+    def _stats_loop(self):
+        while True:
+            gevent.sleep(self.stats_interval)
+            try:
+                self.write_stats()
+            except Exception:
+                LOGGER.error("Could not write stats to {}: {}".format(self.stats_file, traceback.format_exc()))
+
+    def start(self):
+        if self.port is not None:
+            self.server = WSGIServer((self.host, self.port), self.wsgi_app, log=None)
+            self.server.start()
+            LOGGER.info('Serving pipeline metrics on http://{}:{}/metrics'.format(self.host, self.server.server_port))
+        if self.stats_file is not None:
+            self.stats_greenlet = gevent.spawn(self._stats_loop)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+        if self.stats_greenlet is not None:
+            self.stats_greenlet.kill()
+            self.stats_greenlet = None
+            # Last stats, covering the end of the run
+            try:
+                self.write_stats()
+            except Exception:
+                LOGGER.error("Could not write stats to {}: {}".format(self.stats_file, traceback.format_exc()))
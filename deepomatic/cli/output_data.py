@@ -2,12 +2,16 @@
 
 import os
 import sys
-import json
+import queue
+import threading
+import time
 import cv2
 import logging
 import traceback
+from . import serializer
 from .thread_base import Thread
-from .common import (Empty, write_frame_to_disk, SUPPORTED_IMAGE_OUTPUT_FORMAT,
+from .frame import frame_size
+from .common import (write_frame_to_disk, SUPPORTED_IMAGE_OUTPUT_FORMAT,
                      SUPPORTED_VIDEO_OUTPUT_FORMAT, SUPPORTED_FOURCC, BGR_TO_COLOR_SPACE)
 from .cmds.studio_helpers.vulcan2studio import transform_json_from_vulcan_to_studio
 from .exceptions import DeepoUnknownOutputError, DeepoSaveJsonToFileError
@@ -15,6 +19,14 @@ from .exceptions import DeepoUnknownOutputError, DeepoSaveJsonToFileError
 
 LOGGER = logging.getLogger(__name__)
 DEFAULT_OUTPUT_FPS = 25
+REORDER_POLICIES = ['block', 'unordered', 'drop']
+DEFAULT_REORDER_POLICY = 'block'
+DEFAULT_REORDER_WINDOW_MEMORY = 2048  # MB
+DEFAULT_OUTPUT_QUEUE_SIZE = 16  # frames waiting to be written by each output
+JSONL_FSYNC_POLICIES = ['never', 'flush', 'close']
+DEFAULT_JSONL_FSYNC = 'close'
+DEFAULT_JSONL_FLUSH_INTERVAL = 1  # seconds
+DEFAULT_JSONL_FLUSH_BYTES = 1024 * 1024
 
 
 try:
@@ -28,7 +40,7 @@ def save_json_to_file(json_data, json_path, write_mode='w'):
     try:
         with open(json_path, write_mode) as f:
             LOGGER.debug('Writing %s' % json_path)
-            json.dump(json_data, f)
+            serializer.dump(json_data, f)
             if write_mode == 'a':
                 f.write('\n')
             LOGGER.debug('Writing %s done' % json_path)
@@ -36,6 +48,94 @@ def save_json_to_file(json_data, json_path, write_mode='w'):
         raise DeepoSaveJsonToFileError("Could not save file {} in json format: {}".format(json_path, traceback.format_exc()))
 
 
+class StreamingJsonWriter(object):
+    """
+    Writes a json list item by item as the frames are output, instead of keeping all of them in memory.
+    The file starts with prefix, and the document is completed by close() with suffix.
+    """
+    def __init__(self, path, prefix='['):
+        self._path = path
+        self._prefix = prefix
+        self._file = None
+        self._nb_items = 0
+
+    def _open(self):
+        LOGGER.debug('Writing %s' % self._path)
+        self._file = open(self._path, 'w')
+        self._file.write(self._prefix)
+
+    def write(self, item):
+        try:
+            if self._file is None:
+                self._open()
+            if self._nb_items:
+                self._file.write(', ')
+            serializer.dump(item, self._file)
+            self._nb_items += 1
+        except Exception:
+            raise DeepoSaveJsonToFileError("Could not save file {} in json format: {}".format(self._path, traceback.format_exc()))
+
+    def close(self, suffix=']'):
+        try:
+            if self._file is None:
+                self._open()
+            self._file.write(suffix)
+            self._file.close()
+            LOGGER.debug('Writing %s done' % self._path)
+        except Exception:
+            raise DeepoSaveJsonToFileError("Could not save file {} in json format: {}".format(self._path, traceback.format_exc()))
+
+
+class JsonLinesWriter(object):
+    """
+    Keeps the json lines file open and buffers the lines. They are written once flush_bytes are pending or
+    flush_interval seconds after the last write, and at the end in close().
+    The fsync policy tells when the file is also synced to disk: 'never', at each 'flush' or at 'close'.
+    """
+    def __init__(self, path, flush_interval=DEFAULT_JSONL_FLUSH_INTERVAL, flush_bytes=DEFAULT_JSONL_FLUSH_BYTES,
+                 fsync=DEFAULT_JSONL_FSYNC):
+        self._path = path
+        self._flush_interval = flush_interval
+        self._flush_bytes = flush_bytes
+        self._fsync = fsync
+        self._file = None
+        self._lines = []
+        self._nb_bytes = 0
+        self._last_flush = time.time()
+
+    def write(self, item):
+        line = serializer.dumps(item) + '\n'
+        self._lines.append(line)
+        self._nb_bytes += len(line)
+        if self._nb_bytes >= self._flush_bytes or time.time() - self._last_flush >= self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        try:
+            if self._file is None:
+                LOGGER.debug('Writing %s' % self._path)
+                self._file = open(self._path, 'a')
+            self._file.write(''.join(self._lines))
+            self._file.flush()
+            if self._fsync == 'flush':
+                os.fsync(self._file.fileno())
+        except Exception:
+            raise DeepoSaveJsonToFileError("Could not save file {} in json format: {}".format(self._path, traceback.format_exc()))
+        self._lines = []
+        self._nb_bytes = 0
+        self._last_flush = time.time()
+
+    def close(self):
+        if self._lines:
+            self.flush()
+        if self._file is not None:
+            if self._fsync == 'close':
+                os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+            LOGGER.debug('Writing %s done' % self._path)
+
+
 def get_output(descriptor, kwargs):
     if descriptor is not None:
         if ImageOutputData.is_valid(descriptor):
@@ -62,6 +162,17 @@ def get_outputs(descriptors, kwargs):
     return [get_output(descriptor, kwargs) for descriptor in descriptors]
 
 
+def is_resumable(descriptor):
+    """Whether the output is written frame by frame, with names that don't depend on the frame order."""
+    if descriptor is None:
+        return False
+    if JsonLinesOutputData.is_valid(descriptor) or DirectoryOutputData.is_valid(descriptor):
+        return True
+    if JsonOutputData.is_valid(descriptor):
+        return JsonOutputData.get_wildcard_type(descriptor) == WildCardType.STRING
+    return False
+
+
 class NotProcessedYet(object):
     # OutputThread can receive frames in wrong order
     # When a frame arrives and is not the one we want to process,
@@ -71,14 +182,22 @@ class NotProcessedYet(object):
     pass
 
 
+class Dropped(object):
+    # Returned when a frame must be ignored: it arrived after we stopped waiting for it (drop reorder policy)
+    # or its image could not be decoded
+    pass
+
+
 class OutputThread(Thread):
     NOT_PROCESSED_YET = NotProcessedYet()
+    DROPPED = Dropped()
 
     def __init__(self, exit_event, input_queue, output_queue, current_messages,
-                 on_progress, postprocessing, **kwargs):
+                 on_progress, postprocessing, journal=None, **kwargs):
         super(OutputThread, self).__init__(exit_event, input_queue,
                                            output_queue, current_messages)
         self.args = kwargs
+        self.journal = journal  # the frames output are written to the journal to resume the job
         # Opencv images are BGR by default, no need to convert
         output_color_space_str = kwargs.get('output_color_space')
         if output_color_space_str is None or output_color_space_str == 'BGR':
@@ -88,8 +207,18 @@ class OutputThread(Thread):
 
         self.on_progress = on_progress
         self.postprocessing = postprocessing
+        # Frames arrived before the one we are waiting for: the reorder window
         self.frames_to_check_first = {}
-        self.frame_to_output = None
+        self.window_bytes = 0
+        self.peak_window_frames = 0
+        self.peak_window_bytes = 0
+        self.nb_dropped = 0
+        self.nb_unordered = 0
+        # With the block policy, the window is bounded upstream by CurrentFrames.wait_for_room()
+        self.reorder_policy = kwargs.get('reorder_policy') or DEFAULT_REORDER_POLICY
+        self.window_max_frames = kwargs.get('reorder_window_frames')
+        window_max_memory = kwargs.get('reorder_window_memory')
+        self.window_max_bytes = None if window_max_memory is None else int(window_max_memory * 1024 * 1024)
         # Update output fps to default value if none was specified.
         # Logs information only if one of the outputs uses fps.
         if not kwargs['output_fps']:
@@ -101,10 +230,19 @@ class OutputThread(Thread):
                     break
         else:
             self.outputs = get_outputs(self.args.get('outputs', None), self.args)
+        self.needs_image = any(output.needs_image for output in self.outputs)
+        # Each output writes the frames in its own thread, unless a resumed job needs them written before the journal
+        queue_size = kwargs.get('output_queue_size', DEFAULT_OUTPUT_QUEUE_SIZE)
+        if queue_size and not kwargs.get('resume'):
+            self.outputs = [AsyncOutputData(output, queue_size) if output.asynchronous else output
+                            for output in self.outputs]
 
     def close(self):
+        if self.peak_window_frames > 0:
+            LOGGER.info('Reorder window: peak of {} frames using {:.1f} MB, {} frames dropped, {} frames output out of order.'.format(
+                self.peak_window_frames, self.peak_window_bytes / (1024. * 1024.), self.nb_dropped, self.nb_unordered))
         self.frames_to_check_first = {}
-        self.frame_to_output = None
+        self.window_bytes = 0
         for output in self.outputs:
             output.close()
 
@@ -112,21 +250,23 @@ class OutputThread(Thread):
         return super(OutputThread, self).can_stop() and \
             len(self.frames_to_check_first) == 0
 
+    def wait_for_input(self, timeout):
+        # The next frame to output might already be waiting in the frames we popped earlier
+        next_frame = self.current_messages.get_oldest()
+        if next_frame is not None and next_frame in self.frames_to_check_first:
+            return True
+        return super(OutputThread, self).wait_for_input(timeout)
+
     def pop_input(self):
         # looking into frames we popped earlier
-        if self.frame_to_output is None:
-            self.frame_to_output = self.current_messages.pop_oldest()
-            if self.frame_to_output is None:
-                raise Empty()
-
-        frame = self.frames_to_check_first.pop(self.frame_to_output, None)
+        frame = self.window_pop(self.current_messages.get_oldest())
         if frame is None:
             frame = super(OutputThread, self).pop_input()
         return frame
 
     def put_to_output(self, frame_out):
-        if frame_out is self.NOT_PROCESSED_YET:
-            # Nothing to output, the frame has not been processed yet
+        if frame_out is self.NOT_PROCESSED_YET or frame_out is self.DROPPED:
+            # Nothing to output, the frame has not been processed yet or must be ignored
             return
         super(OutputThread, self).put_to_output(frame_out)
 
@@ -136,23 +276,101 @@ class OutputThread(Thread):
             return
 
         super(OutputThread, self).task_done(frame_in, frame_out)
-        self.frame_to_output = None
+        if frame_out is self.DROPPED:
+            # Already counted as an error
+            return
+        self.frame_done(frame_in, frame_out)
 
+    def frame_done(self, frame_in, frame_out):
+        # The frame has been output, we can stop tracking it
+        self.current_messages.forget_frame(frame_in, count_as_error=False)
         if self.output_queue is None:
             # process_msg() returns frame None when output_queue is None
             assert frame_out is None
             # Reporting success only if last pool of the pipeline
             self.current_messages.report_success()
 
+    def window_add(self, frame):
+        self.frames_to_check_first[frame.frame_number] = frame
+        self.window_bytes += frame_size(frame)
+        self.peak_window_frames = max(self.peak_window_frames, len(self.frames_to_check_first))
+        self.peak_window_bytes = max(self.peak_window_bytes, self.window_bytes)
+        self.report_window()
+
+    def window_pop(self, frame_number):
+        frame = self.frames_to_check_first.pop(frame_number, None)
+        if frame is not None:
+            self.window_bytes -= frame_size(frame)
+            self.report_window()
+        return frame
+
+    def report_window(self):
+        if self.metrics is not None:
+            self.metrics.set_gauge('reorder_window_frames', len(self.frames_to_check_first))
+            self.metrics.set_gauge('reorder_window_bytes', self.window_bytes)
+
+    def window_is_full(self):
+        if self.window_max_frames is not None and len(self.frames_to_check_first) > self.window_max_frames:
+            return True
+        if self.window_max_bytes is not None and self.window_bytes > self.window_max_bytes:
+            return True
+        return False
+
+    def shrink_window(self):
+        # Called when the window is over its limits, only for the unordered and drop policies
+        while self.window_is_full():
+            if self.reorder_policy == 'drop':
+                # Stop waiting for the oldest frame, frames behind it can be output
+                oldest = self.current_messages.get_oldest()
+                if oldest is None or oldest in self.frames_to_check_first:
+                    break
+                if self.current_messages.skip_message(oldest):
+                    self.nb_dropped += 1
+                    LOGGER.warning('Reorder window full, dropping frame {}.'.format(oldest))
+                # Let the main loop output the frames now ready
+                if self.current_messages.get_oldest() in self.frames_to_check_first:
+                    break
+            else:
+                # Output the oldest frame we have, out of order
+                frame = self.window_pop(min(self.frames_to_check_first))
+                self.nb_unordered += 1
+                frame_out = self.output_frame(frame)
+                if frame_out is self.DROPPED:
+                    super(OutputThread, self).task_done(frame, frame_out)
+                    continue
+                if frame_out is not None:
+                    super(OutputThread, self).put_to_output(frame_out)
+                super(OutputThread, self).task_done(frame, frame_out)
+                self.frame_done(frame, frame_out)
+
     def process_msg(self, frame):
-        if self.frame_to_output != frame.frame_number:
-            self.frames_to_check_first[frame.frame_number] = frame
+        if self.current_messages.was_skipped(frame):
+            # We stopped waiting for it, it's too late
+            return self.DROPPED
+
+        if self.current_messages.get_oldest() != frame.frame_number:
             # We keep it for later
+            self.window_add(frame)
+            if self.reorder_policy != 'block':
+                self.shrink_window()
             return self.NOT_PROCESSED_YET
 
-        if self.postprocessing is not None:
+        return self.output_frame(frame)
+
+    def output_frame(self, frame):
+        # The frame might already have been drawn or blurred by the postprocessing workers
+        postprocessed = frame.output_image is not None
+        if not postprocessed and (self.postprocessing is not None or self.needs_image) and frame.image is None:
+            # The image is decoded lazily, it might be corrupted even if the inference succeeded
+            LOGGER.error('Could not decode image for frame {}'.format(frame))
+            self.current_messages.forget_frame(frame)
+            return self.DROPPED
+
+        if postprocessed:
+            pass
+        elif self.postprocessing is not None:
             self.postprocessing(frame)
-        else:
+        elif self.needs_image:
             frame.output_image = frame.image  # we output the original image
 
         # Opencv images are BGR by default
@@ -162,6 +380,9 @@ class OutputThread(Thread):
         for output in self.outputs:
             output.output_frame(frame)
 
+        if self.journal is not None:
+            self.journal.add(frame)
+
         if self.on_progress:
             self.on_progress()
 
@@ -175,6 +396,11 @@ class OutputThread(Thread):
 
 
 class OutputData(object):
+    # Whether the output uses frame.output_image, if no output does the input images are not even decoded
+    needs_image = False
+    # Whether the frames can be written in another thread, see AsyncOutputData
+    asynchronous = True
+
     def __init__(self, descriptor, **kwargs):
         self._descriptor = descriptor
         self._args = kwargs
@@ -187,7 +413,56 @@ class OutputData(object):
         raise NotImplementedError()
 
 
+class AsyncOutputData(object):
+    """
+    Writes the frames of an output in a dedicated thread, so that the encoding and the writes of the different
+    outputs overlap with each other and with the output thread. The frames wait in a bounded queue and are written
+    in order. An error of the output is raised by the next call.
+    """
+    END = object()
+
+    def __init__(self, output, maxsize):
+        self.output = output
+        self.needs_image = output.needs_image
+        self._frames = queue.Queue(maxsize=maxsize)
+        self._error = None
+        self._failed = False
+        self._thread = threading.Thread(target=self._run, name='{}Writer'.format(type(output).__name__), daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            frame = self._frames.get()
+            if frame is self.END:
+                return
+            if self._failed:
+                # Already failed, the frames are discarded until the output is closed
+                continue
+            try:
+                self.output.output_frame(frame)
+            except Exception as e:
+                self._error = e
+                self._failed = True
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def output_frame(self, frame):
+        self._raise_error()
+        self._frames.put(frame)
+
+    def close(self):
+        self._frames.put(self.END)
+        self._thread.join()
+        self.output.close()
+        self._raise_error()
+
+
 class ImageOutputData(OutputData):
+    needs_image = True
+
     @classmethod
     def is_valid(cls, descriptor):
         _, ext = os.path.splitext(descriptor)
@@ -209,6 +484,8 @@ class ImageOutputData(OutputData):
 
 
 class VideoOutputData(OutputData):
+    needs_image = True
+
     @classmethod
     def is_valid(cls, descriptor):
         _, ext = os.path.splitext(descriptor)
@@ -253,17 +530,23 @@ class VideoOutputData(OutputData):
 
 
 class StdOutputData(OutputData):
+    needs_image = True
+    asynchronous = False  # other outputs might write to stdout too
+
     def __init__(self, **kwargs):
         super(StdOutputData, self).__init__(None, **kwargs)
 
     def output_frame(self, frame):
         if frame.output_image is None:
-            print(json.dumps(frame.predictions))
+            print(serializer.dumps(frame.predictions.to_dict() if frame.predictions is not None else None))
         else:
             write_bytes_to_stdout(frame.output_image.tobytes())
 
 
 class DisplayOutputData(OutputData):
+    needs_image = True
+    asynchronous = False  # the window must be handled by the thread that created it
+
     def __init__(self, **kwargs):
         super(DisplayOutputData, self).__init__(None, **kwargs)
         self._fps = kwargs['output_fps']
@@ -317,32 +600,49 @@ class JsonOutputData(OutputData):
         self._input_path = None
         self._write_mode = 'w'
 
-        # Check if the output is a string wildcard
-        try:
-            descriptor % 'string'
-            self._wildcard_type = WildCardType.STRING
-            self._all_predictions = None
+        self._wildcard_type = self.get_wildcard_type(descriptor)
+        # Without wildcard, the predictions are streamed to a single json, the file is only created by the first write
+        self._writer = None
+        self._tags = set()
+        if self._wildcard_type == WildCardType.STRING:
             if kwargs.get('recursive', False):
                 self._preserve_input_dir_structure = True
                 self._input_path = kwargs.get('input')
+        elif self._wildcard_type == WildCardType.NONE:
+            self._writer = StreamingJsonWriter(descriptor, '{"images": [' if self._to_studio_format else '[')
+
+    @staticmethod
+    def get_wildcard_type(descriptor):
+        # Check if the output is a string wildcard
+        try:
+            descriptor % 'string'
+            return WildCardType.STRING
         except TypeError:
-            # Check if the output is an integer wildcard
-            try:
-                descriptor % 0
-                self._wildcard_type = WildCardType.INTEGER
-                self._all_predictions = None
-            # Otherwise it's a pure json
-            except TypeError:
-                self._wildcard_type = WildCardType.NONE
-                if self._to_studio_format:
-                    self._all_predictions = {'tags': [], 'images': []}
-                else:
-                    self._all_predictions = []
+            pass
+        # Check if the output is an integer wildcard
+        try:
+            descriptor % 0
+            return WildCardType.INTEGER
+        # Otherwise it's a pure json
+        except TypeError:
+            return WildCardType.NONE
 
     def close(self):
-        if self._all_predictions is not None:
-            json_path = self._descriptor
-            save_json_to_file(self._all_predictions, json_path)
+        if self._writer is not None:
+            if self._to_studio_format:
+                self._writer.close('], "tags": {}}}'.format(serializer.dumps(sorted(self._tags))))
+            else:
+                self._writer.close()
+            self._writer = None
+
+    def _stream(self, predictions):
+        # If the json is not a wildcard we stream the predictions to it, the document is completed in close()
+        if self._to_studio_format:
+            for image in predictions['images']:
+                self._writer.write(image)
+            self._tags.update(predictions['tags'])
+        else:
+            self._writer.write(predictions)
 
     def output_frame(self, frame):
         self._i += 1
@@ -350,7 +650,7 @@ class JsonOutputData(OutputData):
             # For noop command
             LOGGER.warning('No predictions to output.')
             return
-        predictions = frame.predictions
+        predictions = frame.predictions.to_dict()
         predictions['location'] = frame.filename
         predictions['data'] = {
             'framename': frame.name,
@@ -359,15 +659,8 @@ class JsonOutputData(OutputData):
         if self._to_studio_format:
             predictions = transform_json_from_vulcan_to_studio(predictions)
 
-        if self._all_predictions is not None:
-            # If the json is not a wildcard we store prediction to write then to file a the end in close()
-            if self._to_studio_format:
-                self._all_predictions['images'] += predictions['images']
-                self._all_predictions['tags'] = list(
-                    set(self._all_predictions['tags'] + predictions['tags'])
-                )
-            else:
-                self._all_predictions.append(predictions)
+        if self._writer is not None:
+            self._stream(predictions)
         # Otherwise we write them to file directly
         else:
             # Build the prediction json path
@@ -408,12 +701,24 @@ class JsonLinesOutputData(JsonOutputData):
             LOGGER.warning('Wildcards are ignored when using the .jsonl output.')
             self._wildcard_type = WildCardType.NONE
 
-        # By setting all_predictions to None, the JsonOutputData implementation will process each frames individually,
-        self._all_predictions = None
-
-        self._write_mode = 'a'
+        # Each frame is a line, the lines are buffered by the writer
+        flush_bytes = kwargs.get('jsonl_flush_bytes')
+        if kwargs.get('resume'):
+            # The frames are written to the journal once output, they must not wait in the buffer
+            flush_bytes = 0
+        elif flush_bytes is None:
+            flush_bytes = DEFAULT_JSONL_FLUSH_BYTES
+        self._writer = JsonLinesWriter(descriptor,
+                                       flush_interval=kwargs.get('jsonl_flush_interval') or DEFAULT_JSONL_FLUSH_INTERVAL,
+                                       flush_bytes=flush_bytes,
+                                       fsync=kwargs.get('jsonl_fsync') or DEFAULT_JSONL_FSYNC)
+
+        if kwargs.get('resume'):
+            # Append to the predictions of the interrupted job
+            if os.path.exists(self._descriptor):
+                self._drop_truncated_line()
         # ask whether the file should be overwritten or not
-        if os.path.exists(self._descriptor):
+        elif os.path.exists(self._descriptor):
             should_overwrite = None  # TODO: cli flag (not kwargs.get('overwrite'))
             while should_overwrite is None:
                 overwrite = input("{} already exists. Overwrite? Y = yes, N = no\n".format(self._descriptor))
@@ -428,13 +733,26 @@ class JsonLinesOutputData(JsonOutputData):
             if should_overwrite:
                 open(self._descriptor, 'w').close()
 
+    def _drop_truncated_line(self):
+        # The last line might have been partially written if the job was killed
+        with open(self._descriptor, 'rb+') as f:
+            data = f.read()
+            if data and not data.endswith(b'\n'):
+                LOGGER.warning('Removing the truncated last line of {}.'.format(self._descriptor))
+                f.truncate(data.rfind(b'\n') + 1)
+
+    def _stream(self, predictions):
+        self._writer.write(predictions)
+
     def close(self):
-        # Nothing to do at the end
-        # In this implementation the file is opened / closed at each frame
-        pass
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
 
 
 class DirectoryOutputData(OutputData):
+    needs_image = True
+
     @classmethod
     def is_valid(cls, descriptor):
         return (os.path.exists(descriptor) and os.path.isdir(descriptor))
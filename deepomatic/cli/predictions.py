@@ -0,0 +1,161 @@
+"""
+Compact representation of the predictions of a frame.
+
+The predictions are kept in their source format, a dict or a protobuf message, and only their scores are read
+when they are received. Drawing and blurring read the label and the bounding box of the predicted labels only,
+and the Vulcan json is built only when the predictions are output.
+"""
+import operator
+import itertools
+import numpy as np
+try:
+    from google.protobuf.json_format import MessageToDict
+except ImportError:
+    MessageToDict = None  # Only needed by the rpc workflow, which checks protobuf is installed
+
+
+GET_SCORE_ITEM = operator.itemgetter('score')
+GET_SCORE_ATTRIBUTE = operator.attrgetter('score')
+
+
+def message_to_dict(message):
+    return MessageToDict(message, including_default_value_fields=True, preserving_proto_field_name=True)
+
+
+def source_to_dict(prediction):
+    if isinstance(prediction, dict):
+        return prediction
+    return message_to_dict(prediction)
+
+
+class Prediction(object):
+    __slots__ = ('label_id', 'label_name', 'score', 'bbox', '_source')
+
+    def __init__(self, label_id, label_name, score, bbox, source):
+        self.label_id = label_id
+        self.label_name = label_name
+        self.score = score
+        self.bbox = bbox  # (xmin, ymin, xmax, ymax) relative to the image size, None for a tag
+        self._source = source
+
+    @classmethod
+    def from_dict(cls, prediction):
+        bbox = None
+        roi = prediction.get('roi')
+        if roi is not None:
+            bbox = roi['bbox']
+            bbox = (bbox['xmin'], bbox['ymin'], bbox['xmax'], bbox['ymax'])
+        return cls(prediction.get('label_id'), prediction.get('label_name'), prediction['score'], bbox, prediction)
+
+    @classmethod
+    def from_message(cls, prediction):
+        bbox = None
+        if prediction.HasField('roi'):
+            bbox = prediction.roi.bbox
+            bbox = (bbox.xmin, bbox.ymin, bbox.xmax, bbox.ymax)
+        return cls(prediction.label_id, prediction.label_name, prediction.score, bbox, prediction)
+
+    def to_dict(self):
+        return source_to_dict(self._source)
+
+
+class Labels(object):
+    """
+    Predicted and discarded labels of an output. The predictions are kept in their source format with an array of
+    their scores, so that thresholding them only updates the is_predicted mask.
+    Prediction objects are only created when the predicted or discarded labels are read.
+    """
+    __slots__ = ('scores', 'is_predicted', '_predictions', '_from_source', '_source')
+
+    def __init__(self, predicted, discarded, source, from_source, get_score):
+        self._predictions = list(predicted) + list(discarded)
+        self.scores = np.fromiter(map(get_score, self._predictions), np.float64, len(self._predictions))
+        self.is_predicted = np.arange(len(self._predictions)) < len(predicted)
+        self._from_source = from_source
+        self._source = source
+
+    def __len__(self):
+        return len(self._predictions)
+
+    @classmethod
+    def from_dict(cls, labels):
+        return cls(labels.get('predicted', []), labels.get('discarded', []), labels,
+                   Prediction.from_dict, GET_SCORE_ITEM)
+
+    @classmethod
+    def from_message(cls, labels):
+        return cls(labels.predicted, labels.discarded, labels,
+                   Prediction.from_message, GET_SCORE_ATTRIBUTE)
+
+    def _select(self, mask):
+        return list(itertools.compress(self._predictions, mask.tolist()))
+
+    @property
+    def predicted(self):
+        return [self._from_source(prediction) for prediction in self._select(self.is_predicted)]
+
+    @property
+    def discarded(self):
+        return [self._from_source(prediction) for prediction in self._select(~self.is_predicted)]
+
+    def label_names(self):
+        if isinstance(self._source, dict):
+            return [prediction.get('label_name') for prediction in self._predictions]
+        return [prediction.label_name for prediction in self._predictions]
+
+    def to_dict(self):
+        if isinstance(self._source, dict):
+            labels = dict(self._source)
+        else:
+            # Predictions may have been moved by the threshold, only convert the other fields of the message
+            message = type(self._source)()
+            message.CopyFrom(self._source)
+            message.ClearField('predicted')
+            message.ClearField('discarded')
+            labels = message_to_dict(message)
+        labels['predicted'] = [source_to_dict(prediction) for prediction in self._select(self.is_predicted)]
+        labels['discarded'] = [source_to_dict(prediction) for prediction in self._select(~self.is_predicted)]
+        return labels
+
+
+class Output(object):
+    __slots__ = ('labels', '_source')
+
+    def __init__(self, labels, source=None):
+        self.labels = labels
+        self._source = source
+
+    @classmethod
+    def from_dict(cls, output):
+        return cls(Labels.from_dict(output['labels']), output)
+
+    @classmethod
+    def from_message(cls, output):
+        return cls(Labels.from_message(output.labels))
+
+    def to_dict(self):
+        output = dict(self._source or {})
+        output['labels'] = self.labels.to_dict()
+        return output
+
+
+class Predictions(object):
+    __slots__ = ('outputs', '_source')
+
+    def __init__(self, outputs, source=None):
+        self.outputs = outputs
+        self._source = source
+
+    @classmethod
+    def from_dict(cls, predictions):
+        return cls([Output.from_dict(output) for output in predictions['outputs']], predictions)
+
+    @classmethod
+    def from_messages(cls, outputs):
+        return cls([Output.from_message(output) for output in outputs])
+
+    def to_dict(self):
+        """Returns the Vulcan json of the predictions, as a new dict."""
+        predictions = dict(self._source or {})
+        predictions['outputs'] = [output.to_dict() for output in self.outputs]
+        return predictions
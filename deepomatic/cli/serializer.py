@@ -0,0 +1,97 @@
+"""
+Json serialization with the fastest library installed: orjson, rapidjson or ujson, otherwise the json standard module.
+Another backend can be forced with the DEEPOMATIC_CLI_JSON_BACKEND environment variable.
+The documents written are equivalent whatever the backend, only the spacing may differ.
+"""
+import os
+import json
+import logging
+import collections
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _orjson():
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode('utf-8')
+    return dumps, orjson.loads
+
+
+def _rapidjson():
+    import rapidjson
+    return rapidjson.dumps, rapidjson.loads
+
+
+def _ujson():
+    import ujson
+
+    def dumps(obj):
+        return ujson.dumps(obj, escape_forward_slashes=False)
+    return dumps, ujson.loads
+
+
+def _json():
+    return json.dumps, json.loads
+
+
+BACKENDS = collections.OrderedDict([
+    ('orjson', _orjson),
+    ('rapidjson', _rapidjson),
+    ('ujson', _ujson),
+    ('json', _json),
+])
+BACKEND = None
+_dumps, _loads = json.dumps, json.loads
+
+
+def installed_backends():
+    names = []
+    for name, loader in BACKENDS.items():
+        try:
+            loader()
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def use_backend(name=None):
+    """Use the given backend, or the first one installed. Returns the name of the backend used."""
+    global BACKEND, _dumps, _loads
+    names = list(BACKENDS)
+    if name is not None:
+        if name not in BACKENDS:
+            raise ValueError('Unknown json backend {}, expected one of {}'.format(name, ', '.join(BACKENDS)))
+        names.remove(name)
+        names.insert(0, name)
+    for backend in names:
+        try:
+            _dumps, _loads = BACKENDS[backend]()
+        except ImportError:
+            if backend == name:
+                LOGGER.warning('Json backend {} is not installed.'.format(name))
+            continue
+        BACKEND = backend
+        return backend
+
+
+def dumps(obj):
+    return _dumps(obj)
+
+
+def loads(data):
+    return _loads(data)
+
+
+def dump(obj, f):
+    f.write(_dumps(obj))
+
+
+def load(f):
+    return _loads(f.read())
+
+
+use_backend(os.getenv('DEEPOMATIC_CLI_JSON_BACKEND'))
@@ -1,19 +1,24 @@
+import time
 import logging
+import bisect
 import traceback
-import heapq
+import collections
 import gevent
 import signal
 from contextlib import contextmanager
 from gevent.threadpool import ThreadPool
-from threading import Lock
-from .common import clear_queue, Full, Empty
+from threading import Lock, Condition
+from .common import clear_queue, Empty
+from .metrics import PipelineMetrics
 from deepomatic.api.exceptions import BadStatus
 from .exceptions import DeepoCLIException
 
 
 LOGGER = logging.getLogger(__name__)
 QUEUE_MAX_SIZE = 50
-SLEEP_TIME = 0.0001  # don't touch until we have non performance regression tests
+# Threads are woken up as soon as something happens on their queues,
+# this timeout only bounds the time needed to notice a stop request
+WAIT_TIMEOUT = 1
 
 
 @contextmanager
@@ -26,83 +31,152 @@ def try_lock(lock):
             lock.release()
 
 
-@contextmanager
-def blocking_lock(lock, sleep_time=SLEEP_TIME):
-    while True:
-        # avoid lock totally the main thread and blocking greenlets
-        # it may take a little more time to lock if it is not lucky
-        # though you can decrease sleep_time to have more luck
-        gevent.sleep(sleep_time)
-        with try_lock(lock) as acquired:
-            if acquired:
-                yield
-                return
-
-
 class CurrentMessages(object):
     """
-    Track all messages currently being processed in the Pipeline.
+    Track all messages currently being processed in the Pipeline, in the order they were added.
     Also allow to track number of errors.
+
+    Messages are expected to be added in increasing order (they are frame numbers for the inference),
+    which makes add/forget O(1) and get_min/pop_min amortized O(1):
+    forgotten messages are only removed from the queue once they reach its head.
+    Counters can be read without taking the lock.
     """
     def __init__(self):
-        self.heap_lock = Lock()
-        self.messages = []
+        self._lock = Lock()
+        self._pending = collections.deque()  # messages in increasing order, possibly already forgotten
+        self._alive = set()  # messages currently processed
+        self._skipped = set()  # messages we stopped waiting for, see skip_message()
         self.nb_errors = 0
         self.nb_successes = 0
         self.nb_added_messages = 0
 
-    def lock(self):
-        return blocking_lock(self.heap_lock)
+    def __len__(self):
+        return len(self._alive)
+
+    def _released(self, msg):
+        # Called with the lock each time a message is not processed anymore
+        pass
+
+    def _drop_forgotten(self):
+        # Must be called with the lock
+        pending = self._pending
+        while pending and pending[0] not in self._alive:
+            pending.popleft()
 
     def add_message(self, msg):
-        with self.lock():
-            heapq.heappush(self.messages, msg)
+        with self._lock:
+            if self._pending and msg < self._pending[-1]:
+                # Should not happen in the pipeline, still keep the order
+                bisect.insort(self._pending, msg)
+            else:
+                self._pending.append(msg)
+            self._alive.add(msg)
             self.nb_added_messages += 1
 
     def get_min(self):
-        with self.lock():
-            if len(self.messages) > 0:
-                return heapq.nsmallest(1, self.messages)[0]
+        with self._lock:
+            self._drop_forgotten()
+            if self._pending:
+                return self._pending[0]
         return None
 
     def pop_min(self):
-        with self.lock():
-            if len(self.messages) > 0:
-                return heapq.heappop(self.messages)
+        with self._lock:
+            self._drop_forgotten()
+            if self._pending:
+                msg = self._pending.popleft()
+                self._alive.discard(msg)
+                self._released(msg)
+                return msg
         return None
 
     def report_success(self):
         self.report_successes(1)
 
     def report_successes(self, nb_successes):
-        with self.lock():
+        with self._lock:
             self.nb_successes += nb_successes
 
     def report_error(self):
         self.report_errors(1)
 
     def report_errors(self, nb_errors):
-        with self.lock():
+        with self._lock:
             self.nb_errors += nb_errors
 
     def report_message(self):
         self.report_messages(1)
 
     def report_messages(self, nb_messages):
-        with self.lock():
+        with self._lock:
             self.nb_added_messages += nb_messages
 
     def forget_message(self, msg, count_as_error=True):
-        try:
-            with self.lock():
-                if count_as_error:
-                    self.nb_errors += 1
-                self.messages.remove(msg)
-                heapq.heapify(self.messages)
-        except ValueError as e:
-            # TODO: remove the try/catch
-            # we should call it only if we are sure the message it there
-            LOGGER.error(str(e))
+        with self._lock:
+            if msg in self._skipped:
+                # Already counted when skipped
+                self._skipped.remove(msg)
+                return
+            if count_as_error:
+                self.nb_errors += 1
+            if msg not in self._alive:
+                # TODO: we should call it only if we are sure the message it there
+                LOGGER.error('Cannot forget message {}: it is not being processed'.format(msg))
+                return
+            self._alive.remove(msg)
+            self._released(msg)
+            # The message stays in the queue until it reaches its head
+            self._drop_forgotten()
+
+    def skip_message(self, msg):
+        """
+        Stop waiting for a message still being processed, it is counted as an error.
+        When it comes back, take_skipped() tells it must be ignored.
+        """
+        with self._lock:
+            if msg not in self._alive:
+                return False
+            self._alive.remove(msg)
+            self._skipped.add(msg)
+            self.nb_errors += 1
+            self._released(msg)
+            self._drop_forgotten()
+            return True
+
+    def take_skipped(self, msg):
+        with self._lock:
+            if msg in self._skipped:
+                self._skipped.remove(msg)
+                return True
+            return False
+
+
+class Sequencer(object):
+    """
+    Allow the threads of a pool to process messages in parallel while handing them over in the order they were popped:
+    a ticket is taken when popping a message, then each thread waits for its turn before handing its message over.
+    """
+    def __init__(self):
+        self._condition = Condition(Lock())
+        self._next_ticket = 0
+        self._turn = 0
+
+    def pop(self, pop_input):
+        # Popping and taking the ticket must be atomic to keep the order
+        with self._condition:
+            msg = pop_input()
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            return msg, ticket
+
+    def wait_turn(self, ticket, timeout=None):
+        with self._condition:
+            return self._condition.wait_for(lambda: self._turn == ticket, timeout)
+
+    def end_turn(self):
+        with self._condition:
+            self._turn += 1
+            self._condition.notify_all()
 
 
 class ThreadBase(object):
@@ -120,6 +194,10 @@ class ThreadBase(object):
         self.processing_item_lock = Lock()
         self.current_messages = current_messages
         self.alive = False
+        # Set by the Pool and the MainLoop
+        self.pool_name = self.name
+        self.metrics = None
+        self.processing_start = None
 
     def try_lock(self):
         return try_lock(self.processing_item_lock)
@@ -132,6 +210,9 @@ class ThreadBase(object):
     def stop(self):
         # Can be called from the same thread or from another
         self.stop_asked = True
+        # Wake up the thread if it is waiting for an input
+        if self.input_queue is not None:
+            self.input_queue.wake_up()
 
     def wait_until_nothing_to_process(self):
         # Must be called externally (from another thread)
@@ -146,41 +227,41 @@ class ThreadBase(object):
 
         # When ThreadBase has an input queue and previous pools are stopped
         # We can stop when the input queue is empty
-        long_sleep = 0.05
-        sleep_time = long_sleep
+        # The lock is only held while an item is processed, so we don't need to poll it often:
+        # when the queue is drained the thread waits for an input without holding it
+        sleep_time = 0.05
         while not self.exit_event.is_set():
-            # don't touch until we have non performance regression tests
             gevent.sleep(sleep_time)
-            # try to acquire only sometimes
             with self.try_lock() as acquired:
-                if acquired:
-                    sleep_time = long_sleep
-                    if self.can_stop():
-                        self.stop()
-                        return
-                else:
-                    sleep_time = SLEEP_TIME
+                if acquired and self.can_stop():
+                    self.stop()
+                    return
             if not self.alive:
                 return
 
     def process_msg(self, msg):
         raise NotImplementedError()
 
+    def wait_for_input(self, timeout):
+        # Block until an input is available, without holding the processing lock
+        # so that wait_until_nothing_to_process() can check if the thread can stop
+        if self.input_queue is None:
+            return True
+        return self.input_queue.wait_not_empty(timeout)
+
     def pop_input(self):
         return self.input_queue.get(block=False)
 
     def put_to_output(self, msg_out):
-        while True:
-            try:
-                self.output_queue.put(msg_out, block=False)
-                break
-            except Full:
-                # don't touch until we have non performance regression tests
-                gevent.sleep(SLEEP_TIME)
+        # Blocks until there is some room in the output queue
+        # MainLoop.stop() clears the queues on hard stop so that we can't stay stuck here
+        self.output_queue.put(msg_out)
 
     def task_done(self, msg_in, msg_out):
         if self.input_queue is not None:
             self.input_queue.task_done()
+        if self.metrics is not None:
+            self.metrics.observe_processing(self.pool_name, time.time() - self.processing_start)
 
     def init(self):
         pass
@@ -190,24 +271,26 @@ class ThreadBase(object):
 
     def _run(self):
         while not self.stop_asked:
-            empty = False
+            if not self.wait_for_input(WAIT_TIMEOUT):
+                continue
             with self.try_lock() as acquired:
-                if acquired:
-                    msg_in = None
-                    if self.input_queue is not None:
-                        try:
-                            msg_in = self.pop_input()
-                        except Empty:
-                            empty = True
-
-                    if self.input_queue is None or not empty:
-                        msg_out = self.process_msg(msg_in)
-                        if msg_out is not None:
-                            self.put_to_output(msg_out)
-                        self.task_done(msg_in, msg_out)
-            if empty:
-                # don't touch until we have non performance regression tests
-                gevent.sleep(SLEEP_TIME)
+                if not acquired:
+                    # wait_until_nothing_to_process() is checking the thread, let it finish
+                    gevent.sleep(0)
+                    continue
+                msg_in = None
+                if self.input_queue is not None:
+                    try:
+                        msg_in = self.pop_input()
+                    except Empty:
+                        # Another thread of the pool took the input first
+                        continue
+
+                self.processing_start = time.time()
+                msg_out = self.process_msg(msg_in)
+                if msg_out is not None:
+                    self.put_to_output(msg_out)
+                self.task_done(msg_in, msg_out)
 
     def run(self):
         self.alive = True
@@ -273,6 +356,7 @@ class Pool(object):
         for i in range(self.nb_thread):
             th = thread_cls(*thread_args, **thread_kwargs)
             th.name = '{}_{}'.format(self.name, i)
+            th.pool_name = self.name
             self.threads.append(th)
 
     def start(self):
@@ -295,13 +379,19 @@ class Pool(object):
 
 class MainLoop(object):
     def __init__(self, pools, queues, pbar, exit_event,
-                 current_messages, cleanup_func=None):
+                 current_messages, cleanup_func=None, metrics=None):
         self.pools = pools
         self.queues = queues
         self.pbar = pbar
         self.exit_event = exit_event
         self.current_messages = current_messages
         self.cleanup_func = cleanup_func
+        self.metrics = metrics or PipelineMetrics(current_messages=current_messages)
+        for pool in self.pools:
+            # Registers the pools in the pipeline order
+            self.metrics.pool_histogram(pool.name)
+            for th in pool.threads:
+                th.metrics = self.metrics
         self.stop_asked = 0
         self.cleaned = False
 
@@ -359,6 +449,7 @@ class MainLoop(object):
                                                                                        nb_uncompleted,
                                                                                        self.current_messages.nb_successes,
                                                                                        total_inputs))
+        LOGGER.debug('Mean processing time per pool: {}'.format(self.metrics.summary()))
         self.cleaned = True
 
     def run_forever(self):
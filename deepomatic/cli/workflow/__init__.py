@@ -23,7 +23,7 @@ def get_workflow(args):
     elif all([amqp_url, routing_key]):
         LOGGER.debug('Using RPC workflow with'
                      ' recognition_id {}, amqp_url {} and routing_key {}'.format(recognition_id, amqp_url, routing_key))
-        return RpcRecognition(recognition_id, amqp_url, routing_key)
+        return RpcRecognition(recognition_id, amqp_url, routing_key, nb_consumers=args.get('amqp_consumers') or 1)
     elif recognition_id:
         LOGGER.debug('Using Cloud workflow with recognition_id {}'.format(recognition_id))
         return CloudRecognition(recognition_id)
@@ -0,0 +1,164 @@
+import time
+import sqlite3
+import hashlib
+import logging
+from .workflow_abstraction import AbstractWorkflow
+from .. import serializer
+from ..predictions import Predictions
+from ..exceptions import SendInferenceError
+
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_PREDICTION_CACHE_SIZE = 1024  # MB
+COMMIT_INTERVAL = 100  # number of writes between two commits
+EVICTION_RATIO = 0.9  # when the cache is full, the least recently used entries are evicted down to this ratio
+
+
+class PredictionCache(object):
+    """
+    Predictions stored in sqlite, with a least recently used eviction once the predictions use more than max_bytes.
+    """
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._db = sqlite3.connect(path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, predictions TEXT,'
+                         ' size INTEGER, last_used REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)')
+        self.nb_bytes = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM predictions').fetchone()[0]
+        self._nb_writes = 0
+
+    def get(self, key):
+        row = self._db.execute('SELECT predictions FROM predictions WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        self._db.execute('UPDATE predictions SET last_used = ? WHERE key = ?', (time.time(), key))
+        self._written()
+        return serializer.loads(row[0])
+
+    def put(self, key, predictions):
+        data = serializer.dumps(predictions)
+        size = len(data)
+        row = self._db.execute('SELECT size FROM predictions WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            self.nb_bytes -= row[0]
+        self._db.execute('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)', (key, data, size, time.time()))
+        self.nb_bytes += size
+        if self.nb_bytes > self.max_bytes:
+            self._evict()
+        self._written()
+
+    def _evict(self):
+        target = self.max_bytes * EVICTION_RATIO
+        rows = self._db.execute('SELECT key, size FROM predictions ORDER BY last_used')
+        evicted = []
+        for key, size in rows:
+            if self.nb_bytes <= target:
+                break
+            evicted.append((key,))
+            self.nb_bytes -= size
+        self._db.executemany('DELETE FROM predictions WHERE key = ?', evicted)
+        LOGGER.debug('Prediction cache full, {} predictions evicted'.format(len(evicted)))
+
+    def _written(self):
+        self._nb_writes += 1
+        if self._nb_writes % COMMIT_INTERVAL == 0:
+            self._db.commit()
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+
+    def close(self):
+        if self._db is not None:
+            self._db.commit()
+            self._db.close()
+            self._db = None
+
+
+class CachedWorkflow(AbstractWorkflow):
+    """
+    Wraps a workflow to reuse the predictions of the images already sent to the same recognition.
+    The predictions are keyed by the sha256 of the encoded image and the display id of the workflow,
+    a hit doesn't send anything to the wrapped workflow.
+    """
+
+    class CachedResult(AbstractWorkflow.AbstractInferResult):
+        def __init__(self, predictions):
+            self._predictions = predictions
+
+        def get_predictions(self, timeout):
+            return Predictions.from_dict(self._predictions)
+
+    class StoringResult(AbstractWorkflow.AbstractInferResult):
+        def __init__(self, result, cache, key):
+            self._result = result
+            self._cache = cache
+            self._key = key
+
+        def get_predictions(self, timeout):
+            predictions = self._result.get_predictions(timeout)
+            # Stored before the predictions are thresholded
+            self._cache.put(self._key, predictions.to_dict())
+            return predictions
+
+        def __str__(self):
+            return str(self._result)
+
+    def __init__(self, workflow, path, max_size=DEFAULT_PREDICTION_CACHE_SIZE):
+        super(CachedWorkflow, self).__init__(workflow.display_id)
+        self._workflow = workflow
+        self._cache = PredictionCache(path, int(max_size * 1024 * 1024))
+        self.hits = 0
+        self.misses = 0
+
+    def new_client(self):
+        return self._workflow.new_client()
+
+    def close_client(self, client):
+        self._workflow.close_client(client)
+
+    def close(self):
+        nb_requests = self.hits + self.misses
+        if nb_requests:
+            LOGGER.info('Prediction cache: hits={} misses={} hit rate={:.1%}.'.format(
+                self.hits, self.misses, self.hits / float(nb_requests)))
+        self._cache.close()
+        self._workflow.close()
+
+    def _key(self, encoded_image_bytes):
+        key = hashlib.sha256(encoded_image_bytes)
+        key.update(self.display_id.encode('utf-8'))
+        return key.hexdigest()
+
+    def _lookup(self, encoded_image_bytes):
+        key = self._key(encoded_image_bytes)
+        predictions = self._cache.get(key)
+        if predictions is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return key, predictions
+
+    def infer(self, encoded_image_bytes, push_client, frame_name):
+        key, predictions = self._lookup(encoded_image_bytes)
+        if predictions is not None:
+            return self.CachedResult(predictions)
+        return self.StoringResult(self._workflow.infer(encoded_image_bytes, push_client, frame_name), self._cache, key)
+
+    def infer_batch(self, encoded_images, push_client, frame_names):
+        # Only the misses are sent, in a single batch
+        results = []
+        misses = []
+        for i, encoded_image_bytes in enumerate(encoded_images):
+            key, predictions = self._lookup(encoded_image_bytes)
+            results.append(None if predictions is None else self.CachedResult(predictions))
+            if predictions is None:
+                misses.append((i, key))
+        if misses:
+            sent = self._workflow.infer_batch([encoded_images[i] for i, _ in misses], push_client,
+                                              [frame_names[i] for i, _ in misses])
+            for (i, key), result in zip(misses, sent):
+                if not isinstance(result, SendInferenceError):
+                    result = self.StoringResult(result, self._cache, key)
+                results[i] = result
+        return results
@@ -1,5 +1,9 @@
 import logging
+import gevent
+import gevent.pool
+import gevent.event
 from .workflow_abstraction import AbstractWorkflow
+from ..predictions import Predictions
 from ..exceptions import (SendInferenceError,
                           ResultInferenceError,
                           ResultInferenceTimeout)
@@ -8,35 +12,104 @@ import deepomatic.api.client
 import deepomatic.api.inputs
 from ..version import __title__, __version__
 from tenacity import stop_never
-from deepomatic.api.exceptions import TaskError, TaskTimeout, BadStatus, DeepomaticException
+from deepomatic.api.exceptions import BadStatus, DeepomaticException
 
 LOGGER = logging.getLogger(__name__)
+HTTP_POOL_MAXSIZE = 20  # Connections kept alive by the client, also the maximum number of requests sent at the same time
+TASKS_POLL_INTERVAL = 0.1  # Time between two refreshes of the pending tasks (seconds)
+TASKS_PER_REQUEST = 100  # Number of tasks refreshed by a single request, it is also the page size of the task list
+
+
+class TaskPoller(object):
+    """
+    Refresh all the pending tasks with a few bulk requests instead of polling each task separately,
+    so that waiting for thousands of tasks costs about the same as waiting for one.
+    The polling greenlet only runs while some tasks are pending.
+    """
+    def __init__(self, client):
+        self._client = client
+        self._pending = {}  # task id => AsyncResult set with the task once it is done
+        self._greenlet = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def watch(self, task):
+        result = gevent.event.AsyncResult()
+        self._pending[task.pk] = result
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self._run)
+        return result
+
+    def forget(self, task):
+        self._pending.pop(task.pk, None)
+
+    def stop(self):
+        if self._greenlet is not None:
+            self._greenlet.kill()
+
+    def _run(self):
+        try:
+            while self._pending:
+                gevent.sleep(TASKS_POLL_INTERVAL)
+                self._refresh()
+        except Exception as e:
+            # Don't let the waiters wait until their timeout
+            LOGGER.error('Could not refresh the tasks status: {}'.format(e))
+            for result in self._pending.values():
+                result.set_exception(ResultInferenceError(str(e)))
+            self._pending.clear()
+        finally:
+            self._greenlet = None
+
+    def _refresh(self):
+        task_ids = list(self._pending)
+        for start in range(0, len(task_ids), TASKS_PER_REQUEST):
+            task_ids_chunk = task_ids[start:start + TASKS_PER_REQUEST]
+            try:
+                tasks = list(self._client.Task.list(task_ids=task_ids_chunk))
+            except BadStatus as e:
+                for task_id in task_ids_chunk:
+                    result = self._pending.pop(task_id, None)
+                    if result is not None:
+                        result.set_exception(e)
+                continue
+            for task in tasks:
+                if task['status'] == 'pending':
+                    continue
+                result = self._pending.pop(task.pk, None)
+                if result is not None:
+                    result.set(task)
 
 
 class CloudRecognition(AbstractWorkflow):
 
     class InferResult(AbstractWorkflow.AbstractInferResult):
-        def __init__(self, task):
+        def __init__(self, task, poller):
             self._task = task
+            self._poller = poller
+            self._result = poller.watch(task)
 
         def get_predictions(self, timeout):
             try:
-                self._task.wait(timeout=timeout)
-                return self._task['data']
+                task = self._result.get(timeout=timeout)
+            except gevent.Timeout:
+                # Task did not finish on time
+                self._poller.forget(self._task)
+                raise ResultInferenceTimeout(timeout)
             except BadStatus as e:
                 # HTTP Error
                 raise ResultInferenceError(e)
-            except TaskError:
+            if task['status'] == 'error':
                 # Task is in error
-                raise ResultInferenceError(self._task.data())
-            except TaskTimeout:
-                # Task did not finish on time
-                raise ResultInferenceTimeout(timeout)
+                raise ResultInferenceError(task.data())
+            return Predictions.from_dict(task['data'])
 
         def __str__(self):
             return '<{} task_id={}>'.format(self.__class__.__qualname__, self._task.pk)
 
     def close(self):
+        self._poller.stop()
         self._client.http_helper.session.close()
 
     def __init__(self, recognition_version_id):
@@ -49,7 +122,8 @@ class CloudRecognition(AbstractWorkflow):
         user_agent_prefix = '{}/{}'.format(__title__, __version__)
         try:
             self._client = deepomatic.api.client.Client(user_agent_prefix=user_agent_prefix,
-                                                        http_retry=http_retry)
+                                                        http_retry=http_retry,
+                                                        pool_maxsize=HTTP_POOL_MAXSIZE)
         except DeepomaticException:  # TODO later replace with CredentialsNotFound
             error = ('Credentials not found.'
                      ' Please define the DEEPOMATIC_API_KEY environment variable to use cloud-based recognition models.')
@@ -64,6 +138,10 @@ class CloudRecognition(AbstractWorkflow):
         if self._model is None:
             self._model = self._client.RecognitionVersion.retrieve(recognition_version_id)
 
+        # Requests of the batches go through this pool to not open more connections than the client keeps alive
+        self._requests_pool = gevent.pool.Pool(HTTP_POOL_MAXSIZE)
+        self._poller = TaskPoller(self._client)
+
     def infer(self, encoded_image_bytes, _useless_push_client, _useless_frame_name):
         # _useless_push_client and _useless_frame_name are used for the rpc and json workflows
         try:
@@ -71,7 +149,21 @@ class CloudRecognition(AbstractWorkflow):
                 inputs=[deepomatic.api.inputs.ImageInput(encoded_image_bytes, encoding="binary")],
                 show_discarded=True,
                 return_task=True,
-                wait_task=False))
+                wait_task=False), self._poller)
         except BadStatus as e:
             # HTTP error
             raise SendInferenceError(e)
+
+    def infer_batch(self, encoded_images, push_client, frame_names):
+        # The API takes several inputs for networks with multiple inputs, not a batch of images:
+        # the requests of the batch are sent concurrently instead
+        def infer(encoded_image_bytes, frame_name):
+            try:
+                return self.infer(encoded_image_bytes, push_client, frame_name)
+            except SendInferenceError as e:
+                return e
+
+        greenlets = [self._requests_pool.spawn(infer, encoded_image_bytes, frame_name)
+                     for encoded_image_bytes, frame_name in zip(encoded_images, frame_names)]
+        gevent.joinall(greenlets)
+        return [greenlet.get() for greenlet in greenlets]
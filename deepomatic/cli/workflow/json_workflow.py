@@ -1,6 +1,7 @@
-import json
 import logging
 from .workflow_abstraction import AbstractWorkflow
+from .. import serializer
+from ..predictions import Predictions
 from ..json_schema import validate_json, JSONSchemaType
 from ..cmds.studio_helpers.vulcan2studio import transform_json_from_studio_to_vulcan
 from ..exceptions import DeepoPredictionJsonError, DeepoOpenJsonError, SendInferenceError
@@ -17,7 +18,7 @@ class JsonRecognition(AbstractWorkflow):
             self.frame_pred = frame_pred
 
         def get_predictions(self, timeout):
-            return self.frame_pred
+            return Predictions.from_dict(self.frame_pred)
 
     def __init__(self, recognition_version_id, pred_file):
         super(JsonRecognition, self).__init__('r{}'.format(recognition_version_id))
@@ -27,7 +28,7 @@ class JsonRecognition(AbstractWorkflow):
         # Load the json
         try:
             with open(pred_file) as json_file:
-                vulcan_json_with_pred = json.load(json_file)
+                vulcan_json_with_pred = serializer.load(json_file)
         except Exception:
             raise DeepoOpenJsonError("Prediction JSON file {} is not a valid JSON file".format(pred_file))
 
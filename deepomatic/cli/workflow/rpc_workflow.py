@@ -1,4 +1,7 @@
+import itertools
+import gevent.lock
 from .workflow_abstraction import AbstractWorkflow
+from ..predictions import Predictions
 from ..exceptions import ResultInferenceError, ResultInferenceTimeout
 from ..exceptions import DeepoRPCRecognitionError, DeepoRPCUnavailableError
 
@@ -52,25 +55,20 @@ def requires_deepomatic_rpc(cls):
 class RpcRecognition(AbstractWorkflow):
     @requires_deepomatic_rpc
     class InferResult(AbstractWorkflow.AbstractInferResult):
-        def __init__(self, correlation_id, consumer):
+        def __init__(self, correlation_id, consumer, consumer_lock):
             self._correlation_id = correlation_id
             self._consumer = consumer
+            self._consumer_lock = consumer_lock
 
         def get_predictions(self, timeout):
             try:
-                response = self._consumer.get(self._correlation_id, timeout=timeout)
+                # A consumer must not be used by several result greenlets at the same time,
+                # the responses are then converted outside of the lock
+                with self._consumer_lock:
+                    response = self._consumer.get(self._correlation_id, timeout=timeout)
                 try:
-                    outputs = response.to_parsed_result_buffer()
-                    predictions = {
-                        'outputs': [
-                            {
-                                'labels': protobuf.json_format.MessageToDict(output.labels,
-                                                                             including_default_value_fields=True,
-                                                                             preserving_proto_field_name=True)
-                            } for output in outputs
-                        ]
-                    }
-                    return predictions
+                    # The messages are only converted to dicts if the predictions are output in json
+                    return Predictions.from_messages(response.to_parsed_result_buffer())
                 except rpc.exceptions.ServerError as e:
                     raise ResultInferenceError({'error': str(e), 'code': e.code})
             except rpc.amqp.exceptions.Timeout:
@@ -79,17 +77,18 @@ class RpcRecognition(AbstractWorkflow):
         def __str__(self):
             return '<{} correlation_id={}>'.format(self.__class__.__qualname__, self._correlation_id)
 
-    def __init__(self, recognition_version_id, amqp_url, routing_key, recognition_cmd_kwargs=None):
+    def __init__(self, recognition_version_id, amqp_url, routing_key, recognition_cmd_kwargs=None, nb_consumers=1):
         super(RpcRecognition, self).__init__('recognition_{}'.format(recognition_version_id))
         self._id = recognition_version_id
 
         self._routing_key = routing_key
-        self._consumer = None
+        self._consumers = []
         self.amqp_url = amqp_url
 
-        # We declare the client that will be used for consuming in one thread only
+        # We declare the clients that will be used for consuming in one thread only
         # RPC client is not thread safe
-        self._consume_client = rpc.client.Client(amqp_url)
+        # Each client consumes its own response queue, the requests are spread over them
+        self._consume_clients = [rpc.client.Client(amqp_url) for _ in range(max(1, nb_consumers))]
         if recognition_version_id is None:
             self._command_mix = rpc.helpers.v07_proto.create_workflow_command_mix()
         else:
@@ -102,8 +101,11 @@ class RpcRecognition(AbstractWorkflow):
 
             self._command_mix = rpc.helpers.v07_proto.create_recognition_command_mix(recognition_version_id,
                                                                                      **recognition_cmd_kwargs)
-        self._command_queue = self._consume_client.new_queue(self._routing_key)
-        self._response_queue, self._consumer = self._consume_client.new_consuming_queue()
+        self._command_queue = self._consume_clients[0].new_queue(self._routing_key)
+        for consume_client in self._consume_clients:
+            response_queue, consumer = consume_client.new_consuming_queue()
+            self._consumers.append((consume_client, response_queue, consumer, gevent.lock.Semaphore()))
+        self._next_consumers = itertools.cycle(self._consumers)
 
     def close_client(self, client):
         client.amqp_client.ensured_connection.close()
@@ -114,15 +116,17 @@ class RpcRecognition(AbstractWorkflow):
         return rpc.client.Client(self.amqp_url)
 
     def close(self):
-        if self._consumer is not None:
-            self._consume_client.remove_consuming_queue(self._response_queue, self._consumer)
-        self.close_client(self._consume_client)
+        for consume_client, response_queue, consumer, _ in self._consumers:
+            consume_client.remove_consuming_queue(response_queue, consumer)
+        for consume_client in self._consume_clients:
+            self.close_client(consume_client)
 
     def infer(self, encoded_image_bytes, push_client, _useless_frame_name):
         # _useless_frame_name is used for the json workflow
         image_input = rpc.v07_ImageInput(source=rpc.BINARY_IMAGE_PREFIX + encoded_image_bytes)
         # forward_to parameter can be removed for images of worker nn with tag >= 0.7.8
-        reply_to = self._response_queue.name
+        _, response_queue, consumer, consumer_lock = next(self._next_consumers)
+        reply_to = response_queue.name
         serialized_buffer = rpc.helpers.proto.create_v07_images_command([image_input], self._command_mix, forward_to=[reply_to])
         correlation_id = push_client.send_binary(serialized_buffer, self._command_queue.name, reply_to=reply_to)
-        return self.InferResult(correlation_id, self._consumer)
+        return self.InferResult(correlation_id, consumer, consumer_lock)
@@ -1,4 +1,5 @@
 import os
+from ..exceptions import SendInferenceError
 
 
 class AbstractWorkflow(object):
@@ -29,6 +30,19 @@ class AbstractWorkflow(object):
         """Should return a subclass of AbstractInferResult"""
         raise NotImplementedError()
 
+    def infer_batch(self, encoded_images, push_client, frame_names):
+        """
+        Send several images at once. Returns a list with, for each image, a subclass of AbstractInferResult
+        or the SendInferenceError raised while sending it. By default the images are sent one after the other.
+        """
+        results = []
+        for encoded_image_bytes, frame_name in zip(encoded_images, frame_names):
+            try:
+                results.append(self.infer(encoded_image_bytes, push_client, frame_name))
+            except SendInferenceError as e:
+                results.append(e)
+        return results
+
     def get_json_output_filename(self, file):
         dirname = os.path.dirname(file)
         filename, _ = os.path.splitext(file)
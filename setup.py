@@ -38,7 +38,7 @@ setup(
     long_description_content_type='text/markdown',
     data_files=[('', ['requirements.txt'])],
     install_requires=requirements,
-    extras_require={'rpc': ['deepomatic-rpc>=0.8.0']},
+    extras_require={'rpc': ['deepomatic-rpc>=0.8.0'], 'json': ['orjson']},
     python_requires=">=3.6.*",
     classifiers=[
         'Operating System :: OS Independent',
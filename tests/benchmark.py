@@ -0,0 +1,400 @@
+# coding: utf-8
+"""
+Pipeline benchmarks, used as non performance regression tests for the thread/greenlet pools.
+
+It runs InferManager.input_loop end to end on synthetic inputs against FakeWorkflow,
+a local stand-in of the inference backend with configurable latency, jitter and error rate.
+
+Usage:
+    python tests/benchmark.py                   # run and compare with the stored baselines
+    python tests/benchmark.py --save-baseline   # run and store the results as the new baselines
+    python tests/benchmark.py --serialization   # compare the json backends installed
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import contextlib
+import collections
+
+# Must be done before importing anything else, like the deepo entrypoint
+from gevent.monkey import patch_all
+patch_all(thread=False, time=False, subprocess=False)
+
+import cv2  # noqa: E402
+import gevent  # noqa: E402
+import numpy as np  # noqa: E402
+from utils import create_tmp_dir  # noqa: E402
+from deepomatic.cli.cmds.utils import setup_model_cmd_line_parser  # noqa: E402
+from deepomatic.cli.exceptions import ResultInferenceError, ResultInferenceTimeout  # noqa: E402
+from deepomatic.cli.input_data import InputThread  # noqa: E402
+from deepomatic.cli.lib.inference import (InferManager, PrepareInferenceThread,  # noqa: E402
+                                          SendInferenceGreenlet, ResultInferenceGreenlet)
+from deepomatic.cli.output_data import OutputThread  # noqa: E402
+from deepomatic.cli.predictions import Predictions  # noqa: E402
+from deepomatic.cli import serializer  # noqa: E402
+from deepomatic.cli.workflow.workflow_abstraction import AbstractWorkflow  # noqa: E402
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+LOGGER = logging.getLogger(__name__)
+BASELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baselines.json')
+DEFAULT_TOLERANCE = 0.3
+thread_time = getattr(time, 'thread_time', time.process_time)  # python < 3.7
+
+
+# ------- Fake inference backend ------------------------------------------------------------------------------------- #
+
+
+def make_predictions(nb_predictions, rng):
+    predictions = []
+    for i in range(nb_predictions):
+        xmin, ymin = rng.random() * 0.5, rng.random() * 0.5
+        predictions.append({
+            'label_id': i % 10,
+            'label_name': 'label_{}'.format(i % 10),
+            'score': rng.random(),
+            'threshold': 0.5,
+            'roi': {
+                'region_id': i,
+                'bbox': {'xmin': xmin, 'ymin': ymin, 'xmax': xmin + 0.3, 'ymax': ymin + 0.3}
+            }
+        })
+    predictions.sort(key=lambda pred: pred['score'], reverse=True)
+    return {'outputs': [{'labels': {
+        'predicted': [pred for pred in predictions if pred['score'] >= 0.5],
+        'discarded': [pred for pred in predictions if pred['score'] < 0.5]
+    }}]}
+
+
+class FakeWorkflow(AbstractWorkflow):
+    """Stand-in of the inference backend, the server side processing is simulated by a latency."""
+
+    class InferResult(AbstractWorkflow.AbstractInferResult):
+        def __init__(self, ready_at, predictions, error):
+            self._ready_at = ready_at
+            self._predictions = predictions
+            self._error = error
+
+        def get_predictions(self, timeout):
+            wait = self._ready_at - time.time()
+            if wait > timeout:
+                gevent.sleep(timeout)
+                raise ResultInferenceTimeout(timeout)
+            if wait > 0:
+                gevent.sleep(wait)
+            if self._error:
+                raise ResultInferenceError('fake error')
+            return Predictions.from_dict(self._predictions)
+
+    def __init__(self, latency=0.05, jitter=0.01, error_rate=0., nb_predictions=10, seed=0, slow_sends=None):
+        super(FakeWorkflow, self).__init__('fake')
+        self._latency = latency
+        # Time to send specific requests, by request index
+        self._slow_sends = slow_sends or {}
+        self._jitter = jitter
+        self._error_rate = error_rate
+        self._nb_predictions = nb_predictions
+        self._rng = random.Random(seed)
+        self.nb_requests = 0
+
+    def close(self):
+        pass
+
+    def infer(self, encoded_image_bytes, push_client, frame_name):
+        send_time = self._slow_sends.get(self.nb_requests)
+        self.nb_requests += 1
+        if send_time is not None:
+            gevent.sleep(send_time)
+        latency = max(0., self._latency + self._rng.uniform(-self._jitter, self._jitter))
+        error = self._rng.random() < self._error_rate
+        return self.InferResult(time.time() + latency, make_predictions(self._nb_predictions, self._rng), error)
+
+
+# ------- Synthetic inputs ------------------------------------------------------------------------------------------- #
+
+
+def synthetic_image(width, height, seed=0):
+    rng = np.random.RandomState(seed)
+    # Smooth gradients plus noise, closer to a real image than pure noise for the jpeg encoder
+    horizontal = np.tile(np.linspace(0, 223, width), (height, 1))
+    vertical = np.tile(np.linspace(0, 223, height)[:, None], (1, width))
+    image = np.dstack([horizontal, vertical, (horizontal + vertical) / 2]).astype(np.uint8)
+    return image + rng.randint(0, 32, size=image.shape).astype(np.uint8)
+
+
+def write_synthetic_image(path, width=1280, height=720, seed=0):
+    cv2.imwrite(path, synthetic_image(width, height, seed))
+    return path
+
+
+def write_synthetic_video(path, nb_frames=100, width=640, height=360, fps=25):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    image = synthetic_image(width, height)
+    for i in range(nb_frames):
+        writer.write(np.roll(image, 4 * i, axis=1))
+    writer.release()
+    return path
+
+
+def write_synthetic_directory(path, nb_images=50, nb_video_frames=50):
+    os.makedirs(path)
+    for i in range(nb_images):
+        write_synthetic_image(os.path.join(path, 'img_{:04d}.jpg'.format(i)), 640, 360, seed=i)
+    write_synthetic_video(os.path.join(path, 'video.mp4'), nb_video_frames)
+    return path
+
+
+SCENARIOS = collections.OrderedDict([
+    ('image', lambda tmpdir: write_synthetic_image(os.path.join(tmpdir, 'image.jpg'), 1920, 1080)),
+    ('video', lambda tmpdir: write_synthetic_video(os.path.join(tmpdir, 'video.mp4'), 200)),
+    ('directory', lambda tmpdir: write_synthetic_directory(os.path.join(tmpdir, 'directory'))),
+])
+
+
+# ------- Instrumentation -------------------------------------------------------------------------------------------- #
+
+
+STAGES = collections.OrderedDict([
+    ('input', InputThread),
+    ('encode', PrepareInferenceThread),
+    ('send', SendInferenceGreenlet),
+    ('result', ResultInferenceGreenlet),
+    ('output', OutputThread),
+])
+
+
+def current_rss():
+    """Resident set size of the process in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        if resource is None:
+            return 0
+        # Peak RSS, in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageStats(object):
+    def __init__(self):
+        self.nb_calls = 0
+        self.wall_time = 0.
+        # CPU time of the thread running the stage, greenlets stages share the main thread
+        # so it also counts what other greenlets did while they were switched out
+        self.cpu_time = 0.
+        self.peak_rss = 0
+
+    def to_dict(self, nb_frames):
+        nb_frames = max(nb_frames, 1)
+        return {
+            'calls': self.nb_calls,
+            'wall_time_per_frame': self.wall_time / nb_frames,
+            'cpu_time_per_frame': self.cpu_time / nb_frames,
+            'peak_rss_mb': self.peak_rss / 1024. / 1024.,
+        }
+
+
+class PipelineProbe(object):
+    """Wraps the process_msg of each stage to measure it, and stamps frames to measure end-to-end latency."""
+
+    def __init__(self):
+        self.stages = collections.OrderedDict((name, StageStats()) for name in STAGES)
+        self.latencies = []
+
+    def _wrap(self, name, process_msg):
+        stats = self.stages[name]
+
+        def wrapped(thread, msg):
+            start, start_cpu = time.time(), thread_time()
+            msg_out = process_msg(thread, msg)
+            stats.wall_time += time.time() - start
+            stats.cpu_time += thread_time() - start_cpu
+            stats.nb_calls += 1
+            stats.peak_rss = max(stats.peak_rss, current_rss())
+            if name == 'input' and msg_out is not None:
+                msg_out.benchmark_start = time.time()
+            elif name == 'output' and msg_out not in (OutputThread.NOT_PROCESSED_YET, OutputThread.DROPPED):
+                self.latencies.append(time.time() - msg.benchmark_start)
+            return msg_out
+
+        return wrapped
+
+    @contextlib.contextmanager
+    def install(self):
+        originals = {name: cls.process_msg for name, cls in STAGES.items()}
+        try:
+            for name, cls in STAGES.items():
+                cls.process_msg = self._wrap(name, originals[name])
+            yield self
+        finally:
+            for name, cls in STAGES.items():
+                cls.process_msg = originals[name]
+
+
+# ------- Benchmark -------------------------------------------------------------------------------------------------- #
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.
+
+
+def build_kwargs(input_path, outputs, extra_opts=()):
+    parser = argparse.ArgumentParser()
+    setup_model_cmd_line_parser('platform', 'infer', parser)
+    return vars(parser.parse_args(['-i', input_path, '-o'] + list(outputs) + ['-r', '0'] + list(extra_opts)))
+
+
+def run_benchmark(scenario, workflow=None, extra_opts=(), tmpdir=None):
+    """Runs the inference pipeline on a synthetic input and returns the measures."""
+    workflow = workflow or FakeWorkflow()
+    with create_tmp_dir() as own_tmpdir:
+        tmpdir = tmpdir or own_tmpdir
+        input_path = SCENARIOS[scenario](tmpdir)
+        kwargs = build_kwargs(input_path, [os.path.join(tmpdir, 'output.jsonl')], extra_opts)
+        probe = PipelineProbe()
+        start, start_cpu = time.time(), time.process_time()
+        with probe.install():
+            try:
+                InferManager().input_loop(kwargs, workflow=workflow)
+            except SystemExit:
+                # input_loop exits on error or on hard stop
+                pass
+        elapsed = time.time() - start
+        cpu = time.process_time() - start_cpu
+
+    nb_frames = len(probe.latencies)
+    return {
+        'frames': nb_frames,
+        'fps': nb_frames / elapsed if elapsed > 0 else 0.,
+        'latency_p50': percentile(probe.latencies, 50),
+        'latency_p99': percentile(probe.latencies, 99),
+        'cpu_time_per_frame': cpu / max(nb_frames, 1),
+        'peak_rss_mb': max(stats.peak_rss for stats in probe.stages.values()) / 1024. / 1024.,
+        'stages': collections.OrderedDict((name, stats.to_dict(nb_frames)) for name, stats in probe.stages.items()),
+    }
+
+
+def load_baselines(path=BASELINES_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baselines(results, path=BASELINES_PATH):
+    baselines = load_baselines(path)
+    for scenario, result in results.items():
+        baselines[scenario] = {key: result[key] for key in ('fps', 'latency_p50', 'latency_p99')}
+    with open(path, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def check_regressions(scenario, result, baselines, tolerance=DEFAULT_TOLERANCE):
+    """Returns a list of human readable regressions compared to the baseline of the scenario."""
+    baseline = baselines.get(scenario)
+    if baseline is None:
+        return []
+    regressions = []
+    if result['fps'] < baseline['fps'] * (1 - tolerance):
+        regressions.append('{}: fps {:.1f} < baseline {:.1f}'.format(scenario, result['fps'], baseline['fps']))
+    for key in ('latency_p50', 'latency_p99'):
+        if result[key] > baseline[key] * (1 + tolerance):
+            regressions.append('{}: {} {:.3f}s > baseline {:.3f}s'.format(scenario, key, result[key], baseline[key]))
+    return regressions
+
+
+def format_result(scenario, result):
+    lines = ['{}: {} frames, {:.1f} frames/s, latency p50={:.3f}s p99={:.3f}s, cpu={:.2f}ms/frame, peak rss={:.0f}MB'.format(
+        scenario, result['frames'], result['fps'], result['latency_p50'], result['latency_p99'],
+        result['cpu_time_per_frame'] * 1000, result['peak_rss_mb'])]
+    for name, stage in result['stages'].items():
+        lines.append('    {:<7} wall={:.2f}ms/frame cpu={:.2f}ms/frame peak rss={:.0f}MB'.format(
+            name, stage['wall_time_per_frame'] * 1000, stage['cpu_time_per_frame'] * 1000, stage['peak_rss_mb']))
+    return '\n'.join(lines)
+
+
+def benchmark_serialization(nb_frames=100, nb_predictions=1000):
+    """Time to dump and load the predictions of the frames with each json backend installed, in seconds per frame."""
+    rng = random.Random(0)
+    payloads = [make_predictions(nb_predictions, rng) for _ in range(nb_frames)]
+    current = serializer.BACKEND
+    results = collections.OrderedDict()
+    try:
+        for backend in serializer.installed_backends():
+            serializer.use_backend(backend)
+            start = time.time()
+            lines = [serializer.dumps(payload) for payload in payloads]
+            dumps_time = time.time() - start
+            start = time.time()
+            for line in lines:
+                serializer.loads(line)
+            results[backend] = {'dumps': dumps_time / nb_frames, 'loads': (time.time() - start) / nb_frames}
+    finally:
+        serializer.use_backend(current)
+    return results
+
+
+def is_not_progress_bar(record):
+    return not record.getMessage().startswith('Input processing')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the inference pipeline against a fake inference backend.')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS.keys()), default=list(SCENARIOS.keys()))
+    parser.add_argument('--latency', type=float, default=0.05, help="Fake inference latency in seconds.")
+    parser.add_argument('--jitter', type=float, default=0.01, help="Fake inference latency jitter in seconds.")
+    parser.add_argument('--error_rate', type=float, default=0., help="Ratio of fake inferences that fail.")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed relative degradation compared to the baselines.")
+    parser.add_argument('--save-baseline', dest='save_baseline', action='store_true',
+                        help="Store the results as the new baselines.")
+    parser.add_argument('--json', dest='json_output', action='store_true', help="Print the results as json.")
+    parser.add_argument('--serialization', action='store_true',
+                        help="Only compare the json backends installed on large prediction payloads.")
+    parser.add_argument('pipeline_opts', nargs=argparse.REMAINDER,
+                        help="Extra options given to the pipeline, after a '--'.")
+    args = parser.parse_args(args)
+    logging.basicConfig(level=logging.WARNING)
+    # The progress bar would be mixed with the results
+    logging.getLogger('deepomatic.cli.lib.inference').addFilter(is_not_progress_bar)
+    extra_opts = [opt for opt in args.pipeline_opts if opt != '--']
+
+    if args.serialization:
+        for backend, result in benchmark_serialization().items():
+            print('{:10s} dumps={:.2f}ms loads={:.2f}ms per frame of 1000 predictions'.format(
+                backend, result['dumps'] * 1000, result['loads'] * 1000))
+        return 0
+
+    results = collections.OrderedDict()
+    for scenario in args.scenarios:
+        workflow = FakeWorkflow(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+        results[scenario] = run_benchmark(scenario, workflow, extra_opts)
+        if not args.json_output:
+            print(format_result(scenario, results[scenario]))
+
+    if args.json_output:
+        print(json.dumps(results, indent=2))
+
+    if args.save_baseline:
+        save_baselines(results)
+        return 0
+
+    baselines = load_baselines()
+    regressions = [regression for scenario, result in results.items()
+                   for regression in check_regressions(scenario, result, baselines, args.tolerance)]
+    for regression in regressions:
+        print('REGRESSION {}'.format(regression))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
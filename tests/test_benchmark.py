@@ -0,0 +1,92 @@
+import os
+import cv2
+import pytest
+import numpy as np
+from benchmark import (FakeWorkflow, SCENARIOS, run_benchmark, load_baselines,
+                       check_regressions, DEFAULT_TOLERANCE)
+
+
+# Comparing with the baselines only makes sense on the machine that recorded them
+RUN_BENCHMARKS = os.getenv('DEEPOCLI_BENCHMARK', '') not in ('', '0')
+
+
+def test_benchmark_video(no_error_logs):
+    workflow = FakeWorkflow(latency=0.01, jitter=0.005)
+    result = run_benchmark('video', workflow)
+    assert result['frames'] == 200
+    assert workflow.nb_requests == 200
+    assert result['fps'] > 0
+    assert 0 < result['latency_p50'] <= result['latency_p99']
+    for stage in result['stages'].values():
+        assert stage['calls'] > 0
+
+
+def test_benchmark_error_rate():
+    workflow = FakeWorkflow(latency=0.01, error_rate=0.5, seed=1)
+    result = run_benchmark('directory', workflow)
+    assert workflow.nb_requests == 100
+    assert 0 < result['frames'] < 100
+
+
+def test_check_regressions():
+    baselines = {'video': {'fps': 100., 'latency_p50': 0.1, 'latency_p99': 0.2}}
+    result = {'fps': 90., 'latency_p50': 0.1, 'latency_p99': 0.2}
+    assert check_regressions('video', result, baselines) == []
+    assert check_regressions('image', result, baselines) == []
+    result = {'fps': 50., 'latency_p50': 0.1, 'latency_p99': 0.5}
+    assert len(check_regressions('video', result, baselines)) == 2
+
+
+@pytest.mark.skipif(not RUN_BENCHMARKS, reason='set DEEPOCLI_BENCHMARK=1 to compare with the baselines')
+@pytest.mark.parametrize('scenario', list(SCENARIOS.keys()))
+def test_benchmark_baselines(scenario, no_error_logs):
+    result = run_benchmark(scenario)
+    assert check_regressions(scenario, result, load_baselines(), DEFAULT_TOLERANCE) == []
+
+
+class ShapeWorkflow(FakeWorkflow):
+    def __init__(self):
+        super(ShapeWorkflow, self).__init__(latency=0.01)
+        self.shapes = []
+
+    def infer(self, encoded_image_bytes, push_client, frame_name):
+        self.shapes.append(cv2.imdecode(np.frombuffer(encoded_image_bytes, np.uint8), cv2.IMREAD_COLOR).shape)
+        return super(ShapeWorkflow, self).infer(encoded_image_bytes, push_client, frame_name)
+
+
+@pytest.mark.parametrize('opts,shape', [
+    ([], (1080, 1920, 3)),
+    (['--max_inference_size', '640'], (360, 640, 3)),
+    (['--max_inference_size', '4000'], (1080, 1920, 3)),
+])
+def test_max_inference_size(opts, shape, no_error_logs):
+    workflow = ShapeWorkflow()
+    result = run_benchmark('image', workflow, extra_opts=opts)
+    assert result['frames'] == 1
+    assert workflow.shapes == [shape]
+
+
+class BatchWorkflow(FakeWorkflow):
+    def __init__(self):
+        super(BatchWorkflow, self).__init__(latency=0.01)
+        self.batch_sizes = []
+
+    def infer_batch(self, encoded_images, push_client, frame_names):
+        self.batch_sizes.append(len(encoded_images))
+        return super(BatchWorkflow, self).infer_batch(encoded_images, push_client, frame_names)
+
+
+def test_batch_size(no_error_logs):
+    workflow = BatchWorkflow()
+    result = run_benchmark('video', workflow, extra_opts=['--batch_size', '8', '--batch_max_wait', '0.1'])
+    assert result['frames'] == 200
+    assert workflow.nb_requests == 200
+    assert max(workflow.batch_sizes) == 8
+    # Single frames don't go through infer_batch
+    assert min(workflow.batch_sizes) > 1
+
+
+def test_result_workers(no_error_logs):
+    workflow = FakeWorkflow(latency=0.01, jitter=0.005)
+    result = run_benchmark('video', workflow, extra_opts=['--result_workers', '4'])
+    assert result['frames'] == 200
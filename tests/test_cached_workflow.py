@@ -0,0 +1,47 @@
+import json
+from benchmark import FakeWorkflow, build_kwargs, write_synthetic_directory
+from deepomatic.cli.lib.inference import InferManager
+from deepomatic.cli.workflow.cached_workflow import CachedWorkflow, PredictionCache
+
+
+def run(input_path, output, extra_opts=()):
+    workflow = FakeWorkflow(latency=0.001, jitter=0.)
+    InferManager().input_loop(build_kwargs(input_path, [output], extra_opts), workflow=workflow)
+    return workflow
+
+
+def read_predictions(path):
+    with open(path) as f:
+        return sorted((line['data']['framename'], json.dumps(line['outputs'])) for line in map(json.loads, f))
+
+
+def test_prediction_cache(tmp_path):
+    input_path = write_synthetic_directory(str(tmp_path / 'input'), nb_images=10, nb_video_frames=10)
+    cache = str(tmp_path / 'cache.db')
+    opts = ['--prediction_cache', cache]
+    assert run(input_path, str(tmp_path / 'first.jsonl'), opts).nb_requests == 20
+    # Nothing is sent again, and the predictions are the same
+    assert run(input_path, str(tmp_path / 'second.jsonl'), opts).nb_requests == 0
+    assert read_predictions(str(tmp_path / 'first.jsonl')) == read_predictions(str(tmp_path / 'second.jsonl'))
+    # Another recognition doesn't use the same predictions
+    workflow = FakeWorkflow(latency=0.001, jitter=0.)
+    workflow._display_id = 'other'
+    cached = CachedWorkflow(workflow, cache)
+    assert cached.infer_batch([b'a', b'b'], None, ['a', 'b'])
+    assert (cached.hits, cached.misses, workflow.nb_requests) == (0, 2, 2)
+    cached.close()
+
+
+def test_prediction_cache_eviction(tmp_path):
+    cache = PredictionCache(str(tmp_path / 'cache.db'), max_bytes=1000)
+    predictions = {'outputs': [{'labels': {'predicted': [], 'discarded': []}}]}
+    size = len(json.dumps(predictions))
+    for i in range(1000 // size):
+        cache.put(str(i), predictions)
+    assert cache.get('0') == predictions  # the first one is now the most recently used
+    cache.put('new', predictions)
+    assert cache.nb_bytes <= 1000
+    assert cache.get('0') is not None and cache.get('new') is not None
+    assert cache.get('1') is None
+    cache.close()
+    assert PredictionCache(str(tmp_path / 'cache.db'), max_bytes=1000).nb_bytes == cache.nb_bytes
@@ -0,0 +1,82 @@
+import gevent
+import pytest
+from deepomatic.api.exceptions import BadStatus
+from deepomatic.api.resources.task import Task
+import deepomatic.cli.cmds  # noqa: F401, the workflows can't be imported first because of a circular import
+from deepomatic.cli.exceptions import ResultInferenceError, ResultInferenceTimeout
+from deepomatic.cli.workflow.cloud_workflow import CloudRecognition, TaskPoller
+
+
+def make_predictions(task_id):
+    return {'outputs': [{'labels': {'predicted': [{'label_name': str(task_id), 'score': 1.}], 'discarded': []}}]}
+
+
+class FakeTaskResource(object):
+    """Task list endpoint of a fake client, tasks are done after a number of refreshes."""
+    def __init__(self, refreshes_before_done, errors=(), bad_status=False):
+        self.refreshes_before_done = refreshes_before_done
+        self.errors = errors
+        self.bad_status = bad_status
+        self.refreshes = {}
+        self.requests = []
+
+    def list(self, task_ids):
+        self.requests.append(task_ids)
+        if self.bad_status:
+            raise BadStatus(type('Response', (), {'status_code': 500, 'content': 'error'})())
+        tasks = []
+        for task_id in task_ids:
+            self.refreshes[task_id] = self.refreshes.get(task_id, 0) + 1
+            status = 'pending'
+            if self.refreshes[task_id] >= self.refreshes_before_done.get(task_id, 1):
+                status = 'error' if task_id in self.errors else 'success'
+            tasks.append(Task(None, task_id, {'id': task_id, 'status': status, 'error': 'failed',
+                                              'data': make_predictions(task_id)}))
+        return tasks
+
+
+class FakeClient(object):
+    def __init__(self, *args, **kwargs):
+        self.Task = FakeTaskResource(*args, **kwargs)
+
+
+def infer_results(poller, task_ids):
+    return [CloudRecognition.InferResult(Task(None, task_id, {'id': task_id, 'status': 'pending'}), poller)
+            for task_id in task_ids]
+
+
+def test_task_poller_bulk_requests():
+    nb_tasks = 250
+    client = FakeClient({task_id: task_id % 3 + 1 for task_id in range(nb_tasks)}, errors={7})
+    poller = TaskPoller(client)
+    results = infer_results(poller, range(nb_tasks))
+    for task_id, result in enumerate(results):
+        if task_id == 7:
+            with pytest.raises(ResultInferenceError):
+                result.get_predictions(timeout=5)
+        else:
+            assert result.get_predictions(timeout=5).to_dict() == make_predictions(task_id)
+    assert len(poller) == 0
+    # All the tasks are refreshed together, by chunks of 100
+    assert len(client.Task.requests) <= 3 * 3
+    assert max(len(task_ids) for task_ids in client.Task.requests) == 100
+    gevent.sleep(0.2)
+    assert poller._greenlet is None
+
+
+def test_task_poller_timeout():
+    client = FakeClient({0: 1000})
+    poller = TaskPoller(client)
+    result, = infer_results(poller, [0])
+    with pytest.raises(ResultInferenceTimeout):
+        result.get_predictions(timeout=0.3)
+    assert len(poller) == 0
+
+
+def test_task_poller_bad_status():
+    client = FakeClient({}, bad_status=True)
+    poller = TaskPoller(client)
+    results = infer_results(poller, [0, 1])
+    for result in results:
+        with pytest.raises(ResultInferenceError):
+            result.get_predictions(timeout=5)
@@ -0,0 +1,57 @@
+import json
+import time
+import gevent
+from benchmark import FakeWorkflow, run_benchmark
+from deepomatic.cli.concurrency import ConcurrencyLimiter
+
+
+def test_limiter_bounds_requests_in_flight():
+    limiter = ConcurrencyLimiter(min_concurrency=2, max_concurrency=4)
+    sent_at = [limiter.acquire(timeout=0), limiter.acquire(timeout=0)]
+    assert None not in sent_at
+    assert limiter.acquire(timeout=0.05) is None
+    gevent.spawn_later(0.05, limiter.release, sent_at[0])
+    assert limiter.acquire(timeout=5) is not None
+    assert limiter.in_flight == 2
+
+
+def test_limiter_aimd():
+    limiter = ConcurrencyLimiter(min_concurrency=2, max_concurrency=40)
+    # Slow start
+    for _ in range(10):
+        limiter.release(limiter.acquire())
+    assert limiter.limit == 12
+    for _ in range(100):
+        limiter.release(limiter.acquire())
+    assert limiter.limit == 40
+    # All the requests sent before the decrease count as a single congestion
+    sent_at = [limiter.acquire() for _ in range(10)]
+    for request_sent_at in sent_at:
+        limiter.release(request_sent_at, congestion=True)
+    assert limiter.limit == 20
+    assert limiter.nb_decreases == 1
+    # Additive increase
+    for _ in range(20):
+        limiter.release(limiter.acquire())
+    assert 20.9 < limiter.limit < 21
+    for _ in range(10):
+        limiter.release(limiter.acquire(), congestion=True)
+    assert limiter.limit == 2
+
+
+def test_limiter_target_latency():
+    limiter = ConcurrencyLimiter(min_concurrency=1, max_concurrency=10, target_latency=0.01)
+    for _ in range(5):
+        limiter.release(limiter.acquire())
+    assert limiter.limit == 6
+    limiter.release(time.time() - 1)
+    assert limiter.limit == 3
+
+
+def test_pipeline_concurrency_adapts_to_errors(tmp_path):
+    workflow = FakeWorkflow(latency=0.01, error_rate=0.2, seed=2)
+    stats_file = str(tmp_path / 'stats.jsonl')
+    run_benchmark('video', workflow, extra_opts=['--max_concurrency', '8', '--stats_file', stats_file])
+    with open(stats_file) as f:
+        stats = [json.loads(line) for line in f]
+    assert 1 <= stats[-1]['gauges']['inference_concurrency_limit'] < 8
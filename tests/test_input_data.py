@@ -0,0 +1,172 @@
+import os
+import glob
+import json
+import struct
+import cv2
+import pytest
+from unittest.mock import patch
+from benchmark import FakeWorkflow, run_benchmark, synthetic_image, write_synthetic_video
+from deepomatic.cli.common import read_jpeg_header
+from deepomatic.cli.exceptions import DeepoVideoOpenError
+from deepomatic.cli.input_data import ImageInputData, VideoInputData, DirectoryInputData
+from deepomatic.cli.input_manifest import InputManifest
+
+
+def encode_jpeg(width=64, height=32):
+    return cv2.imencode('.jpg', synthetic_image(width, height))[1].tobytes()
+
+
+def with_exif_orientation(data, orientation, byte_order='>'):
+    tiff = (b'MM' if byte_order == '>' else b'II') + struct.pack(byte_order + 'HI', 42, 8)
+    tiff += struct.pack(byte_order + 'H', 1) + struct.pack(byte_order + 'HHIH2x', 0x0112, 3, 1, orientation)
+    tiff += struct.pack(byte_order + 'I', 0)
+    segment = b'Exif\x00\x00' + tiff
+    return data[:2] + b'\xff\xe1' + struct.pack('>H', len(segment) + 2) + segment + data[2:]
+
+
+def test_read_jpeg_header():
+    data = encode_jpeg(64, 32)
+    assert read_jpeg_header(data) == (64, 32, None)
+    assert read_jpeg_header(with_exif_orientation(data, 6)) == (64, 32, 6)
+    assert read_jpeg_header(with_exif_orientation(data, 1, '<')) == (64, 32, 1)
+    # Truncated or not a jpeg
+    assert read_jpeg_header(data[:len(data) // 2]) is None
+    assert read_jpeg_header(b'not a jpeg') is None
+    assert read_jpeg_header(b'') is None
+
+
+# Opencv applies the EXIF orientation, images needing a rotation are not sent as is
+@pytest.mark.parametrize('orientation,passthrough,shape', [
+    (None, True, (32, 64, 3)),
+    (1, True, (32, 64, 3)),
+    (6, False, (64, 32, 3)),
+])
+def test_image_input_jpeg_passthrough(tmp_path, orientation, passthrough, shape):
+    data = encode_jpeg()
+    if orientation is not None:
+        data = with_exif_orientation(data, orientation)
+    path = str(tmp_path / 'image.jpg')
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    frame = next(iter(ImageInputData(path, recognition_id='0')))
+    assert (frame.jpeg_bytes == data) is passthrough
+    # Not decoded until needed
+    assert (frame._image is None) is passthrough
+    assert frame.image.shape == shape
+
+    frame = next(iter(ImageInputData(path, recognition_id='0', jpeg_passthrough=False)))
+    assert frame.jpeg_bytes is None
+
+
+class BytesWorkflow(FakeWorkflow):
+    def __init__(self):
+        super(BytesWorkflow, self).__init__(latency=0.01)
+        self.sent = []
+
+    def infer(self, encoded_image_bytes, push_client, frame_name):
+        self.sent.append(encoded_image_bytes)
+        return super(BytesWorkflow, self).infer(encoded_image_bytes, push_client, frame_name)
+
+
+@pytest.mark.parametrize('opts,passthrough', [
+    ([], True),
+    (['--no_jpeg_passthrough'], False),
+    # Too big, must be resized
+    (['--max_inference_size', '640'], False),
+])
+def test_jpeg_sent_as_is(tmp_path, opts, passthrough, no_error_logs):
+    workflow = BytesWorkflow()
+    result = run_benchmark('image', workflow, extra_opts=opts, tmpdir=str(tmp_path))
+    assert result['frames'] == 1
+    with open(os.path.join(str(tmp_path), 'image.jpg'), 'rb') as f:
+        assert (workflow.sent == [f.read()]) is passthrough
+
+
+def test_decode_prefetch(tmp_path, no_error_logs):
+    stats_file = str(tmp_path / 'stats.jsonl')
+    workflow = FakeWorkflow(latency=0.001)
+    result = run_benchmark('video', workflow, extra_opts=['--decode_prefetch', '8', '--stats_file', stats_file])
+    assert result['frames'] == 200
+    with open(stats_file) as f:
+        stats = [json.loads(line) for line in f]
+    assert stats[-1]['pools']['decode']['count'] == 201  # the end of the video is also decoded
+    assert 0 <= stats[-1]['gauges']['decode_ring_frames'] <= 8
+
+
+def test_decode_prefetch_frames_order(tmp_path):
+    path = str(tmp_path / 'video.mp4')
+    write_synthetic_video(path, 200)
+    kwargs = {'input_fps': None, 'skip_frame': 1, 'recognition_id': None}
+    expected = [frame.name for frame in iter(VideoInputData(path, **kwargs))]
+    inputs = iter(VideoInputData(path, decode_prefetch=3, **kwargs))
+    frames = list(inputs)
+    inputs.close()
+    assert len(expected) == 100
+    assert [frame.name for frame in frames] == expected
+
+
+def test_decode_workers_frames_order(tmp_path):
+    for i in range(3):
+        write_synthetic_video(str(tmp_path / 'video_{}.mp4'.format(i)), 20 + i)
+        with open(str(tmp_path / 'image_{}.jpg'.format(i)), 'wb') as f:
+            f.write(encode_jpeg())
+    kwargs = {'input_fps': None, 'skip_frame': 0, 'recognition_id': None, 'recursive': False}
+    expected = [(frame.name, frame.decoded_video_frame_index) for frame in iter(DirectoryInputData(str(tmp_path), **kwargs))]
+    inputs = iter(DirectoryInputData(str(tmp_path), decode_workers=2, **kwargs))
+    frames = list(inputs)
+    inputs.close()
+    assert len(expected) == 3 + 20 + 21 + 22
+    assert [(frame.name, frame.decoded_video_frame_index) for frame in frames] == expected
+    # The jpeg files are still passed through, and decoded on demand
+    image = next(frame for frame in frames if frame.jpeg_bytes is not None)
+    assert image.image.shape == (32, 64, 3)
+
+
+def test_directory_lazy_scan(tmp_path):
+    os.mkdir(str(tmp_path / 'b_dir'))
+    for path in ['a.jpg', 'b_dir/a.jpg', 'b_dir/b.jpg', 'c.jpg']:
+        with open(str(tmp_path / path), 'wb') as f:
+            f.write(encode_jpeg())
+    with open(str(tmp_path / 'd_broken.mp4'), 'wb') as f:
+        f.write(b'not a video')
+    kwargs = {'input_fps': None, 'skip_frame': 0, 'recognition_id': None, 'recursive': True}
+    # The broken video is only opened when counting the frames or when it is reached
+    with pytest.raises(DeepoVideoOpenError):
+        DirectoryInputData(str(tmp_path), **kwargs).get_frame_count()
+    inputs = iter(DirectoryInputData(str(tmp_path), count_frames=False, **kwargs))
+    assert inputs.get_frame_count() == -1
+    filenames = [next(inputs).filename for _ in range(4)]
+    assert filenames == [str(tmp_path / path) for path in ['a.jpg', 'b_dir/a.jpg', 'b_dir/b.jpg', 'c.jpg']]
+    with pytest.raises(DeepoVideoOpenError):
+        next(inputs)
+
+
+def test_input_cache(tmp_path):
+    directory = tmp_path / 'videos'
+    os.mkdir(str(directory))
+    for i in range(3):
+        write_synthetic_video(str(directory / 'video_{}.mp4'.format(i)), 20 + i)
+    cache = str(tmp_path / 'cache.db')
+    kwargs = {'input_fps': None, 'skip_frame': 1, 'recognition_id': None, 'recursive': False}
+    expected = DirectoryInputData(str(directory), **kwargs).get_frame_count()
+    assert expected == 10 + 10 + 11
+    assert DirectoryInputData(str(directory), input_cache=cache, **kwargs).get_frame_count() == expected
+
+    def cached_videos():
+        with InputManifest(cache) as manifest:
+            return {os.path.basename(path): manifest.get(path) for path in glob.glob(str(directory / '*.mp4'))}
+
+    assert all(entry is not None for entry in cached_videos().values())
+    # The videos are not opened again
+    with patch('deepomatic.cli.input_data.VideoInputData', side_effect=AssertionError):
+        assert DirectoryInputData(str(directory), input_cache=cache, **kwargs).get_frame_count() == expected
+
+    # A modified video is updated, a deleted one is removed
+    write_synthetic_video(str(directory / 'video_0.mp4'), 40)
+    os.remove(str(directory / 'video_2.mp4'))
+    assert cached_videos()['video_0.mp4'] is None
+    assert DirectoryInputData(str(directory), input_cache=cache, **kwargs).get_frame_count() == 20 + 10
+    assert cached_videos()['video_0.mp4'][1] == 40
+    with InputManifest(cache) as manifest:
+        assert manifest.prune(str(directory), [str(directory / 'video_0.mp4'), str(directory / 'video_1.mp4')]) == 0
@@ -0,0 +1,58 @@
+import os
+import json
+import pytest
+from benchmark import FakeWorkflow, build_kwargs, write_synthetic_directory
+from deepomatic.cli.exceptions import DeepoResumeError
+from deepomatic.cli.journal import ResumeJournal, get_journal_path, get_resume_journal
+from deepomatic.cli.lib.inference import InferManager
+
+
+def run(input_path, outputs, extra_opts=()):
+    workflow = FakeWorkflow(latency=0.001, jitter=0.)
+    InferManager().input_loop(build_kwargs(input_path, outputs, extra_opts), workflow=workflow)
+    return workflow
+
+
+def read_frames(path):
+    with open(path) as f:
+        return [(line['data']['original_filename'], line['data']['framename']) for line in map(json.loads, f)]
+
+
+def interrupt(path, nb_lines):
+    # Keep the first lines, and a truncated one, as if the job had been killed
+    with open(path) as f:
+        lines = f.readlines()
+    with open(path, 'w') as f:
+        f.writelines(lines[:nb_lines])
+        f.write(lines[nb_lines][:10])
+
+
+@pytest.mark.parametrize('with_journal', [True, False])
+@pytest.mark.parametrize('nb_done', [5, 15])  # interrupted after 5 images, or after 5 frames of the video
+def test_resume(tmp_path, with_journal, nb_done):
+    input_path = write_synthetic_directory(str(tmp_path / 'input'), nb_images=10, nb_video_frames=20)
+    output = str(tmp_path / 'output.jsonl')
+    run(input_path, [output], ['--resume'])
+    expected = read_frames(output)
+    assert len(expected) == 30
+    journal_path = get_journal_path(output)
+    assert len(ResumeJournal(journal_path)) == 30
+
+    interrupt(output, nb_done)
+    if with_journal:
+        interrupt(journal_path, nb_done)
+    else:
+        os.remove(journal_path)
+    workflow = run(input_path, [output], ['--resume'])
+    assert workflow.nb_requests == 30 - nb_done
+    assert read_frames(output) == expected
+    assert len(ResumeJournal(journal_path)) == 30
+
+
+def test_resume_outputs(tmp_path):
+    with pytest.raises(DeepoResumeError):
+        get_resume_journal([str(tmp_path / 'output.jsonl'), str(tmp_path / 'video.mp4')])
+    with pytest.raises(DeepoResumeError):
+        get_resume_journal([str(tmp_path / 'pred_%04d.json')])
+    journal = get_resume_journal([str(tmp_path / 'pred_%s.json'), str(tmp_path)])
+    assert journal.path == str(tmp_path / '.pred_s.json.journal')
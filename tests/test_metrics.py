@@ -0,0 +1,63 @@
+import json
+import gevent
+import requests
+from benchmark import FakeWorkflow, run_benchmark
+from deepomatic.cli.common import Queue
+from deepomatic.cli.metrics import Histogram, PipelineMetrics, MetricsExporter
+
+
+def test_histogram():
+    histogram = Histogram(buckets=(1, 2, 4))
+    assert histogram.quantile(0.5) is None
+    for value in (0.5, 1.5, 1.5, 3, 10):
+        histogram.observe(value)
+    assert histogram.count == 5
+    assert histogram.sum == 16.5
+    assert histogram.cumulative_counts() == [1, 3, 4, 5]
+    assert histogram.quantile(0.2) == 1
+    assert 1 < histogram.quantile(0.5) < 2
+    assert histogram.quantile(1) == 4
+
+
+def test_prometheus_format():
+    queue = Queue()
+    queue.put('msg')
+    metrics = PipelineMetrics(queues=[('input->output', queue)])
+    metrics.observe_processing('output', 0.003)
+    metrics.inference_sent()
+    text = metrics.to_prometheus()
+    assert 'deepocli_queue_depth{queue="input->output"} 1' in text
+    assert 'deepocli_inferences_in_flight 1' in text
+    assert 'deepocli_pool_processing_seconds_bucket{pool="output",le="0.005"} 1' in text
+    assert 'deepocli_pool_processing_seconds_count{pool="output"} 1' in text
+
+
+def test_metrics_endpoint():
+    metrics = PipelineMetrics()
+    metrics.observe_processing('encode', 0.01)
+    exporter = MetricsExporter(metrics, port=0)
+    exporter.start()
+    try:
+        url = 'http://localhost:{}'.format(exporter.server.server_port)
+        response = gevent.spawn(requests.get, url + '/metrics.json').get(timeout=10)
+        assert response.json()['pools']['encode']['count'] == 1
+        response = gevent.spawn(requests.get, url + '/metrics').get(timeout=10)
+        assert 'deepocli_pool_processing_seconds_count{pool="encode"} 1' in response.text
+        assert gevent.spawn(requests.get, url + '/unknown').get(timeout=10).status_code == 404
+    finally:
+        exporter.stop()
+
+
+def test_pipeline_stats_file(tmp_path, no_error_logs):
+    stats_file = str(tmp_path / 'stats.jsonl')
+    workflow = FakeWorkflow(latency=0.01)
+    run_benchmark('video', workflow, extra_opts=['--stats_file', stats_file, '--stats_interval', '0.1'])
+    with open(stats_file) as f:
+        stats = [json.loads(line) for line in f]
+    assert len(stats) > 0
+    last = stats[-1]
+    assert last['messages']['successful'] == 200
+    assert last['inferences_in_flight'] == 0
+    assert list(last['pools']) == ['input', 'encode', 'send', 'result', 'output']
+    assert last['pools']['send']['count'] == 200
+    assert list(last['queues']) == ['input->encode', 'encode->send', 'send->result', 'result->output']
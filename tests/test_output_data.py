@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import random
+import cv2
+import pytest
+from benchmark import FakeWorkflow, build_kwargs, make_predictions, write_synthetic_directory
+from deepomatic.cli.exceptions import DeepoSaveJsonToFileError
+from deepomatic.cli.frame import Frame
+from deepomatic.cli.lib.inference import InferManager
+from deepomatic.cli.output_data import AsyncOutputData, JsonOutputData, JsonLinesOutputData, OutputData
+from deepomatic.cli.predictions import Predictions
+from deepomatic.cli.cmds.studio_helpers.vulcan2studio import transform_json_from_vulcan_to_studio
+
+
+def make_frames(nb_frames):
+    rng = random.Random(0)
+    frames = []
+    for i in range(nb_frames):
+        frame = Frame('frame_{}'.format(i), 'video.mp4', None, i, i)
+        frame.predictions = Predictions.from_dict(make_predictions(3, rng))
+        frames.append(frame)
+    return frames
+
+
+def expected_json(frame):
+    predictions = frame.predictions.to_dict()
+    predictions['location'] = frame.filename
+    predictions['data'] = {'framename': frame.name, 'original_filename': frame.filename}
+    return predictions
+
+
+@pytest.mark.parametrize('nb_frames', [0, 1, 10])
+@pytest.mark.parametrize('studio_format', [False, True])
+def test_json_output(tmp_path, nb_frames, studio_format):
+    path = str(tmp_path / 'output.json')
+    output = JsonOutputData(path, studio_format=studio_format)
+    frames = make_frames(nb_frames)
+    for frame in frames:
+        output.output_frame(frame)
+    output.close()
+    with open(path) as f:
+        result = json.load(f)
+
+    expected = [expected_json(frame) for frame in frames]
+    if studio_format:
+        expected = transform_json_from_vulcan_to_studio(expected)
+        assert result['tags'] == sorted(expected['tags'])
+        assert result['images'] == expected['images']
+    else:
+        assert result == expected
+
+
+def test_jsonl_output(tmp_path):
+    path = str(tmp_path / 'output.jsonl')
+    frames = make_frames(10)
+    # Written once the first 3 lines are buffered
+    flush_bytes = sum(len(json.dumps(expected_json(frame))) + 1 for frame in frames[:3])
+    output = JsonLinesOutputData(path, jsonl_flush_bytes=flush_bytes, jsonl_flush_interval=3600)
+
+    def read_lines():
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+
+    for frame in frames[:2]:
+        output.output_frame(frame)
+    assert not os.path.exists(path)
+    output.output_frame(frames[2])
+    assert len(read_lines()) == 3
+    for frame in frames[3:]:
+        output.output_frame(frame)
+    output.close()
+    assert read_lines() == [expected_json(frame) for frame in frames]
+
+    # The lines are appended when the job is resumed, without buffering
+    output = JsonLinesOutputData(path, resume=True)
+    output.output_frame(frames[0])
+    assert len(read_lines()) == 11
+    output.close()
+
+
+class ListOutput(OutputData):
+    def __init__(self, fail_at=None):
+        super(ListOutput, self).__init__(None)
+        self.frames = []
+        self.closed = False
+        self._fail_at = fail_at
+
+    def output_frame(self, frame):
+        if len(self.frames) == self._fail_at:
+            raise DeepoSaveJsonToFileError('disk full')
+        time.sleep(0.001)
+        self.frames.append(frame.name)
+
+    def close(self):
+        self.closed = True
+
+
+def test_async_output():
+    frames = make_frames(20)
+    output = AsyncOutputData(ListOutput(), 4)
+    for frame in frames:
+        output.output_frame(frame)
+    output.close()
+    assert output.output.closed
+    assert output.output.frames == [frame.name for frame in frames]
+
+    # The error is raised by the next call
+    output = AsyncOutputData(ListOutput(fail_at=5), 4)
+    with pytest.raises(DeepoSaveJsonToFileError):
+        for frame in frames:
+            output.output_frame(frame)
+            time.sleep(0.01)
+    output.close()
+    assert output.output.frames == [frame.name for frame in frames[:5]]
+
+
+def test_async_outputs_pipeline(tmp_path):
+    input_path = write_synthetic_directory(str(tmp_path / 'input'), nb_images=10, nb_video_frames=10)
+    results = []
+    for queue_size in ['0', '4']:
+        output_dir = tmp_path / 'output_{}'.format(queue_size)
+        os.mkdir(str(output_dir))
+        outputs = [str(output_dir / 'images'), str(output_dir / 'output.jsonl'), str(output_dir / 'output.avi')]
+        os.mkdir(outputs[0])
+        kwargs = build_kwargs(input_path, outputs, ['--output_queue_size', queue_size])
+        InferManager().input_loop(kwargs, workflow=FakeWorkflow(latency=0.001))
+        with open(outputs[1]) as f:
+            names = [json.loads(line)['data']['framename'] for line in f]
+        video = cv2.VideoCapture(outputs[2])
+        results.append((names, sorted(os.listdir(outputs[0])), video.get(cv2.CAP_PROP_FRAME_COUNT)))
+        video.release()
+    assert len(results[0][0]) == len(results[0][1]) == results[0][2] == 20
+    assert results[0] == results[1]
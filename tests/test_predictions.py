@@ -0,0 +1,104 @@
+import os
+import json
+import copy
+import random
+import cv2
+import pytest
+import numpy as np
+from benchmark import FakeWorkflow, build_kwargs, make_predictions, run_benchmark, write_synthetic_directory
+from deepomatic.cli.frame import Frame
+from deepomatic.cli.lib.inference import DrawImagePostprocessing, BlurImagePostprocessing, InferManager
+from deepomatic.cli.predictions import Predictions
+
+
+def vulcan_predictions():
+    predictions = make_predictions(10, random.Random(0))
+    predictions['outputs'][0]['labels']['predicted'].append({'label_id': 10, 'label_name': 'tag', 'score': 0.9,
+                                                             'threshold': 0.5})
+    predictions['extra'] = 'kept'
+    return predictions
+
+
+def test_predictions_from_dict():
+    vulcan = vulcan_predictions()
+    predictions = Predictions.from_dict(copy.deepcopy(vulcan))
+    labels = predictions.outputs[0].labels
+    assert len(labels.predicted) == len(vulcan['outputs'][0]['labels']['predicted'])
+    tag = labels.predicted[-1]
+    assert (tag.label_name, tag.score, tag.bbox) == ('tag', 0.9, None)
+    bbox = vulcan['outputs'][0]['labels']['predicted'][0]['roi']['bbox']
+    assert labels.predicted[0].bbox == (bbox['xmin'], bbox['ymin'], bbox['xmax'], bbox['ymax'])
+    assert predictions.to_dict() == vulcan
+    # Thresholding only updates the mask, the predictions keep their order
+    labels.is_predicted[len(labels.predicted) - 1] = False
+    assert [pred.label_name for pred in labels.discarded][0] == 'tag'
+    assert predictions.to_dict()['outputs'][0]['labels']['discarded'][0]['label_name'] == 'tag'
+    assert predictions.to_dict()['extra'] == 'kept'
+
+
+def test_label_thresholds(tmp_path):
+    label_thresholds = str(tmp_path / 'thresholds.json')
+    with open(label_thresholds, 'w') as f:
+        json.dump({'label_1': 0., 'label_2': 1.1}, f)
+    output = str(tmp_path / 'output.jsonl')
+    run_benchmark('directory', FakeWorkflow(latency=0.001),
+                  extra_opts=['-o', output, '-t', '0.7', '--label_thresholds', label_thresholds])
+    with open(output) as f:
+        frames = [json.loads(line) for line in f]
+    assert len(frames) == 100
+    for frame in frames:
+        labels = frame['outputs'][0]['labels']
+        for pred in labels['predicted']:
+            assert pred['label_name'] != 'label_2'
+            assert pred['label_name'] == 'label_1' or pred['score'] >= 0.7
+        for pred in labels['discarded']:
+            assert pred['label_name'] != 'label_1'
+            assert pred['label_name'] == 'label_2' or pred['score'] < 0.7
+
+
+def test_postprocessings():
+    image = np.full((100, 200, 3), 128, np.uint8)
+    frame = Frame('frame', 'frame.jpg', image)
+    frame.predictions = Predictions.from_dict(vulcan_predictions())
+    DrawImagePostprocessing(draw_labels=True, draw_scores=True, font_scale=0.5, font_thickness=1,
+                            threshold=None, font_bg_color=None)(frame)
+    assert frame.output_image.shape == image.shape
+    assert not np.array_equal(frame.output_image, image)
+    BlurImagePostprocessing(blur_method='black')(frame)
+    assert (frame.output_image == 0).any()
+
+
+@pytest.mark.parametrize('postprocessing_workers', [0, 3])
+def test_postprocessing_workers(tmp_path, postprocessing_workers):
+    input_path = write_synthetic_directory(str(tmp_path / 'input'), nb_images=20, nb_video_frames=1)
+    os.remove(os.path.join(input_path, 'video.mp4'))
+    output = str(tmp_path / 'output.jsonl')
+    images = str(tmp_path / 'frame_%04d.png')
+    draw = DrawImagePostprocessing(draw_labels=True, draw_scores=False, font_scale=0.5, font_thickness=1,
+                                   threshold=None, font_bg_color=None)
+    kwargs = build_kwargs(input_path, [output, images], ['--postprocessing_workers', str(postprocessing_workers)])
+    InferManager().input_loop(kwargs, postprocessing=draw, workflow=FakeWorkflow(latency=0.001))
+    with open(output) as f:
+        lines = [json.loads(line) for line in f]
+    assert [line['data']['original_filename'] for line in lines] == sorted(
+        os.path.join(input_path, name) for name in os.listdir(input_path))
+    # The frames are written in order, each one drawn with its own predictions
+    for i, line in enumerate(lines):
+        frame = Frame('frame', line['data']['original_filename'], cv2.imread(line['data']['original_filename']))
+        frame.predictions = Predictions.from_dict(line)
+        draw(frame)
+        assert np.array_equal(cv2.imread(images % (i + 1)), frame.output_image)
+
+
+def test_threshold(tmp_path, no_error_logs):
+    output = str(tmp_path / 'output.json')
+    run_benchmark('directory', FakeWorkflow(latency=0.001), extra_opts=['-o', output, '-t', '0.7'])
+    assert os.path.exists(output)
+    with open(output) as f:
+        frames = json.load(f)
+    assert len(frames) == 100
+    for frame in frames:
+        labels = frame['outputs'][0]['labels']
+        assert all(pred['score'] >= 0.7 for pred in labels['predicted'])
+        assert all(pred['score'] < 0.7 for pred in labels['discarded'])
+        assert len(labels['predicted']) + len(labels['discarded']) == 10
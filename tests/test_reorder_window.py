@@ -0,0 +1,50 @@
+import os
+import re
+import json
+import logging
+from benchmark import FakeWorkflow, run_benchmark
+
+
+VIDEO_FRAMES = 200
+SLOW_FRAME = 3
+
+
+def run_with_slow_frame(tmp_path, caplog, policy, *opts):
+    # The 4th frame is much slower to send than the others, frames behind it pile up in the reorder window
+    caplog.set_level(logging.INFO)
+    workflow = FakeWorkflow(latency=0.005, jitter=0, slow_sends={SLOW_FRAME: 1})
+    run_benchmark('video', workflow, tmpdir=str(tmp_path),
+                  extra_opts=['--reorder_policy', policy, '--reorder_window_frames', '10'] + list(opts))
+    with open(os.path.join(str(tmp_path), 'output.jsonl')) as f:
+        frame_names = [json.loads(line)['data']['framename'] for line in f]
+    peak = re.search(r'Reorder window: peak of (\d+) frames', caplog.text)
+    summary = re.search(r'Summary: errors=(\d+) uncompleted=(\d+) successful=(\d+)', caplog.text)
+    return frame_names, int(peak.group(1)) if peak else 0, [int(count) for count in summary.groups()]
+
+
+def test_reorder_window_block(tmp_path, caplog, no_error_logs):
+    frame_names, peak, summary = run_with_slow_frame(tmp_path, caplog, 'block')
+    assert len(frame_names) == VIDEO_FRAMES
+    assert frame_names == sorted(frame_names)
+    # Admission control limits the frames in the pipeline, the slow frame included
+    assert 0 < peak < 10
+    assert summary == [0, 0, VIDEO_FRAMES]
+
+
+def test_reorder_window_unordered(tmp_path, caplog, no_error_logs):
+    frame_names, peak, summary = run_with_slow_frame(tmp_path, caplog, 'unordered')
+    assert len(frame_names) == VIDEO_FRAMES
+    assert frame_names != sorted(frame_names)
+    # The slow frame is output after the window was full
+    assert frame_names.index(sorted(frame_names)[SLOW_FRAME]) > 10
+    assert peak == 11
+    assert summary == [0, 0, VIDEO_FRAMES]
+
+
+def test_reorder_window_drop(tmp_path, caplog, no_error_logs):
+    frame_names, peak, summary = run_with_slow_frame(tmp_path, caplog, 'drop')
+    assert len(frame_names) == VIDEO_FRAMES - 1
+    assert frame_names == sorted(frame_names)
+    assert peak == 11
+    assert 'dropping frame {}'.format(SLOW_FRAME) in caplog.text
+    assert summary == [1, 0, VIDEO_FRAMES - 1]
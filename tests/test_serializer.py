@@ -0,0 +1,44 @@
+import io
+import json
+import random
+import pytest
+from benchmark import benchmark_serialization, make_predictions
+from deepomatic.cli import serializer
+
+
+@pytest.fixture
+def backend():
+    current = serializer.BACKEND
+    yield
+    serializer.use_backend(current)
+
+
+@pytest.mark.parametrize('name', list(serializer.BACKENDS))
+def test_backends(backend, name):
+    if name not in serializer.installed_backends():
+        pytest.skip('{} is not installed'.format(name))
+    serializer.use_backend(name)
+    predictions = make_predictions(100, random.Random(0))
+    predictions['outputs'][0]['labels']['predicted'][0]['label_name'] = u'étiquette/1'
+    # Any backend writes the same document
+    data = serializer.dumps(predictions)
+    assert json.loads(data) == predictions
+    assert serializer.loads(json.dumps(predictions)) == predictions
+    f = io.StringIO()
+    serializer.dump(predictions, f)
+    f.seek(0)
+    assert serializer.load(f) == predictions
+
+
+def test_backend_fallback(backend):
+    with pytest.raises(ValueError):
+        serializer.use_backend('unknown')
+    assert serializer.use_backend('json') == 'json'
+    assert serializer.dumps({'a': [1, 2.5, None]}) == json.dumps({'a': [1, 2.5, None]})
+
+
+def test_benchmark_serialization(backend):
+    current = serializer.BACKEND
+    results = benchmark_serialization(nb_frames=2, nb_predictions=10)
+    assert 'json' in results and current in results
+    assert serializer.BACKEND == current
@@ -0,0 +1,254 @@
+import time
+import random
+import threading
+import gevent
+import pytest
+from tqdm import tqdm
+from deepomatic.cli.common import Queue, Empty, Full
+from deepomatic.cli.thread_base import Pool, Thread, Greenlet, MainLoop, CurrentMessages, Sequencer
+
+
+# ------- Helpers ---------------------------------------------------------------------------------------------------- #
+
+
+class ProducerThread(Thread):
+    def __init__(self, exit_event, input_queue, output_queue, messages, delay=0):
+        super(ProducerThread, self).__init__(exit_event, input_queue, output_queue)
+        self.messages = iter(messages)
+        self.delay = delay
+
+    def process_msg(self, _unused):
+        if self.delay:
+            gevent.sleep(self.delay)
+        try:
+            return next(self.messages)
+        except StopIteration:
+            self.stop()
+
+
+class ForwardGreenlet(Greenlet):
+    def process_msg(self, msg):
+        return msg
+
+
+class ForwardThread(Thread):
+    def process_msg(self, msg):
+        return msg
+
+
+class SequencedThread(Thread):
+    # Processing takes a random time, the sequencer must keep the order
+    def __init__(self, exit_event, input_queue, output_queue, sequencer):
+        super(SequencedThread, self).__init__(exit_event, input_queue, output_queue)
+        self.sequencer = sequencer
+        self.ticket = None
+
+    def pop_input(self):
+        msg, self.ticket = self.sequencer.pop(super(SequencedThread, self).pop_input)
+        return msg
+
+    def process_msg(self, msg):
+        time.sleep(random.random() * 0.002)
+        self.sequencer.wait_turn(self.ticket)
+        try:
+            self.output_queue.put(msg)
+        finally:
+            self.sequencer.end_turn()
+
+
+class ConsumerThread(Thread):
+    def __init__(self, exit_event, input_queue, output_queue, current_messages, received):
+        super(ConsumerThread, self).__init__(exit_event, input_queue, output_queue, current_messages)
+        self.received = received
+
+    def process_msg(self, msg):
+        self.received.append(msg)
+        self.current_messages.report_success()
+
+
+def run_pipeline(messages, delay=0, stop_after=None, sequenced=False):
+    queues = [Queue(maxsize=10) for _ in range(3)]
+    exit_event = threading.Event()
+    current_messages = CurrentMessages()
+    received = []
+    pools = [
+        Pool(1, ProducerThread, thread_args=(exit_event, None, queues[0], messages, delay)),
+        Pool(1, ForwardThread, thread_args=(exit_event, queues[0], queues[1])),
+        Pool(5, ForwardGreenlet, thread_args=(exit_event, queues[1], queues[2])) if not sequenced else
+        Pool(4, SequencedThread, thread_args=(exit_event, queues[1], queues[2], Sequencer())),
+        Pool(1, ConsumerThread, thread_args=(exit_event, queues[2], None, current_messages, received)),
+    ]
+    pbar = tqdm(total=None, disable=True)
+    loop = MainLoop(pools, queues, pbar, exit_event, current_messages)
+    if stop_after is not None:
+        gevent.spawn_later(stop_after, loop.stop)
+    loop.run_forever()
+    assert not exit_event.is_set()
+    return received, current_messages
+
+
+# ------- Queue Tests ------------------------------------------------------------------------------------------------ #
+
+
+def test_queue_non_blocking():
+    queue = Queue(maxsize=1)
+    with pytest.raises(Empty):
+        queue.get(block=False)
+    queue.put(1, block=False)
+    with pytest.raises(Full):
+        queue.put(2, block=False)
+    assert queue.get(block=False) == 1
+
+
+def test_queue_timeout():
+    queue = Queue(maxsize=1)
+    start = time.time()
+    with pytest.raises(Empty):
+        queue.get(timeout=0.1)
+    assert not queue.wait_not_empty(timeout=0.1)
+    queue.put(1)
+    with pytest.raises(Full):
+        queue.put(2, timeout=0.1)
+    assert not queue.wait_not_full(timeout=0.1)
+    assert time.time() - start >= 0.4
+
+
+def test_queue_get_woken_up_by_greenlet():
+    queue = Queue()
+    gevent.spawn_later(0.05, queue.put, 'msg')
+    assert queue.get(timeout=5) == 'msg'
+
+
+def test_queue_get_woken_up_by_thread():
+    queue = Queue()
+    timer = threading.Timer(0.05, queue.put, args=('msg',))
+    timer.start()
+    assert queue.get(timeout=5) == 'msg'
+    timer.join()
+
+
+def test_queue_put_woken_up_by_clear():
+    queue = Queue(maxsize=1)
+    queue.put(1)
+    gevent.spawn_later(0.05, queue.clear)
+    queue.put(2, timeout=5)
+    assert queue.get(block=False) == 2
+
+
+def test_queue_put_is_fair():
+    # Blocked producers must be served in arrival order, even if another producer comes when there is room
+    queue = Queue(maxsize=1)
+    queue.put(0)
+    producers = [gevent.spawn(queue.put, i) for i in range(1, 4)]
+    gevent.sleep(0.01)
+    items = [queue.get(block=False)]
+    # Comes when there is room, but after the blocked producers
+    producers.append(gevent.spawn(queue.put, 4))
+    while len(items) < 5:
+        items.append(queue.get(timeout=5))
+    gevent.joinall(producers)
+    assert items == [0, 1, 2, 3, 4]
+
+
+def test_queue_wake_up():
+    queue = Queue()
+    gevent.spawn_later(0.05, queue.wake_up)
+    start = time.time()
+    assert not queue.wait_not_empty(timeout=5)
+    assert time.time() - start < 1
+
+
+# ------- CurrentMessages Tests -------------------------------------------------------------------------------------- #
+
+
+def test_current_messages_order():
+    current_messages = CurrentMessages()
+    assert current_messages.get_min() is None
+    assert current_messages.pop_min() is None
+    for msg in (0, 1, 3, 4, 6):
+        current_messages.add_message(msg)
+    current_messages.forget_message(3)
+    current_messages.forget_message(0)
+    current_messages.forget_message(6, count_as_error=False)
+    assert current_messages.nb_added_messages == 5
+    assert current_messages.nb_errors == 2
+    assert len(current_messages) == 2
+    assert current_messages.get_min() == 1
+    assert current_messages.pop_min() == 1
+    assert current_messages.pop_min() == 4
+    assert current_messages.pop_min() is None
+    # Out of order messages are still sorted
+    current_messages.add_message(10)
+    current_messages.add_message(8)
+    assert current_messages.pop_min() == 8
+    assert current_messages.pop_min() == 10
+
+
+def test_current_messages_forget_unknown(caplog):
+    current_messages = CurrentMessages()
+    current_messages.add_message(1)
+    current_messages.forget_message(2)
+    assert 'Cannot forget message 2' in caplog.text
+    assert current_messages.get_min() == 1
+
+
+def test_current_messages_forget_is_not_linear():
+    # Forgetting messages out of order used to cost a list.remove and a heapify each time
+    nb_messages = 200000
+    current_messages = CurrentMessages()
+    start = time.time()
+    for msg in range(nb_messages):
+        current_messages.add_message(msg)
+    for msg in range(nb_messages - 1, 0, -1):
+        current_messages.forget_message(msg)
+    assert current_messages.pop_min() == 0
+    assert current_messages.pop_min() is None
+    assert time.time() - start < 2
+
+
+# ------- Pipeline Tests --------------------------------------------------------------------------------------------- #
+
+
+def test_pipeline_drains_all_messages(no_error_logs):
+    messages = list(range(500))
+    received, current_messages = run_pipeline(messages)
+    assert sorted(received) == messages
+    assert current_messages.nb_successes == len(messages)
+
+
+def test_pipeline_sequencer_keeps_order(no_error_logs):
+    messages = list(range(300))
+    received, _ = run_pipeline(messages, sequenced=True)
+    assert received == messages
+
+
+def test_pipeline_soft_stop_processes_queued_messages(no_error_logs):
+    # The producer never ends by itself, the soft stop must let the queued messages go through
+    received, current_messages = run_pipeline(iter(int, 1), delay=0.001, stop_after=0.2)
+    assert len(received) > 0
+    assert current_messages.nb_successes == len(received)
+
+
+# ------- Non performance regression tests --------------------------------------------------------------------------- #
+
+
+def test_idle_pipeline_does_not_busy_wait(no_error_logs):
+    # Downstream pools wait for a message that comes only after 1 second,
+    # they must sleep instead of polling their queues
+    start_cpu = time.process_time()
+    start = time.time()
+    received, _ = run_pipeline(['msg'], delay=1)
+    elapsed = time.time() - start
+    cpu = time.process_time() - start_cpu
+    assert received == ['msg']
+    assert elapsed >= 1
+    assert cpu < 0.05 * elapsed
+
+
+def test_pipeline_throughput(no_error_logs):
+    messages = list(range(5000))
+    start = time.time()
+    received, _ = run_pipeline(messages)
+    assert len(received) == len(messages)
+    # Each hand-off must cost a wake up, not a polling period
+    assert time.time() - start < 3